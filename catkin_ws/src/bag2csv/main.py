@@ -1,12 +1,19 @@
 """
-This script saves each topic in a bagfile as a csv.
+This script saves each topic in a bagfile as a csv (and optionally as binary .npy files).
 
-Accepts a filename as an optional argument. Operates on all bagfiles in current directory if no argument provided
+Accepts a filename as argument, and optionally the names of the topics to export. All the topics are exported if no
+topic names are provided.
 
-Usage 1 (for one bag file):
+Usage 1 (for some topics):
     python bag2csv.py bag_directory/filename.bag topic_1 topic_2 ... topic_n
-Usage 2 (for all bag files in current directory):
+Usage 2 (for all topics in the bag file):
     python bag2csv.py bag_directory/filename.bag
+Usage 3 (also write a .npy file with the numeric columns of each topic):
+    python bag2csv.py --binary bag_directory/filename.bag topic_1 topic_2 ... topic_n
+
+The bag is read only once, and every message is sent to the writer of its topic. The columns of each topic are taken
+from the message type (nested fields are joined with dots, fixed-size arrays are expanded into one column per element),
+and the writers run on their own threads, so that file I/O overlaps with the decoding of the bag.
 
 Script adapted by Guillem Torrente from original script by Nick Speal in May 2013 at McGill University's Aerospace
 Mechatronics Laboratory. Bugfixed by Marc Hanheide. June 2016.
@@ -15,84 +22,210 @@ www.speal.ca
 Supervised by Professor Inna Sharf, Professor Meyer Nahon
 """
 
-import rosbag
-import sys
-import csv
-import string
+from __future__ import print_function
+
+import re
 import os  # for file management make directory
+import csv
+import sys
+import argparse
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import numpy as np
+import rosbag
+
+# Number of rows handed to a writer at once, and maximum number of pending batches per writer
+BATCH_SIZE = 1000
+MAX_PENDING_BATCHES = 16
+
+PRIMITIVE_TYPES = {
+    "bool": np.bool_, "int8": np.int8, "uint8": np.uint8, "byte": np.int8, "char": np.uint8,
+    "int16": np.int16, "uint16": np.uint16, "int32": np.int32, "uint32": np.uint32,
+    "int64": np.int64, "uint64": np.uint64, "float32": np.float32, "float64": np.float64,
+    "time": np.int64, "duration": np.int64, "string": None
+}
+
+
+class Column(object):
+    def __init__(self, name, slot_path, index=None, dtype=None):
+        """
+        Describes how to extract one column from a message
+
+        :param name: column header
+        :param slot_path: list of attribute names to get to the field from the message
+        :param index: element index, if the field is a fixed-size array
+        :param dtype: numpy type of the column, or None if the column is not numeric
+        """
+        self.name = name
+        self.slot_path = slot_path
+        self.index = index
+        self.dtype = dtype
+
+    def value(self, msg):
+        for slot in self.slot_path:
+            msg = getattr(msg, slot)
+        if self.index is not None:
+            msg = msg[self.index]
+        if hasattr(msg, "to_nsec"):
+            # rospy Time and Duration are exported in ns
+            return msg.to_nsec()
+        if isinstance(msg, (list, tuple)):
+            # Variable-length arrays are exported in a single column
+            return " ".join(str(x) for x in msg)
+        return msg
+
+
+def message_columns(msg, prefix="", slot_path=()):
+    """
+    Generates the column layout of a message from its type
+
+    :param msg: a message instance of the type
+    :param prefix: header prefix of the columns
+    :param slot_path: attribute names to get to `msg` from the top level message
+    :return: list of Column objects
+    """
+
+    columns = []
+    for slot, slot_type in zip(msg.__slots__, msg._slot_types):
+        name = prefix + slot
+        path = list(slot_path) + [slot]
+        array_match = re.match(r"^(.+)\[(\d*)\]$", slot_type)
+
+        if array_match:
+            base_type, size = array_match.groups()
+            if size and base_type in PRIMITIVE_TYPES:
+                columns += [Column("{0}_{1}".format(name, i), path, i, PRIMITIVE_TYPES[base_type])
+                            for i in range(int(size))]
+            else:
+                columns.append(Column(name, path))
+        elif slot_type in PRIMITIVE_TYPES:
+            columns.append(Column(name, path, dtype=PRIMITIVE_TYPES[slot_type]))
+        else:
+            columns += message_columns(getattr(msg, slot), name + ".", path)
+
+    return columns
+
+
+class TopicWriter(object):
+    def __init__(self, file_base, write_binary):
+        """
+        Writes the messages of one topic to a csv file (and optionally a .npy file) in a background thread
+
+        :param file_base: path of the output files, without extension
+        :param write_binary: whether to also write the numeric columns in a .npy file
+        """
+        self.file_base = file_base
+        self.write_binary = write_binary
+        self.columns = None
+        self.numeric_columns = None
+        self.binary_dtype = None
+        self.batch = []
+        self.binary_rows = []
+        self.pending = queue.Queue(maxsize=MAX_PENDING_BATCHES)
+        self.thread = None
+        self.error = None
+        self.csv_file = None
+        self.csv_writer = None
+
+    def add(self, msg, t):
+        if self.columns is None:
+            self.columns = message_columns(msg)
+            self.numeric_columns = [i for i, column in enumerate(self.columns) if column.dtype is not None]
+            # Structured array: one named field per numeric column, with the type given by the message definition
+            self.binary_dtype = [("rosbagTimestamp", np.int64)] + \
+                [(self.columns[i].name, self.columns[i].dtype) for i in self.numeric_columns]
+            self.csv_file = open(self.file_base + ".csv", "w")
+            self.csv_writer = csv.writer(self.csv_file, delimiter=",")
+            self.csv_writer.writerow(["rosbagTimestamp"] + [column.name for column in self.columns])
+            self.thread = threading.Thread(target=self._run)
+            self.thread.start()
+
+        self.batch.append([t.to_nsec()] + [column.value(msg) for column in self.columns])
+        if len(self.batch) >= BATCH_SIZE:
+            self.pending.put(self.batch)
+            self.batch = []
+
+    def _run(self):
+        while True:
+            rows = self.pending.get()
+            if rows is None:
+                break
+            if self.error is not None:
+                # Keep draining the queue so that the reading thread is never blocked
+                continue
+            try:
+                self.csv_writer.writerows(rows)
+                if self.write_binary:
+                    self.binary_rows.append(np.array(
+                        [tuple([row[0]] + [row[i + 1] for i in self.numeric_columns]) for row in rows],
+                        dtype=self.binary_dtype))
+            except Exception as exc:
+                self.error = exc
+
+    def close(self):
+        if self.thread is None:
+            return
+        if self.batch:
+            self.pending.put(self.batch)
+        self.pending.put(None)
+        self.thread.join()
+        self.csv_file.close()
+
+        if self.error is not None:
+            raise self.error
+
+        if self.write_binary:
+            np.save(self.file_base + ".npy", np.concatenate(self.binary_rows))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the topics of a bag file to csv (and npy) files")
+    parser.add_argument("bag_file", help="bag file to read")
+    parser.add_argument("topic_names", nargs="*", help="topics to export. All topics are exported if none is given")
+    parser.add_argument("--binary", action="store_true", help="also write a .npy file with the numeric columns")
+    args = parser.parse_args()
+
+    print("reading bag file: " + str(args.bag_file))
 
-# verify correct input arguments: 1 or 2
-if len(sys.argv) < 2:
-    print("invalid number of arguments:   " + str(len(sys.argv)))
-    print("should be 3 or more: 'bag2csv.py' 'bagDir/Name' 'topicName_1' 'topicName_2' ...")
-    print("or just 2  : 'bag2csv.py' 'bagDir/Name")
-    sys.exit(1)
-else:
-    listOfBagFiles = [sys.argv[1]]
-    numberOfFiles = 1
-    print("reading bag file: " + str(listOfBagFiles[0]))
-
-    topic_names = None
-    if len(sys.argv) > 2:
-        topic_names = sys.argv[2:]
-        topic_name_list = ""
-        for topic_name in topic_names:
-            topic_name = string.lower(topic_name)
-            topic_name_list += topic_name + ' '
-        print("reading topics: " + topic_name_list)
-
-for bagFile in listOfBagFiles:
     # access bag
-    bag = rosbag.Bag(bagFile)
-    bagContents = bag.read_messages()
-    bagName = bag.filename
+    bag = rosbag.Bag(args.bag_file)
+
+    # get list of topics from the bag index, without reading the messages
+    list_of_topics = list(bag.get_type_and_topic_info()[1].keys())
+    if args.topic_names:
+        requested = [topic_name.lower() for topic_name in args.topic_names]
+        list_of_topics = [topic for topic in list_of_topics if topic.lower() in requested]
+    print("reading topics: " + " ".join(list_of_topics))
 
     # create a new directory
-    folder = string.split(bagName, ".bag")[0]
+    folder = args.bag_file.split(".bag")[0]
     if not os.path.exists(folder):
         os.makedirs(folder)
 
-    # get list of topics from the bag
-    listOfTopics = []
-    for topic, msg, t in bagContents:
-        if topic not in listOfTopics:
-            listOfTopics.append(topic)
-
-    for topicName in listOfTopics:
-        if topic_names is not None and string.lower(topicName) not in topic_names:
-            continue
-
-        # Create a new CSV file for each topic
-        filename = folder + '/' + string.replace(topicName, '/', '_slash_') + '.csv'
-        with open(filename, 'w+') as csvfile:
-            file_writer = csv.writer(csvfile, delimiter=',')
-            firstIteration = True  # allows header row
-            for subtopic, msg, t in bag.read_messages(topicName):
-                # for each instant in time that has data for topicName parse data from this instant, which is of the
-                # form of multiple lines of "Name: value\n", then put it in the form of a list of 2-element lists
-
-                msgString = str(msg)
-                msgList = string.split(msgString, '\n')
-                instantaneousListOfData = []
-                for nameValuePair in msgList:
-                    splitPair = string.split(nameValuePair, ':')
-                    for i in range(len(splitPair)):  # should be 0 to 1
-                        splitPair[i] = string.strip(splitPair[i])
-                    instantaneousListOfData.append(splitPair)
-
-                # write the first row from the first element of each pair
-                if firstIteration:  # header
-                    headers = ["rosbagTimestamp"]  # first column header
-                    for pair in instantaneousListOfData:
-                        headers.append(pair[0])
-                    file_writer.writerow(headers)
-                    firstIteration = False
-                    
-                # write the value from each pair to the file
-                values = [str(t)]  # first column will have rosbag timestamp
-                for pair in instantaneousListOfData:
-                    if len(pair) > 1:
-                        values.append(pair[1])
-                file_writer.writerow(values)
-    bag.close()
-print("Done reading all " + str(numberOfFiles) + " bag files.")
+    writers = {topic: TopicWriter(folder + "/" + topic.replace("/", "_slash_"), args.binary)
+               for topic in list_of_topics}
+
+    # Single pass over the bag: each message goes to the writer of its topic
+    try:
+        for topic, msg, t in bag.read_messages(topics=list_of_topics):
+            writers[topic].add(msg, t)
+    finally:
+        for writer in writers.values():
+            writer.close()
+        bag.close()
+
+    print("Done reading bag file " + str(args.bag_file))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("invalid number of arguments:   " + str(len(sys.argv)))
+        print("should be 3 or more: 'bag2csv.py' 'bagDir/Name' 'topicName_1' 'topicName_2' ...")
+        print("or just 2  : 'bag2csv.py' 'bagDir/Name")
+        sys.exit(1)
+    main()
@@ -8,7 +8,25 @@ gflags.DEFINE_integer("model_number", 8, "Which model to train or test")
 gflags.DEFINE_string("model_type", "preintegration_net", "Type of the deep model")
 gflags.DEFINE_string('dataset', 'blackbird', 'Which dataset to use for training and testing')
 gflags.DEFINE_integer('window_length', 50, 'The number of past samples used to predict next velocity value')
+gflags.DEFINE_integer('max_window_length', 0, 'If larger than window_length, the pre-integration targets are computed '
+                      'and cached once for windows of this length, and sliced for any shorter window length')
 gflags.DEFINE_string('dataset_type', "imu_preintegration", 'Dataset structure to be built')
+gflags.DEFINE_list('sequences', [], 'Sequences to combine in the dataset, as comma-separated specs (e.g. '
+                   'bentDice/yawForward/2.0,clover/yawForward/1.0 for blackbird). If empty, the sequence selected by '
+                   'the dataset flags is used')
+gflags.DEFINE_integer('ingestion_workers', 4, 'Number of processes used to generate the sequences of the dataset')
+gflags.DEFINE_integer('pre_integration_workers', 1, 'Number of processes used to compute the targets of the '
+                      'pre-integration dataset of every sequence')
+gflags.DEFINE_integer('preprocessing_chunk_size', 0, 'If not 0, the sequences are preprocessed out of core, in chunks '
+                      'of this number of samples')
+gflags.DEFINE_bool('uniform_imu_rate', False, 'Whether to resample the IMU data onto an exact uniform time grid at the '
+                   'sampling frequency of the dataset')
+gflags.DEFINE_string('dataset_precision', 'float64', 'Floating point type of the windows and targets of the datasets '
+                     '(float64 or float32)')
+gflags.DEFINE_integer('window_stride', 1, 'Only every window_stride-th window of every sequence is part of the '
+                      'datasets')
+gflags.DEFINE_bool('random_window_stride', False, 'Whether to keep all the windows in the datasets, and apply the '
+                   'window stride at a random offset on every pass over the training dataset instead')
 
 # Train parameters
 gflags.DEFINE_integer('batch_size', 32, 'Batch size in training and evaluation')
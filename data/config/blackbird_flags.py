@@ -5,3 +5,7 @@ FLAGS = gflags.FLAGS
 gflags.DEFINE_string('trajectory_name', 'bentDice', 'The name of the trajectory to use from the dataset')
 gflags.DEFINE_string('yaw_type', 'yawForward', 'The yaw type to use from the dataset')
 gflags.DEFINE_float('max_speed', 2.0, 'The maximum speed of the drone in the dataset')
+
+# Ground truth parameters
+gflags.DEFINE_integer('gt_smoothing_window', 0, 'Length (odd, in samples) of the Savitzky-Golay filter used to derive '
+                                                'the ground truth velocities and acceleration. 0: no smoothing')
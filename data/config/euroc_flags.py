@@ -3,3 +3,8 @@ FLAGS = gflags.FLAGS
 
 # Dataset selection parameters
 gflags.DEFINE_string('dataset_version', 'dataset_1', 'Which version to use of the EuRoC dataset')
+
+# Resampling parameters
+gflags.DEFINE_string('oversampled_regions', '6000:7000:4:mirror', 'Regions of the processed flight that are '
+                                                                   'oversampled, as semicolon-separated '
+                                                                   'start:end:repeats[:mirror] specs. Empty: none')
@@ -5,3 +5,7 @@ FLAGS = gflags.FLAGS
 gflags.DEFINE_string('dataset_version', 'euroc', 'Which version of the generated dataset to use')
 gflags.DEFINE_string('flight', 'MH01', 'Which flight version of the dataset to use')
 gflags.DEFINE_integer('number', 0, 'Which number of the generated version to use')
+
+# Reading parameters
+gflags.DEFINE_integer('read_chunk_size', 1000000, 'Number of rows of the simulator files parsed at once (0: all)')
+gflags.DEFINE_bool('out_of_core_read', False, 'Whether to read the simulator files into memory-mapped files')
@@ -1,14 +1,44 @@
+import os
+import shutil
+import multiprocessing
 import numpy as np
 import collections
-from utils.algebra import log_mapping, quaternion_error, rotate_vec, q_inv, correct_quaternion_flip
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from utils.algebra import log_mapping, quaternion_normalize, quaternion_product, quaternion_conjugate, \
+    quaternion_to_rotation_matrix, quaternion_log
 from tensorflow.python.keras.utils import Progbar
 
 
+# Number of window samples (windows x window length) pre-integrated at once
+PRE_INTEGRATION_BLOCK_ELEMENTS = 2 ** 18
+
+
 class StatePredictionDataset:
-    def __init__(self):
+    def __init__(self, pre_integration_workers=1, dtype=np.float64):
+        """
+        Generates the windowed datasets (inputs and targets) of the pre-processed imu and ground truth data
+
+        :param pre_integration_workers: number of processes that compute the targets of the pre-integration dataset.
+        With more than one, the data and the targets are placed in shared memory, and every process computes the
+        targets of a range of windows in place
+        :param dtype: floating point type of the generated inputs and targets. The timestamps and the intermediate
+        results are always computed in float64, and only the stored values are rounded to this type
+        """
+
+        self.pre_integration_workers = pre_integration_workers
+        self.dtype = np.dtype(dtype)
+        self.pre_integration_pool = None
+
+        # Pre-integration targets of every window start, from which the pre-integration dataset is sliced (see
+        # `build_pre_integration_table`). Built for the requested window length if not given
+        self.pre_integration_table = None
 
         self.imu_raw = None
         self.gt_raw = None
+        self.sample_map = None
+
+        # Padded imu buffer of the last generated imu windows, which are views of it (see `window_imu_data`)
+        self.padded_imu = None
         self.x_ds = {}
         self.y_ds = {}
         self.accepted_datasets = [
@@ -36,7 +66,7 @@ class StatePredictionDataset:
         assert collections.Counter(self.accepted_datasets) == collections.Counter(list(self.dataset_keys.keys())), \
             "There is one or more key mismatch in the accepted dataset dictionaries"
 
-    def load_data(self, imu, gt):
+    def load_data(self, imu, gt, sample_map=None):
         """
         Loads the imu and ground truth data. They will be used to generate a dataset
 
@@ -46,20 +76,42 @@ class StatePredictionDataset:
         :param gt: ground truth velocity data. Shape: <n, 6>, n = number of acquisitions, and each acquisition is a
         6-dimensional vector where in order the components represent: x,y,z position, x,y,z velocity, w,x,y,z attitude,
         x,y,z angular velocity, x,y,z acceleration and timestamp difference (same as `raw_imu`)
+        :param sample_map: index map over the samples of `imu` and `gt` (see `oversampling_index_map`). If given, the
+        dataset is generated from the sequence of samples `imu[sample_map]`, `gt[sample_map]`, which are gathered
+        through the map while generating the windows, instead of expanding the loaded data beforehand
         """
 
         self.imu_raw = imu
         self.gt_raw = gt
+        self.sample_map = sample_map
+
+    def sequence_len(self):
+        """
+        :return: number of samples of the (resampled) sequence the dataset is generated from
+        """
+
+        return len(self.imu_raw) if self.sample_map is None else len(self.sample_map)
 
-    def generate_dataset(self, dataset, args):
+    def map_samples(self, data):
+        """
+        :param data: array with one row per sample of the loaded data
+        :return: the rows of the data in the order of the sample map, or the data itself if there is no map
+        """
+
+        return data if self.sample_map is None else data[self.sample_map]
+
+    def generate_dataset(self, dataset, args, stride=1):
         """
         Generates the chosen dataset
 
         :param dataset: version of dataset to generate (must be one of the accepted keys)
         :param args: extra arguments for dataset generation
+        :param stride: only every stride-th window (the windows 0, stride, 2 * stride...) is kept. The kept windows are
+        strided views and slices of the generated arrays, so they are not copied
         """
 
         assert dataset in self.accepted_datasets, "The dataset version must be among {0}".format(self.accepted_datasets)
+        assert stride >= 1, "The window stride must be a positive integer"
 
         if dataset == "imu_integration":
             self.windowed_imu_for_state_prediction(args)
@@ -70,6 +122,74 @@ class StatePredictionDataset:
         elif dataset == "imu_preintegration":
             self.windowed_imu_preintegration_dataset(args)
 
+        # The imu windows and the pre-integration targets are generated in the dataset type already (so this does not
+        # copy them), and the remaining arrays, of one row per window, are rounded at the end
+        for ds in (self.x_ds, self.y_ds):
+            for key in ds:
+                ds[key] = ds[key][::stride].astype(self.dtype, copy=False)
+
+    def generate_dataset_chunks(self, dataset, args, chunk_size, chunks_dir, stride=1):
+        """
+        Generates the chosen dataset chunk by chunk, and saves every chunk in .npy files, so that the windows of a long
+        sequence never need to be in memory at once. Every chunk is generated from its samples plus a margin of samples
+        at both sides, and only the windows that start within the chunk are kept, so the concatenation of the chunks is
+        the same dataset that `generate_dataset` generates from the whole sequence.
+
+        :param dataset: version of dataset to generate (must be one of the accepted keys)
+        :param args: extra arguments for dataset generation
+        :param chunk_size: number of windows generated at once
+        :param chunks_dir: directory where the chunks are saved
+        :param stride: only every stride-th window of the whole sequence is kept (see `generate_dataset`)
+        :return: list of (x files, y files) pairs, with the dictionaries of key -> .npy file of every chunk, in order
+        """
+
+        assert dataset in self.accepted_datasets, "The dataset version must be among {0}".format(self.accepted_datasets)
+        assert stride >= 1, "The window stride must be a positive integer"
+
+        window_len = args[0]
+        n_samples = self.sequence_len()
+
+        # The windows, initial states and pre-integrations reach at most one window length (plus the extra sample of
+        # the pre-integration dataset) past the first window of the chunk, in both directions
+        margin = 2 * window_len + 2
+
+        shutil.rmtree(chunks_dir, ignore_errors=True)
+        os.makedirs(chunks_dir)
+
+        chunks = []
+        for i, start in enumerate(range(0, n_samples, chunk_size)):
+            end = min(start + chunk_size, n_samples)
+            margin_start = max(start - margin, 0)
+            margin_end = min(end + margin, n_samples)
+
+            # The chunks of a resampled sequence are slices of its index map, over the same data. All the chunks share
+            # the process pool of the parallel pre-integration
+            chunk_generator = StatePredictionDataset(self.pre_integration_workers, self.dtype)
+            chunk_generator.pre_integration_pool = self.pre_integration_pool
+            if self.sample_map is None:
+                chunk_generator.load_data(self.imu_raw[margin_start:margin_end], self.gt_raw[margin_start:margin_end])
+            else:
+                chunk_generator.load_data(self.imu_raw, self.gt_raw, self.sample_map[margin_start:margin_end])
+            chunk_generator.generate_dataset(dataset, args)
+            x_chunk, y_chunk = chunk_generator.get_dataset()
+            self.pre_integration_pool = chunk_generator.pre_integration_pool
+
+            # The window j of the chunk is the window margin_start + j of the whole sequence. Only the windows at a
+            # multiple of the stride of the whole sequence are kept, so a chunk may keep none of its windows
+            chunk_windows = slice(start - margin_start, end - margin_start)
+            if not len(next(iter(y_chunk.values()))[chunk_windows]):
+                break
+            kept_windows = slice(chunk_windows.start + (-start % stride), chunk_windows.stop, stride)
+
+            chunk_files = ({}, {})
+            for ds_files, ds_chunk in zip(chunk_files, (x_chunk, y_chunk)):
+                for key, values in ds_chunk.items():
+                    ds_files[key] = "{0}{1}_{2:05d}.npy".format(chunks_dir, key, i)
+                    np.save(ds_files[key], values[kept_windows])
+            chunks.append(chunk_files)
+
+        return chunks
+
     def set_outputs(self, keys, outputs):
         """
         Adds the outputs to the dictionary of outputs using the provided keys
@@ -133,7 +253,7 @@ class StatePredictionDataset:
         window_len = args[0]
 
         # Initialize y data. Will be the absolute ground truth value of the speed of the drone
-        gt_v_tensor = np.expand_dims(np.linalg.norm(np.stack(self.gt_raw[:, 1]), axis=1), axis=1)
+        gt_v_tensor = np.expand_dims(self.map_samples(np.linalg.norm(self.gt_raw[:, 3:6], axis=1)), axis=1)
 
         imu_img_tensor = self.window_imu_data(window_len)[:, :, :-1, :]
 
@@ -156,9 +276,9 @@ class StatePredictionDataset:
 
         window_len = args[0]
 
-        n_samples = len(self.imu_raw) - window_len
+        n_samples = self.sequence_len() - window_len
 
-        gt = reformat_data(self.gt_raw)
+        gt = reformat_data(self.map_samples(self.gt_raw))
 
         # Keep only position, attitude, velocity information (remove angular velocity, acceleration and timestamp)
         gt = np.delete(gt, np.s_[10:17], axis=1)
@@ -212,10 +332,7 @@ class StatePredictionDataset:
 
         window_len = args[0]
 
-        # TODO: get as a parameter of the dataset
-        g_val = -9.81
-
-        n_samples = len(self.imu_raw) - window_len - 1
+        n_samples = self.sequence_len() - window_len - 1
 
         self.windowed_imu_for_state_prediction(args)
 
@@ -224,88 +341,350 @@ class StatePredictionDataset:
         self.x_ds["state_input"] = self.x_ds["state_input"][1:]
         self.y_ds["state_output"] = self.y_ds["state_output"][:-1]
 
-        gt_augmented = self.x_ds["state_input"]
-        gt_augmented = np.concatenate((gt_augmented, self.y_ds["state_output"][-window_len:, :]), axis=0)
+        table = self.pre_integration_table
+        if table is None:
+            table = self.build_pre_integration_table(window_len)
+        table_len = table["pre_integrated_R"].shape[1]
+        assert table_len >= window_len, "The pre-integration table must be built for windows of {0} samples at least" \
+            .format(window_len)
+        assert len(table["pre_integrated_R"]) == self.sequence_len() + table_len - 3, \
+            "The pre-integration table was not built from the loaded data"
+
+        # The window i starts at the sample i - window_len + 2 (the imu window ending at the sample i + 1), which is
+        # the row i + table_len - window_len of the table
+        first = table_len - window_len
+        keys = ["pre_integrated_R", "pre_integrated_v", "pre_integrated_p"]
+        self.set_outputs(keys, [table[key][first:first + n_samples, :window_len] for key in keys])
+
+    def build_pre_integration_table(self, window_len):
+        """
+        Pre-integrates the windows of every start sample, from window_len - 2 samples before the first sample of the
+        sequence (like the first windows of the datasets, with zero-padded imu samples and the first state) to its
+        second-last sample. The windows that reach past the end of the sequence are padded with the last state and zero
+        dt, and those steps are never part of a dataset.
+
+        The pre-integrated rotation, velocity and position at the step t of a window only depend on its start sample
+        and on t, so the targets of the pre-integration dataset of any window length up to window_len are a zero-copy
+        slice of the table: the rows of their start samples, and their first steps
+
+        :param window_len: maximum window length
+        :return: dictionary with the pre-integrated rotation, velocity and position of every window start, each one with
+        shape <sequence length + window_len - 3, window_len, 3>
+        """
 
-        imu_window = self.x_ds["imu_input"]
+        # TODO: get as a parameter of the dataset
+        g_val = -9.81
 
-        # Define the pre-integrated rotation, velocity and position vectors
-        pre_int_rot = np.zeros((n_samples, window_len, 3))
-        pre_int_v = np.zeros((n_samples, window_len, 3))
-        pre_int_p = np.zeros((n_samples, window_len, 3))
+        n_samples = self.sequence_len()
+        n_starts = n_samples + window_len - 3
+
+        # States (without angular velocity, acceleration and timestamp) and imu dt (in ms) of all the samples covered
+        # by the windows, from the first step of the first window to the last step of the last one
+        covered = np.arange(2 - window_len, n_starts + 1)
+        rows = np.clip(covered, 0, n_samples - 1)
+        states = reformat_data(self.map_samples(self.gt_raw))[rows, :10]
+        dt_series = np.where((covered >= 0) & (covered < n_samples),
+                             reformat_data(self.map_samples(self.imu_raw[:, -1:]))[rows, 0], 0)
+
+        # The windows are pre-integrated in blocks, so that the temporary arrays stay within a bounded memory size, and
+        # in parallel mode there are a few blocks per process at least, so that the work is balanced among them
+        block_size = PRE_INTEGRATION_BLOCK_ELEMENTS // window_len
+        if self.pre_integration_workers > 1:
+            block_size = min(block_size, -(-n_starts // (4 * self.pre_integration_workers)))
+        block_size = max(block_size, 1)
+        blocks = [slice(start, min(start + block_size, n_starts)) for start in range(0, n_starts, block_size)]
 
         print("Generating pre-integration dataset. This may take a while...")
-        prog_bar = Progbar(n_samples)
+        prog_bar = Progbar(n_starts)
 
-        for i in range(n_samples):
-            pi = np.tile(gt_augmented[i, 0:3], [window_len, 1])
-            vi = np.tile(gt_augmented[i, 3:6], [window_len, 1])
-            qi = np.tile(gt_augmented[i, 6:], [window_len, 1])
+        pre_integrated = None
+        if self.pre_integration_workers > 1 and len(blocks) > 1:
+            pre_integrated = self.pre_integrate_parallel(states, dt_series, blocks, window_len, g_val, prog_bar)
 
-            # imu_window[i, :, -1, 0] is a <1, window_len> vector containing all the dt between two consecutive samples
-            # of the imu. We compute the cumulative sum to get the total time for every sample in the window since the
-            # beginning of the window itself. We divide by 1000 to transform from ms to s
-            cum_dt_vec = np.cumsum(imu_window[i, :, -1, 0]) / 1000
+        if pre_integrated is not None:
+            pre_int_rot, pre_int_v, pre_int_p = pre_integrated
+        else:
+            # Define the pre-integrated rotation, velocity and position vectors
+            pre_int_rot = np.zeros((n_starts, window_len, 3), dtype=self.dtype)
+            pre_int_v = np.zeros((n_starts, window_len, 3), dtype=self.dtype)
+            pre_int_p = np.zeros((n_starts, window_len, 3), dtype=self.dtype)
 
-            # We calculate the quaternion that rotates q(i) to q(i+t) for all t in [0, window_len], and map it to so(3)
-            pre_int_q = np.array([q.elements for q in quaternion_error(qi, gt_augmented[i:i + window_len, 6:])])
-            pre_int_rot[i, :, :] = log_mapping(correct_quaternion_flip(pre_int_q))
+            for block in blocks:
+                pre_integrate_range(states, dt_series, pre_int_rot, pre_int_v, pre_int_p, block, window_len, g_val)
+                prog_bar.update(block.stop)
 
-            g_contrib = np.expand_dims(cum_dt_vec * g_val, axis=1)*np.array([0, 0, 1])
-            pre_int_v[i, :, :] = rotate_vec(gt_augmented[i:i+window_len, 3:6] - vi - g_contrib, q_inv(qi))
+        return {"pre_integrated_R": pre_int_rot, "pre_integrated_v": pre_int_v, "pre_integrated_p": pre_int_p}
 
-            v_contrib = np.multiply(np.expand_dims(cum_dt_vec, axis=1), vi)
-            g_contrib = 1/2 * np.expand_dims(cum_dt_vec ** 2 * g_val, axis=1)*np.array([0, 0, 1])
-            pre_int_p[i, :, :] = rotate_vec(gt_augmented[i:i+window_len, 0:3] - pi - v_contrib - g_contrib, q_inv(qi))
+    def pre_integrate_parallel(self, states, dt_series, blocks, window_len, g_val, prog_bar):
+        """
+        Computes the pre-integration targets in a pool of processes. The ground truth, the imu dt and the targets are
+        placed in shared memory, and every task pre-integrates a block of windows in place, so no large array is ever
+        pickled. The pool is kept for the next calls (e.g. for the next chunks of the sequence)
+
+        :param states: states of the samples covered by the windows (the window i starts at the state i)
+        :param dt_series: dt (in ms) between the imu samples covered by the windows
+        :param blocks: slices of windows pre-integrated by every task
+        :param window_len: number of imu samples of every window
+        :param g_val: gravity acceleration, along the z axis
+        :param prog_bar: progress bar, updated as the blocks are finished
+        :return: the pre-integrated rotation, velocity and position, each one with shape <n_samples, window_len, 3>, or
+        None if shared memory is not available (python < 3.8), in which case the targets must be computed serially
+        """
 
-            prog_bar.update(i+1)
+        try:
+            from data.utils.shared_arrays import SharedArray
+        except ImportError:
+            print("Shared memory requires python >= 3.8, the pre-integration targets are computed in a single process")
+            return None
+
+        if self.pre_integration_pool is None:
+            # Spawn the workers instead of forking the (possibly multi-threaded) tensorflow process
+            self.pre_integration_pool = ProcessPoolExecutor(
+                max_workers=self.pre_integration_workers, mp_context=multiprocessing.get_context("spawn"))
+
+        n_samples = blocks[-1].stop
+        shared_inputs = [SharedArray.from_array(states), SharedArray.from_array(dt_series)]
+        shared_outputs = [SharedArray((n_samples, window_len, 3), self.dtype) for _ in range(3)]
+
+        try:
+            specs = [shared.spec for shared in shared_inputs + shared_outputs]
+            futures = {self.pre_integration_pool.submit(pre_integrate_shared_range, specs, block.start, block.stop,
+                                                        window_len, g_val): block for block in blocks}
+
+            done = 0
+            for future in as_completed(futures):
+                future.result()
+                done += futures[future].stop - futures[future].start
+                prog_bar.update(done)
+
+            return tuple(np.array(shared.array) for shared in shared_outputs)
+        finally:
+            for shared in shared_inputs + shared_outputs:
+                shared.close()
+
+    def close(self):
+        """
+        Shuts down the process pool of the parallel pre-integration, if it was started
+        """
 
-        self.set_outputs(
-            ["pre_integrated_R", "pre_integrated_v", "pre_integrated_p"], [pre_int_rot, pre_int_v, pre_int_p])
+        if self.pre_integration_pool is not None:
+            self.pre_integration_pool.shutdown()
+            self.pre_integration_pool = None
+
+    def pad_imu_data(self, window_len):
+        """
+        :param window_len: number of imu samples of every window
+        :return: a copy of the (reformatted, see `reformat_data`) imu data, preceded by window_len - 1 rows of zeros,
+        which pad the first windows on the left (not enough acquisitions to fill them up yet). Shape:
+        <window_len - 1 + n_samples, imu channels>
+        """
+
+        n_samples = self.sequence_len()
+        window_channels = np.shape(self.imu_raw)[1]
+
+        padded_imu = np.zeros((window_len - 1 + n_samples, window_channels), dtype=self.dtype)
+        reformat_data(self.map_samples(self.imu_raw), out=padded_imu[window_len - 1:])
+
+        return padded_imu
 
     def window_imu_data(self, window_len):
         """
-        # TODO: complete
+        Windows the imu data: the window i holds the (reformatted, see `reformat_data`) imu samples i - window_len + 1
+        to i. The windows are a read-only strided view over a single zero-padded copy of the imu data (see
+        `pad_imu_data`). So they take O(n) memory, instead of window_len copies of every sample
+
+        :param window_len: number of imu samples of every window
+        :return: the windows, with shape <n_samples, window_len, imu channels, 1>
         """
 
-        raw_imu = reformat_data(self.imu_raw)
+        self.padded_imu = self.pad_imu_data(window_len)
+        return imu_window_view(self.padded_imu, window_len)
 
-        window_channels = np.shape(raw_imu)[1]
 
-        # Initialize x data. Will be sequence of IMU measurements of size (imu_len x window_channels)
-        imu_img_tensor = np.zeros((len(raw_imu), window_len, window_channels, 1))
+def window_view(series, window_len):
+    """
+    :param series: array with the samples in the first dimension
+    :param window_len: number of samples of every window
+    :return: read-only strided view of the windows of consecutive samples of the series (the window i holds the samples
+    i to i + window_len - 1), with shape <n_samples - window_len + 1, window_len, ...>
+    """
 
-        for i in range(len(raw_imu) - window_len):
-            imu_img = np.zeros((window_len, window_channels))
+    series = np.asarray(series)
+    assert len(series) >= window_len, "The series must have {0} samples at least".format(window_len)
 
-            # The first imu_x_len data vectors will not be full of data (not enough acquisitions to fill it up yet)
-            if i < window_len:
-                imu_img[window_len - i - 1:window_len, :] = raw_imu[0:i + 1, :]
-            else:
-                imu_img = raw_imu[i - window_len + 1:i + 1, :]
+    shape = (len(series) - window_len + 1, window_len) + series.shape[1:]
+    return np.lib.stride_tricks.as_strided(series, shape, series.strides[:1] + series.strides, writeable=False)
+
+
+def imu_window_view(padded_imu, window_len, first=0, n_windows=None, n_channels=None):
+    """
+    :param padded_imu: padded imu buffer (see `StatePredictionDataset.pad_imu_data`)
+    :param window_len: number of imu samples of every window
+    :param first: first window of the view
+    :param n_windows: number of windows of the view. All the windows from the first one if not given
+    :param n_channels: number of imu channels of the view. All the channels if not given
+    :return: read-only strided view of the windows of the buffer, with shape <n_windows, window_len, n_channels, 1>
+    """
+
+    windows = window_view(padded_imu, window_len)
+    stop = None if n_windows is None else first + n_windows
+
+    return windows[first:stop, :, :n_channels, np.newaxis]
+
+
+def imu_window_spec(windows, padded_imu):
+    """
+    Describes a view of the windows of a padded imu buffer (e.g. the imu input of a dataset, sliced from the result of
+    `window_imu_data`), so that it can be rebuilt from the buffer with `imu_window_view`, instead of storing the windows
+
+    :param windows: windows of the buffer, as returned by `imu_window_view`
+    :param padded_imu: padded imu buffer the windows are a view of
+    :return: json-serializable [first window, number of windows, number of channels] of the view
+    """
+
+    offset = windows.__array_interface__["data"][0] - padded_imu.__array_interface__["data"][0]
+    return [offset // padded_imu.strides[0], len(windows), windows.shape[2]]
+
+
+def imu_window_rows(windows, padded_imu):
+    """
+    :param windows: windows of a padded imu buffer, as returned by `imu_window_view` (possibly strided)
+    :param padded_imu: padded imu buffer the windows are a view of
+    :return: the row of the buffer where every window starts
+    """
+
+    row_bytes = padded_imu.strides[0]
+    first = (windows.__array_interface__["data"][0] - padded_imu.__array_interface__["data"][0]) // row_bytes
+    return first + np.arange(len(windows), dtype=np.int64) * (windows.strides[0] // row_bytes)
+
+
+def gather_imu_windows(imu_buffer, rows, window_len):
+    """
+    :param imu_buffer: padded imu buffer (see `StatePredictionDataset.pad_imu_data`)
+    :param rows: row of the buffer where every window starts (see `imu_window_rows`)
+    :param window_len: number of imu samples of every window
+    :return: a copy of the windows, with shape <number of rows, window_len, imu channels, 1>
+    """
+
+    return window_view(imu_buffer, window_len)[np.asarray(rows)][:, :, :, np.newaxis]
+
+
+def pre_integrate_range(states, dt_series, pre_int_rot, pre_int_v, pre_int_p, windows, window_len, g_val):
+    """
+    Pre-integrates a range of windows, and writes the results in the target arrays
+
+    :param states: states of the samples covered by the windows (the window i starts at the state i)
+    :param dt_series: dt (in ms) between the imu samples covered by the windows
+    :param pre_int_rot: pre-integrated rotation of all the windows
+    :param pre_int_v: pre-integrated velocity of all the windows
+    :param pre_int_p: pre-integrated position of all the windows
+    :param windows: slice of the windows to pre-integrate
+    :param window_len: number of imu samples of every window
+    :param g_val: gravity acceleration, along the z axis
+    """
+
+    # The samples covered by the windows of the range
+    samples = slice(windows.start, windows.stop + window_len - 1)
+
+    pre_int_rot[windows], pre_int_v[windows], pre_int_p[windows] = pre_integrate_windows(
+        states[samples], dt_series[samples], window_len, g_val)
+
+
+def pre_integrate_shared_range(specs, start, stop, window_len, g_val):
+    """
+    Process pool task of the parallel pre-integration (see `StatePredictionDataset.pre_integrate_parallel`): attaches
+    to the shared ground truth, dt and target arrays, and pre-integrates the windows from start to stop in place
+
+    :param specs: specs of the shared states, dt, rotation, velocity and position arrays
+    :param start: first window to pre-integrate
+    :param stop: last window to pre-integrate + 1
+    :param window_len: number of imu samples of every window
+    :param g_val: gravity acceleration, along the z axis
+    """
+
+    from data.utils.shared_arrays import SharedArray
+
+    shared = [SharedArray.attach(spec) for spec in specs]
+    try:
+        pre_integrate_range(*[array.array for array in shared], slice(start, stop), window_len, g_val)
+    finally:
+        for array in shared:
+            array.close()
+
+
+def pre_integrate_windows(states, dt, window_len, g_val):
+    """
+    Pre-integrates a batch of consecutive windows: computes, for every step of every window, the rotation, velocity
+    and position increments from the initial state of the window, in the body frame of the initial state (i.e. with
+    the gravity removed and rotated by the inverse of the initial attitude).
+
+    The increments are differences between the states of the ground truth, so the window i + 1 shares all the terms of
+    the window i but its oldest sample. Those terms (the unit attitudes and the rotation matrices of the initial
+    attitudes) are computed once per sample, and every window takes them as a strided view, so that only the increments
+    themselves are computed per step of every window
+
+    :param states: 10-dimensional states of the samples covered by the windows, with shape
+    <n_windows + window_len - 1, 10>. The window i spans the states i to i + window_len - 1
+    :param dt: time differences (in ms) between the consecutive imu samples of the windows, with shape
+    <n_windows + window_len - 1>
+    :param window_len: number of imu samples of every window
+    :param g_val: gravity acceleration, along the z axis
+    :return: the pre-integrated rotation (in so(3)), velocity and position, each one with shape
+    <n_windows, window_len, 3>
+    """
+
+    n_windows = len(states) - window_len + 1
+
+    def windowed(series):
+        # Strided view with the values of the series at every step of every window: <n_windows, window_len, ...>
+        return window_view(series, window_len)
+
+    q = quaternion_normalize(states[:, 6:])
+    p_i, v_i, q_i = states[:n_windows, np.newaxis, 0:3], states[:n_windows, np.newaxis, 3:6], q[:n_windows, np.newaxis]
+
+    # Cumulative sum of the dt, to get the total time for every sample in the window since the beginning of the window
+    # itself. We divide by 1000 to transform from ms to s. It is summed within every window (instead of subtracting a
+    # running sum of the whole sequence), so that the result does not depend on where the sequence, a chunk or a block
+    # of windows begin
+    cum_dt = np.cumsum(windowed(dt), axis=1)[:, :, np.newaxis] / 1000
+    g_vec = np.array([0, 0, g_val])
+
+    # We calculate the quaternion that rotates q(i) to q(i+t) for all t in [0, window_len], with positive real part,
+    # and map it to so(3)
+    pre_int_q = quaternion_product(windowed(q), quaternion_conjugate(q_i))
+    pre_int_q *= np.where(pre_int_q[:, :, :1] < 0, -1.0, 1.0)
+    pre_int_rot = quaternion_log(pre_int_q)
 
-            imu_img_tensor[i, :, :, :] = np.expand_dims(imu_img, 2)
+    # Rotating the row vectors of a window by the inverse of q(i) is multiplying them by the rotation matrix of q(i)
+    r_i = quaternion_to_rotation_matrix(q[:n_windows])
+    pre_int_v = np.matmul(windowed(states[:, 3:6]) - v_i - cum_dt * g_vec, r_i)
+    pre_int_p = np.matmul(windowed(states[:, 0:3]) - p_i - cum_dt * v_i - 1/2 * cum_dt ** 2 * g_vec, r_i)
 
-        return imu_img_tensor
+    return pre_int_rot, pre_int_v, pre_int_p
 
 
-def reformat_data(compact_data):
+def reformat_data(compact_data, out=None):
     """
-    Expands the data (converts from IMU/GT object to a flat-dimensional vector. Additionally, computes the timestamp
-    differences
+    Computes the timestamp differences of the flattened IMU/GT data, and stores them in place of the timestamps
 
-    :param compact_data: data from IMU/GT, with the timestamps at the last component
+    :param compact_data: flattened data from IMU/GT, with the timestamps (in ns) at the last column
+    :param out: array where the result is written (e.g. `compact_data` itself, or a float32 array). Allocated (in
+    float64) if not given
+    :return: the reformatted data
     """
 
-    data_channels = np.shape(compact_data)[1] - 1
+    # Calculate difference between timestamps, and change units from ns to ms. They are computed from the original
+    # timestamps, as a lower precision `out` array can not represent them
+    dt = np.diff(np.asarray(compact_data[:, -1], dtype=np.float64)) / 1e6
 
-    # Reshape to 2D array
-    flattened_data = np.concatenate([np.stack(compact_data[:, i], axis=0) for i in range(data_channels)], axis=1)
-    flattened_data = np.append(flattened_data, np.expand_dims(compact_data[:, data_channels], axis=1), axis=1)
+    if out is None:
+        flattened_data = np.array(compact_data, dtype=np.float64)
+    else:
+        flattened_data = out
+        if out is not compact_data:
+            flattened_data[...] = compact_data
 
-    # TODO: get timestamp format (s/ms/us). blackbird is in us
-    # Calculate difference between timestamps, and change units to ms
-    flattened_data[1:, -1] = np.diff(flattened_data[:, -1]) / 1000
+    flattened_data[1:, -1] = dt
     flattened_data[0, -1] = 0
 
     return flattened_data
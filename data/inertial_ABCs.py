@@ -1,74 +1,229 @@
+import os
 import numpy as np
 import matplotlib.pyplot as plt
 
-from pyquaternion import Quaternion
 from abc import ABC, abstractmethod
-from sklearn.preprocessing import MinMaxScaler
-from sklearn.externals import joblib
-from scipy.signal import butter as butterworth_filter
 
-from data.utils.data_utils import filter_with_coeffs, interpolate_ts
+from data.utils.data_utils import butterworth_sos, filter_with_sos, interpolate_ts, interpolation_brackets, \
+    increasing_samples, uniform_grid
+from data.utils.diagnostics import DIAGNOSTICS_DIR, diagnostics_renderer, filter_stft, render_filter_stft
+from data.utils.raw_sequence_cache import RawSequenceCache
+from data.utils.resampling import oversampling_index_map
+from data.utils.streaming_scaler import StreamingScaler
 
 
-class IMU:
-    def __init__(self):
-        # Timestamp in ns!!
-        self.timestamp = 0.0
-        self.gyro = np.array([0.0, 0.0, 0.0])
-        self.acc = np.array([0.0, 0.0, 0.0])
+# Field layout of the IMU and ground truth series. The flattened (numpy) format of the processed data is the buffer of
+# the series, with the fields in this order and the timestamp as last column
+IMU_FIELDS = ("gyro", "acc", "timestamp")
+GT_FIELDS = ("pos", "vel", "att", "ang_vel", "acc", "timestamp")
+FIELD_WIDTHS = {"gyro": 3, "acc": 3, "pos": 3, "vel": 3, "att": 4, "ang_vel": 3, "timestamp": 1}
 
-    @abstractmethod
-    def read(self, data):
-        ...
+# Order of the low-pass Butterworth filter of the imu data
+IMU_FILTER_ORDER = 10
 
-    def unroll(self):
-        return self.gyro, self.acc, self.timestamp
+# Columns of the imu buffer that are low-pass filtered: all the channels, except for the timestamp
+IMU_FILTER_CHANNELS = slice(0, FIELD_WIDTHS["gyro"] + FIELD_WIDTHS["acc"])
 
+# Timestamps are integer nanoseconds. They are stored relative to the first sample of the sequence, so that they are
+# exact in the float64 buffers of the series (for recordings of up to 2^53 ns, about 104 days)
+NS_PER_S = 10 ** 9
 
-class GT:
-    def __init__(self):
-        # Timestamp expected in ns!!
+# Intervals between imu samples longer than this number of sampling periods are reported as gaps (dropped samples)
+IMU_GAP_TOLERANCE = 1.5
 
-        self.timestamp = 0.0
-        self.pos = np.array([0.0, 0.0, 0.0])
-        self.att = np.array([0.0, 0.0, 0.0, 0.0])
-        self.vel = np.array([0.0, 0.0, 0.0])
-        self.ang_vel = np.array([0.0, 0.0, 0.0])
-        self.acc = np.array([0.0, 0.0, 0.0])
+# Directory (within the dataset directory) of the memory-mapped intermediate files of the chunked preprocessing
+CHUNKED_PROCESSING_DIR = "chunked_processing/"
 
-    @abstractmethod
-    def read(self, data):
-        ...
 
-    def read_from_tuple(self, data):
-        self.pos = data[0]
-        self.vel = data[1]
-        self.att = data[2]
-        self.ang_vel = data[3]
-        self.acc = data[4]
-        self.timestamp = data[5]
-        return self
+class _SeriesField:
+    def __init__(self, name):
+        """
+        Attribute of an InertialSeries that gives a view of one of its fields
+
+        :param name: name of the field
+        """
+        self.name = name
+
+    def __get__(self, series, owner):
+        if series is None:
+            return self
+        return series.field(self.name)
+
+    def __set__(self, series, value):
+        series.field(self.name)[...] = value
+
+
+class InertialSeries:
+    fields = ()
+
+    def __init__(self, buffer):
+        """
+        Time series of inertial samples, backed by a single contiguous float64 buffer of shape <n, total field width>,
+        with the fields laid out one after the other (see `fields`). The fields are accessed as zero-copy views, e.g.
+        `series.acc` is a <n, 3> view of the buffer, and assigning to them writes into the buffer.
+
+        :param buffer: 2D float64 array, used without copying (e.g. a memory-mapped file)
+        """
+
+        assert np.ndim(buffer) == 2 and np.shape(buffer)[1] == self.width(), \
+            "The buffer of a {0} must have shape <n, {1}>".format(type(self).__name__, self.width())
+
+        self.buffer = buffer
+
+    @classmethod
+    def width(cls):
+        return sum(FIELD_WIDTHS[field] for field in cls.fields)
+
+    @classmethod
+    def field_slice(cls, name):
+        """
+        :param name: name of the field
+        :return: the columns of the field in the buffer (an integer for scalar fields)
+        """
+
+        start = 0
+        for field in cls.fields:
+            if field == name:
+                return start if FIELD_WIDTHS[field] == 1 else slice(start, start + FIELD_WIDTHS[field])
+            start += FIELD_WIDTHS[field]
+        raise KeyError("{0} has no field {1}".format(cls.__name__, name))
+
+    @classmethod
+    def empty(cls, n_samples):
+        return cls(np.zeros((n_samples, cls.width())))
+
+    @classmethod
+    def from_columns(cls, columns):
+        """
+        Builds a series from columnar data
+
+        :param columns: dictionary of field name -> array with the samples in the first dimension. Missing fields are
+        filled with zeros
+        :return: the series
+        """
+
+        series = cls.empty(len(columns["timestamp"]))
+        for field in cls.fields:
+            if field in columns:
+                series.field(field)[...] = columns[field]
+        return series
 
-    def unroll(self):
-        return self.pos, self.vel, self.att, self.ang_vel, self.acc, self.timestamp
+    def field(self, name):
+        return self.buffer[:, self.field_slice(name)]
 
-    def integrate(self, gt_old, int_pos=True, int_att=True):
+    def columns(self):
+        """
+        :return: dictionary of field name -> view of the field
         """
-        Integrates position and attitude. Saves integrated values to current GT object
 
-        :param gt_old: GT from previous timestamp
-        :param int_pos: whether position should be integrated, or velocity is already available instead
-        :param int_att: whether attitude should be integrated, or angular velocity is already available instead
+        return {field: self.field(field) for field in self.fields}
+
+    def copy(self):
+        return type(self)(np.array(self.buffer))
+
+    def writable(self):
+        """
+        :return: the series itself, or a copy of it if its buffer is read-only
         """
 
-        # TODO: implement angular velocity integration
+        return self if self.buffer.flags.writeable else self.copy()
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def __getitem__(self, index):
+        """
+        Selects samples of the series. Slices return views, while masks and index arrays return copies
+
+        :param index: slice, boolean mask or index array along the samples
+        :return: the selected series
+        """
+
+        return type(self)(self.buffer[index])
+
+
+class ImuSeries(InertialSeries):
+    fields = IMU_FIELDS
+
+    gyro = _SeriesField("gyro")
+    acc = _SeriesField("acc")
+    timestamp = _SeriesField("timestamp")
+
+
+class GtSeries(InertialSeries):
+    fields = GT_FIELDS
+
+    pos = _SeriesField("pos")
+    vel = _SeriesField("vel")
+    att = _SeriesField("att")
+    ang_vel = _SeriesField("ang_vel")
+    acc = _SeriesField("acc")
+    timestamp = _SeriesField("timestamp")
 
-        dt = (self.timestamp - gt_old.timestamp) * 10e-6
-        if int_pos:
-            self.vel = (self.pos - gt_old.pos) / dt
-        if int_att:
-            att_q = Quaternion(self.att[0], self.att[1], self.att[2], self.att[3])
-            self.ang_vel = self.ang_vel
+
+def interpolate_gt_series(gt, timestamps):
+    """
+    Interpolates a ground truth series at different times. The interpolation brackets are shared by all the channels:
+    all the buffer is interpolated linearly at once, and then the attitude is replaced by its SLERP
+
+    :param gt: ground truth series
+    :param timestamps: target times (must be inside the time span of `gt`)
+    :return: the interpolated ground truth series
+    """
+
+    brackets = interpolation_brackets(gt.timestamp, timestamps)
+    gt_interp = GtSeries(interpolate_ts(gt.timestamp, timestamps, gt.buffer, brackets=brackets))
+    gt_interp.att = interpolate_ts(gt.timestamp, timestamps, gt.att, is_quaternion=True, brackets=brackets)
+    gt_interp.timestamp = timestamps
+
+    return gt_interp
+
+
+def split_time_origin(imu_data, gt_data):
+    """
+    Makes the timestamps of the imu and ground truth data relative to the earliest of them (see `NS_PER_S`)
+
+    :param imu_data: imu data (series or columnar format), with the timestamps in integer nanoseconds
+    :param gt_data: ground truth data (series or columnar format), with the timestamps in integer nanoseconds
+    :return: the imu and ground truth series, and the time origin (absolute time of the earliest sample, in ns)
+    """
+
+    def timestamps(data, series_class):
+        if not isinstance(data, dict):
+            return as_series(data, series_class).timestamp
+        # Integer timestamps are used as they are, as they may not be exact once converted to float64
+        ts = np.asarray(data["timestamp"])
+        return ts if np.issubdtype(ts.dtype, np.integer) else np.rint(ts).astype(np.int64)
+
+    origin = int(min(np.min(timestamps(imu_data, ImuSeries)), np.min(timestamps(gt_data, GtSeries))))
+
+    series = []
+    for data, series_class in ((imu_data, ImuSeries), (gt_data, GtSeries)):
+        if isinstance(data, dict):
+            # The columnar timestamps are shifted before they are converted to float64, so that they stay exact
+            data = as_series(dict(data, timestamp=timestamps(data, series_class) - origin), series_class)
+        else:
+            data = as_series(data, series_class).writable()
+            data.timestamp -= origin
+        series.append(data)
+
+    return series[0], series[1], origin
+
+
+def as_series(data, series_class):
+    """
+    Returns the data as a series
+
+    :param data: series, columnar data dictionary or flat 2D array (the buffer of a series)
+    :param series_class: InertialSeries subclass of the data
+    :return: the series (without copying the data, unless it is in columnar format)
+    """
+
+    if isinstance(data, series_class):
+        return data
+    if isinstance(data, dict):
+        return series_class.from_columns(data)
+    return series_class(data)
 
 
 class InertialDataset(ABC):
@@ -81,19 +236,151 @@ class InertialDataset(ABC):
         self.ds_local_dir = None
 
         self.plot_stft = False
+
+        # Whether to low-pass filter the imu data forward and backward (no phase delay), instead of causally
+        self.zero_phase_filter = False
+
+        # Regions of the processed sequence that are oversampled in the dataset (see `oversampling_index_map`), and the
+        # index map over the processed samples that describes them. The processed data itself is never expanded: the
+        # windows of the dataset are gathered through the map. None if the sequence is not resampled
+        self.oversampled_regions = []
+        self.sample_map = None
+
+        # Absolute time (in ns) of the first sample of the sequence, which the timestamps of the series are relative to
+        self.time_origin = None
+
+        # Whether to resample the imu data onto an exact uniform time grid at the sampling frequency (see
+        # `regularize_timing`)
+        self.uniform_imu_rate = False
+
+        # Report of the timing stage: sampling period, dropped samples and gaps (see `regularize_timing`)
+        self.timing = None
+
+        # If set, number of samples processed at once by the out-of-core preprocessing, which keeps the interpolated
+        # and filtered sequences in memory-mapped files instead of in memory (see `CHUNKED_PROCESSING_DIR`)
+        self.chunk_size = None
+
+        # Cache of parsed raw sequences and of the outputs of their preprocessing stages, shared by all the datasets
+        self.raw_cache = RawSequenceCache()
+
+        # Cache key of the current data: the key of the raw sequence, chained with the parameters of every stage that
+        # has processed it since (see `run_stage`). None if the data does not come from the cache
+        self.stage_key = None
+
+        # Key of the last cache entry the current data derives from (skipping the stages that are not cached). The
+        # cached stages are linked to it, so that they are invalidated along with it
+        self.entry_key = None
         ...
 
     @abstractmethod
     def get_raw_ds(self):
         ...
     
+    def read_raw_data(self, source_files, read_func, params=None):
+        """
+        Reads the raw imu and ground truth data through the raw sequence cache. If the source files have not changed
+        since the sequence was cached, the parsed series are memory-mapped from the cache instead of parsed again.
+
+        :param source_files: list of files from which the raw data is parsed
+        :param read_func: function that parses the source files into `self.imu_data` and `self.gt_data`
+        :param params: json-serializable parameters of `read_func` that the parsed data depends on
+        """
+
+        cached = self.raw_cache.load(source_files, params)
+        if cached is not None:
+            self.imu_data, self.gt_data = ImuSeries(cached["imu"]), GtSeries(cached["gt"])
+            self.time_origin = int(cached["time_origin"][0])
+            self.stage_key = self.entry_key = self.raw_cache.key(source_files, params=params)
+            return
+
+        read_func()
+        self.stage_key = self.entry_key = None
+
+        if self.imu_data is not None and self.gt_data is not None:
+            self.imu_data, self.gt_data, self.time_origin = self.store_raw_data(
+                source_files, self.imu_data, self.gt_data, params)
+            self.stage_key = self.entry_key = self.raw_cache.key(source_files, params=params)
+
+    def store_raw_data(self, source_files, imu_data, gt_data, params=None):
+        """
+        Stores a parsed sequence in the raw sequence cache
+
+        :param source_files: list of files from which the raw data was parsed
+        :param imu_data: raw imu data (series or columnar format), with the timestamps in integer nanoseconds
+        :param gt_data: raw ground truth data (series or columnar format), with the timestamps in integer nanoseconds
+        :param params: json-serializable parameters that the parsed data depends on
+        :return: the imu and ground truth series, with the timestamps relative to the time origin, and the time origin
+        (see `split_time_origin`)
+        """
+
+        imu, gt, time_origin = split_time_origin(imu_data, gt_data)
+        self.raw_cache.store(source_files, {"imu": imu.buffer, "gt": gt.buffer,
+                                            "time_origin": np.array([time_origin], dtype=np.int64)}, params)
+
+        return imu, gt, time_origin
+
+    def run_stage(self, stage, params, stage_func, cached=True):
+        """
+        Runs a preprocessing stage of the imu and ground truth data through the stage cache. The output of the stage is
+        keyed by the parameters of the stage and the key of its input data, so the stage only runs again when any of
+        them changes, i.e. when it or any of its upstream stages (down to the raw sequence) is configured differently.
+
+        :param stage: name of the stage
+        :param params: json-serializable parameters of the stage
+        :param stage_func: function that processes `self.imu_data` and `self.gt_data` (replacing them), and returns a
+        json-serializable dictionary with any other result of the stage, or None
+        :param cached: whether to look up and store the output of the stage in the cache. If False, the stage always
+        runs, but the key of its output is still computed, so the downstream stages can be cached
+        :return: the other results of the stage
+        """
+
+        if self.stage_key is None:
+            return stage_func()
+
+        self.stage_key = self.raw_cache.stage_key(self.stage_key, stage, params)
+        if not cached:
+            return stage_func()
+
+        entry = self.raw_cache.load_entry(self.stage_key)
+        if entry is not None:
+            arrays, results = entry
+            self.imu_data, self.gt_data = ImuSeries(arrays["imu"]), GtSeries(arrays["gt"])
+        else:
+            results = stage_func()
+            self.raw_cache.store_entry(self.stage_key, {"imu": as_series(self.imu_data, ImuSeries).buffer,
+                                                        "gt": as_series(self.gt_data, GtSeries).buffer},
+                                       results, self.entry_key)
+
+        self.entry_key = self.stage_key
+        return results
+
     def get_ds_directory(self):
         assert self.ds_local_dir is not None, "Directory has not yet been set"
         return self.ds_local_dir
 
+    def get_chunk_directory(self):
+        return self.get_ds_directory() + CHUNKED_PROCESSING_DIR
+
+    def open_chunked_series(self, name, series_class, n_samples):
+        """
+        Creates an empty series backed by a memory-mapped file of the chunked preprocessing
+
+        :param name: name of the file (without extension)
+        :param series_class: InertialSeries subclass of the series
+        :param n_samples: length of the series
+        :return: the series
+        """
+
+        os.makedirs(self.get_chunk_directory(), exist_ok=True)
+        buffer = np.lib.format.open_memmap(self.get_chunk_directory() + name + ".npy", mode='w+', dtype=np.float64,
+                                           shape=(n_samples, series_class.width()))
+        return series_class(buffer)
+
     def basic_preprocessing(self, gyro_scale_file, acc_scale_file, filter_freq):
         """
-        Pre-process dataset (apply low-pass filter and minmax scaling)
+        Pre-process dataset (apply low-pass filter and minmax scaling). The filtered data and the statistics of the
+        scalers are cached as a preprocessing stage (see `run_stage`). Also builds the index map of the oversampled
+        regions of the sequence (see `sample_map`)
 
         :param gyro_scale_file: file to save pre-processing functions for gyroscope
         :param acc_scale_file: file to save pre-processing functions for accelerometer
@@ -104,170 +391,334 @@ class InertialDataset(ABC):
         assert self.imu_data is not None and self.gt_data is not None and self.sampling_freq is not None, \
             "Data cannot be processed because there is no data yet."
 
-        # Transform the data to numpy matrices
-        imu_unroll = np.array([(imu_s.unroll()) for imu_s in self.imu_data])
-        gt_unroll = np.array([(gt_meas.unroll()) for gt_meas in self.gt_data])
+        params = {"sampling_freq": self.sampling_freq, "filter_freq": filter_freq, "filter_order": IMU_FILTER_ORDER,
+                  "zero_phase": self.zero_phase_filter}
+
+        # The STFT diagnostics are cached along with the filtered data, keyed by the same input data and parameters. The
+        # unfiltered channels are only kept (copied, as they are filtered in place) when the STFT must be computed. They
+        # are not available in the out-of-core mode, which does not keep the whole sequence in memory
+        stft, raw_channels = None, None
+        stft_key = None if self.stage_key is None else self.raw_cache.stage_key(self.stage_key, "filter_stft", params)
+        stft_upstream_key = self.entry_key
+        if self.plot_stft and not self.chunk_size:
+            stft = None if stft_key is None else self.raw_cache.load_entry(stft_key)
+            if stft is None:
+                raw_channels = np.array(as_series(self.imu_data, ImuSeries).buffer[:, IMU_FILTER_CHANNELS])
+            else:
+                stft = stft[0]
 
-        # Get number of channels per data type (we subtract 1 because timestamp is not a channel we want to filter)
-        imu_channels = np.shape(imu_unroll)[1] - 1
+        scalers = self.run_stage("filtered", params, lambda: self.filter_imu_data(filter_freq))
 
-        # Design butterworth filter
-        fs = self.sampling_freq  # Sample frequency (Hz)
-        f0 = filter_freq  # Frequency to be removed from signal (Hz)
-        w0 = f0 / (fs / 2)  # Normalized Frequency
-        [b_bw, a_bw] = butterworth_filter(10, w0, output='ba')
-
-        for i, tit in zip(range(imu_channels), ("log(STFT) gyro", "log(STFT) acc")):
-            filt_res = filter_with_coeffs(a_bw, b_bw, np.stack(imu_unroll[:, i]), fs, self.plot_stft)
-            if self.plot_stft:
-                fig = filt_res[1]
-                imu_unroll[:, i] = [tuple(j) for j in filt_res[0]]
-                fig.suptitle(tit)
-                fig.axes[0].set_title("x")
-                fig.axes[1].set_title("y")
-                fig.axes[2].set_title("z")
-                fig.show()
-            else:
-                imu_unroll[:, i] = [tuple(j) for j in filt_res]
+        if raw_channels is not None:
+            filtered = as_series(self.imu_data, ImuSeries).buffer[:, IMU_FILTER_CHANNELS]
+            stft = filter_stft(raw_channels, filtered, self.sampling_freq)
+            if stft_key is not None:
+                self.raw_cache.store_entry(stft_key, stft, upstream_key=stft_upstream_key)
+        if stft is not None:
+            self.render_filter_stft(stft)
 
-        scale_g = MinMaxScaler()
-        scale_g.fit(np.stack(imu_unroll[:, 0]))
-        scale_a = MinMaxScaler()
-        scale_a.fit(np.stack(imu_unroll[:, 1]))
+        StreamingScaler.from_dict(scalers["gyro"]).save(self.get_ds_directory() + gyro_scale_file)
+        StreamingScaler.from_dict(scalers["acc"]).save(self.get_ds_directory() + acc_scale_file)
 
-        joblib.dump(scale_g, self.get_ds_directory() + gyro_scale_file)
-        joblib.dump(scale_a, self.get_ds_directory() + acc_scale_file)
+        # Careful -> data from now on is in flat numpy format (the buffers of the series, see `IMU_FIELDS` and
+        # `GT_FIELDS` for the column layout), instead of ImuSeries and GtSeries format
+        self.imu_data = as_series(self.imu_data, ImuSeries).buffer
+        self.gt_data = as_series(self.gt_data, GtSeries).buffer
 
-        # Add back the timestamps to the data matrix and return
-        # Careful -> data from now on is in numpy format, instead of GT and IMU format
-        self.imu_data = imu_unroll
-        self.gt_data = gt_unroll
+        self.sample_map = oversampling_index_map(len(self.imu_data), self.oversampled_regions)
 
         return self.imu_data, self.gt_data
-    
-    def interpolate_ground_truth(self):
+
+    def filter_imu_data(self, filter_freq):
         """
-        Interpolates the data of the ground truth so that it matches the timestamps of the raw imu data
+        Low-pass filters the imu data, and fits the scalers of the filtered gyroscope and accelerometer data
 
-        :return: the original imu data, and the interpolated ground truth data
+        :param filter_freq: frequency used for low-pass filter
+        :return: dictionary with the statistics of the gyroscope ("gyro") and accelerometer ("acc") scalers
         """
-        x_data = np.array(self.imu_data)
 
-        imu_timestamps = np.array([imu_meas.timestamp for imu_meas in x_data])
-        gt_unroll = np.array([(gt_meas.unroll()) for gt_meas in self.gt_data])
+        # The butterworth filter designs are cached, so they are only computed once per sampling and cutoff frequency
+        fs = self.sampling_freq  # Sample frequency (Hz)
+        sos = butterworth_sos(fs, filter_freq, IMU_FILTER_ORDER)
 
-        gt_timestamps = gt_unroll[:, 5]
+        channels = IMU_FILTER_CHANNELS
 
-        # Only keep imu data that is within the ground truth time span
-        x_data = x_data[(imu_timestamps > gt_timestamps[0]) * (imu_timestamps < gt_timestamps[-1])]
-        imu_timestamps = np.array([imu_meas.timestamp for imu_meas in x_data])
-        self.imu_data = x_data
+        if self.chunk_size:
+            imu, scale_g, scale_a = self.filter_imu_chunked(as_series(self.imu_data, ImuSeries), sos, channels)
+            gt = as_series(self.gt_data, GtSeries)
+        else:
+            # The imu data is filtered in place (the cached entries are copy-on-write maps, so the cache is untouched)
+            imu = as_series(self.imu_data, ImuSeries).writable()
+            gt = as_series(self.gt_data, GtSeries).writable()
+
+            imu.buffer[:, channels] = filter_with_sos(sos, imu.buffer[:, channels], self.zero_phase_filter)
+
+            scale_g = StreamingScaler().fit(imu.gyro)
+            scale_a = StreamingScaler().fit(imu.acc)
+
+        self.imu_data = imu
+        self.gt_data = gt
+
+        return {"gyro": scale_g.to_dict(), "acc": scale_a.to_dict()}
+
+    def render_filter_stft(self, stft):
+        """
+        Renders the STFT of the gyroscope and accelerometer channels, before and after filtering them, in the
+        background. The figures are saved in the diagnostics directory of the dataset (see `DIAGNOSTICS_DIR`)
+
+        :param stft: STFT of all the filtered channels, as returned by `filter_stft`
+        """
+
+        directory = self.get_ds_directory() + DIAGNOSTICS_DIR
+        for channel in IMU_FIELDS[:-1]:
+            channel_slice = ImuSeries.field_slice(channel)
+            channel_stft = {**stft, "raw": stft["raw"][channel_slice], "filtered": stft["filtered"][channel_slice]}
+            diagnostics_renderer.submit(render_filter_stft, directory + "filter_stft_{0}.png".format(channel),
+                                        channel_stft, "log(STFT) {0}".format(channel), ("x", "y", "z"))
+        print("Rendering the filter STFT figures in {0}".format(directory))
+
+    def filter_imu_chunked(self, imu, sos, channels):
+        """
+        Low-pass filters the imu data chunk by chunk into a memory-mapped file, carrying the state of the filter from
+        one chunk to the next (so the result is the same as filtering all the data at once), and fits the scalers of
+        the filtered gyroscope and accelerometer data on the way
+
+        :param imu: imu series
+        :param sos: second-order sections of the filter
+        :param channels: columns of the buffer to filter
+        :return: the filtered imu series, and the scalers of the gyroscope and the accelerometer
+        """
+
+        assert not self.zero_phase_filter, "The zero-phase filter is not supported by the chunked preprocessing"
+
+        imu_filt = self.open_chunked_series("imu_filtered", ImuSeries, len(imu))
+        imu_filt.timestamp = imu.timestamp
+
+        scale_g = StreamingScaler()
+        scale_a = StreamingScaler()
+
+        zi = np.zeros((len(sos), 2, channels.stop - channels.start))
+        for start in range(0, len(imu), self.chunk_size):
+            chunk = slice(start, start + self.chunk_size)
+            imu_filt.buffer[chunk, channels], zi = filter_with_sos(sos, imu.buffer[chunk, channels], zi=zi)
+
+            scale_g.partial_fit(imu_filt.gyro[chunk])
+            scale_a.partial_fit(imu_filt.acc[chunk])
+
+        imu_filt.buffer.flush()
+
+        return imu_filt, scale_g, scale_a
+
+    def regularize_timing(self):
+        """
+        Checks the timing of the raw imu and ground truth data. Duplicated and out-of-order samples are dropped, and the
+        gaps of the imu data (intervals longer than `IMU_GAP_TOLERANCE` sampling periods) are reported. If
+        `uniform_imu_rate` is set, the imu data is also resampled onto an exact uniform grid at the sampling frequency.
+        Cached as a preprocessing stage (see `run_stage`), with the report of the stage kept in `timing`
+        """
+
+        assert self.imu_data is not None and self.gt_data is not None and self.sampling_freq is not None, \
+            "The timing cannot be checked because there is no data yet."
+
+        params = {"sampling_freq": self.sampling_freq, "uniform": self.uniform_imu_rate}
+        self.timing = self.run_stage("timing", params, self._regularize_timing)
+
+        print("IMU timing: {0} duplicated or out-of-order samples dropped ({1} in the ground truth), {2} gaps with {3} "
+              "missing samples{4}".format(self.timing["imu_dropped"], self.timing["gt_dropped"],
+                                          self.timing["imu_gaps"], self.timing["imu_missing_samples"],
+                                          ", resampled at a uniform rate" if self.timing["uniform"] else ""))
+
+    def _regularize_timing(self):
+        imu = as_series(self.imu_data, ImuSeries)
+        gt = as_series(self.gt_data, GtSeries)
+
+        # The timestamps are integer nanoseconds (see `NS_PER_S`), so they are checked as integers
+        imu_ts = np.asarray(imu.timestamp).astype(np.int64)
+        gt_ts = np.asarray(gt.timestamp).astype(np.int64)
+        period = int(round(NS_PER_S / self.sampling_freq))
+
+        # The data is only copied if there are samples to drop
+        imu_keep = increasing_samples(imu_ts)
+        gt_keep = increasing_samples(gt_ts)
+        if not imu_keep.all():
+            imu, imu_ts = imu[imu_keep], imu_ts[imu_keep]
+        if not gt_keep.all():
+            gt = gt[gt_keep]
 
-        gt_pos = np.stack(gt_unroll[:, 0])
-        gt_vel = np.stack(gt_unroll[:, 1])
-        gt_att = np.stack(gt_unroll[:, 2])
-        gt_ang_vel = np.stack(gt_unroll[:, 3])
-        gt_acc = np.stack(gt_unroll[:, 4])
+        intervals = np.diff(imu_ts)
+        gaps = intervals[intervals > IMU_GAP_TOLERANCE * period]
+
+        if self.uniform_imu_rate:
+            imu = self.resample_imu_uniform(imu, imu_ts, period)
+
+        self.imu_data = imu
+        self.gt_data = gt
+
+        return {"period_ns": period, "uniform": self.uniform_imu_rate,
+                "imu_dropped": int(np.count_nonzero(~imu_keep)), "gt_dropped": int(np.count_nonzero(~gt_keep)),
+                "imu_gaps": len(gaps), "imu_missing_samples": int(np.sum(np.rint(gaps / period) - 1))}
+
+    def resample_imu_uniform(self, imu, imu_ts, period):
+        """
+        Linearly interpolates the imu data onto a uniform time grid, which starts at its first sample. The grid is
+        processed in blocks (of `chunk_size` samples, in the out-of-core mode, where the result is a memory-mapped file)
+
+        :param imu: imu series, with increasing timestamps
+        :param imu_ts: timestamps of the imu series, as int64
+        :param period: sampling period of the grid, in ns
+        :return: the resampled imu series
+        """
+
+        grid = uniform_grid(imu_ts[0], imu_ts[-1], period)
+
+        if self.chunk_size:
+            uniform = self.open_chunked_series("imu_uniform", ImuSeries, len(grid))
+        else:
+            uniform = ImuSeries.empty(len(grid))
+
+        block_size = self.chunk_size or len(grid)
+        for start in range(0, len(grid), block_size):
+            grid_block = grid[start:start + block_size]
+
+            # Imu samples that bracket the times of the block
+            ref_start = min(max(np.searchsorted(imu_ts, grid_block[0], side='right') - 1, 0), len(imu_ts) - 2)
+            ref_end = min(np.searchsorted(imu_ts, grid_block[-1], side='right') + 1, len(imu_ts))
+
+            uniform.buffer[start:start + len(grid_block)] = \
+                interpolate_ts(imu_ts[ref_start:ref_end], grid_block, imu.buffer[ref_start:ref_end])
+
+        # The interpolated timestamps are set to the exact (integer) grid times
+        uniform.timestamp = grid
+
+        return uniform
+
+    def interpolate_ground_truth(self):
+        """
+        Interpolates the data of the ground truth so that it matches the timestamps of the raw imu data. Both the imu
+        and the ground truth data are left in series format. The interpolated data is cached as a preprocessing stage
+        (see `run_stage`)
+        """
+
+        self.run_stage("interpolated", None, self._interpolate_ground_truth)
+
+    def _interpolate_ground_truth(self):
+        imu = as_series(self.imu_data, ImuSeries)
+        gt = as_series(self.gt_data, GtSeries)
+
+        if self.chunk_size:
+            self.imu_data, self.gt_data = self.interpolate_ground_truth_chunked(imu, gt)
+            return
+
+        # Only keep imu data that is within the ground truth time span
+        in_span = (imu.timestamp > gt.timestamp[0]) & (imu.timestamp < gt.timestamp[-1])
+        imu = imu[in_span]
 
         # Interpolate Ground truth to match IMU time acquisitions
-        gt_pos_interp = interpolate_ts(gt_timestamps, imu_timestamps, gt_pos)
-        gt_vel_interp = interpolate_ts(gt_timestamps, imu_timestamps, gt_vel)
-        gt_att_interp = interpolate_ts(gt_timestamps, imu_timestamps, gt_att, is_quaternion=True)
-        gt_ang_vel_interp = interpolate_ts(gt_timestamps, imu_timestamps, gt_ang_vel)
-        gt_acc_interp = interpolate_ts(gt_timestamps, imu_timestamps, gt_acc)
-        
-        gt_interp = (gt_pos_interp, gt_vel_interp, gt_att_interp, gt_ang_vel_interp, gt_acc_interp, imu_timestamps)
-        
-        # Re-make vector of interpolated GT measurements
-        n_samples = len(gt_pos_interp)
-        gt_interp = [GT().read_from_tuple(tuple([gt_interp[i][j] for i in range(6)])) for j in range(n_samples)]
+        self.imu_data = imu
+        self.gt_data = interpolate_gt_series(gt, imu.timestamp)
+
+    def interpolate_ground_truth_chunked(self, imu, gt):
+        """
+        Interpolates the ground truth chunk by chunk into a memory-mapped file (see `interpolate_ground_truth`)
+
+        :param imu: imu series (sorted by timestamp)
+        :param gt: ground truth series (sorted by timestamp)
+        :return: the imu series within the ground truth time span (a view) and the interpolated ground truth series
+        """
+
+        gt_ts = np.ascontiguousarray(gt.timestamp)
+
+        # Only keep imu data that is within the ground truth time span. The timestamps are sorted, so it is a slice
+        imu_ts = np.ascontiguousarray(imu.timestamp)
+        imu = imu[np.searchsorted(imu_ts, gt_ts[0], side='right'):np.searchsorted(imu_ts, gt_ts[-1], side='left')]
+        del imu_ts
+
+        gt_interp = self.open_chunked_series("gt_interpolated", GtSeries, len(imu))
+
+        for start in range(0, len(imu), self.chunk_size):
+            imu_chunk = imu[start:start + self.chunk_size]
 
-        self.gt_data = gt_interp
+            # Ground truth samples that bracket the timestamps of the chunk
+            gt_start = max(np.searchsorted(gt_ts, imu_chunk.timestamp[0], side='right') - 1, 0)
+            gt_end = min(np.searchsorted(gt_ts, imu_chunk.timestamp[-1], side='right') + 1, len(gt))
+
+            gt_interp.buffer[start:start + self.chunk_size] = \
+                interpolate_gt_series(gt[gt_start:gt_end], imu_chunk.timestamp).buffer
+
+        gt_interp.buffer.flush()
+
+        return imu, gt_interp
+
+    def keep_first_samples(self, fraction):
+        """
+        Keeps only the first fraction of the (interpolated) imu and ground truth samples
+
+        :param fraction: fraction of samples to keep, between 0 and 1
+        """
+
+        def keep_samples():
+            imu = as_series(self.imu_data, ImuSeries)
+            gt = as_series(self.gt_data, GtSeries)
+
+            self.imu_data = imu[:int(np.ceil(fraction * len(imu)))]
+            self.gt_data = gt[:int(np.ceil(fraction * len(gt)))]
+
+        # The samples are kept as views, so there is no need to cache them
+        self.run_stage("first_samples", {"fraction": fraction}, keep_samples, cached=False)
 
     def plot_all_data(self, title="", from_numpy=False, show=False):
         """
         Plots the imu and ground truth data in two separate figures
 
         :param title: title of the plot
-        :param from_numpy: format of the input data
+        :param from_numpy: format of the input data (flat numpy arrays if True, series format otherwise)
         :param show: whether to show plot or not
         :return:
         """
 
         self.plot_stft = True
-        x_axis = np.linspace(0, len(self.imu_data)/self.sampling_freq, len(self.imu_data))
-
-        if from_numpy:
-            fig = plt.figure()
-            fig.tight_layout()
-            ax = fig.add_subplot(2, 1, 1)
-            ax.plot(x_axis, np.stack(self.imu_data[:, 0]))
-            ax.set_title("IMU: gyroscope")
-            ax.legend(['x', 'y', 'z'])
-            ax.set_ylabel('rad/s')
-            ax = fig.add_subplot(2, 1, 2)
-            ax.plot(x_axis, np.stack(self.imu_data[:, 1]))
-            ax.set_title("IMU: accelerometer")
-            ax.legend(['x', 'y', 'z'])
-            ax.set_ylabel(r'$m/s^{2}$')
-            ax.set_xlabel('s')
-            fig.suptitle(title)
-
-            fig = plt.figure()
-            fig.tight_layout()
-            ax = fig.add_subplot(2, 2, 1)
-            ax.plot(x_axis, np.stack(self.gt_data[:, 0]))
-            ax.set_title("GT: position")
-            ax.legend(['x', 'y', 'z'])
-            ax = fig.add_subplot(2, 2, 2)
-            ax.plot(x_axis, np.stack(self.gt_data[:, 1]))
-            ax.set_title("GT: velocity")
-            ax.legend(['x', 'y', 'z'])
-            ax = fig.add_subplot(2, 2, 3)
-            ax.plot(x_axis, np.stack(self.gt_data[:, 2]))
-            ax.set_title("GT: attitude")
-            ax.legend(['w', 'x', 'y', 'z'])
-            ax = fig.add_subplot(2, 2, 4)
-            ax.plot(x_axis, np.stack(self.gt_data[:, 3]))
-            ax.set_title("GT: angular velocity")
-            ax.legend(['x', 'y', 'z'])
-            fig.suptitle(title)
 
-        else:
-            fig = plt.figure()
-            fig.tight_layout()
-            ax = fig.add_subplot(2, 1, 1)
-            ax.plot(x_axis, [imu.gyro for imu in self.imu_data])
-            ax.set_title("IMU: gyroscope")
-            ax.legend(['x', 'y', 'z'])
-            ax.set_ylabel('rad/s')
-            ax = fig.add_subplot(2, 1, 2)
-            ax.plot(x_axis, [imu.acc for imu in self.imu_data])
-            ax.set_title("IMU: accelerometer")
-            ax.legend(['x', 'y', 'z'])
-            ax.set_ylabel(r'$m/s^{2}$')
-            ax.set_xlabel('s')
-            fig.suptitle(title)
-
-            fig = plt.figure()
-            fig.tight_layout()
-            ax = fig.add_subplot(2, 2, 1)
-            ax.plot(x_axis, [gt.pos for gt in self.gt_data])
-            ax.set_title("GT: position")
-            ax.legend(['x', 'y', 'z'])
-            ax = fig.add_subplot(2, 2, 2)
-            ax.plot(x_axis, [gt.vel for gt in self.gt_data])
-            ax.set_title("GT: velocity")
-            ax.legend(['x', 'y', 'z'])
-            ax = fig.add_subplot(2, 2, 3)
-            ax.plot(x_axis, [gt.att for gt in self.gt_data])
-            ax.set_title("GT: attitude")
-            ax.legend(['w', 'x', 'y', 'z'])
-            ax = fig.add_subplot(2, 2, 4)
-            ax.plot(x_axis, [gt.ang_vel for gt in self.gt_data])
-            ax.set_title("GT: angular velocity")
-            ax.legend(['x', 'y', 'z'])
-            fig.suptitle(title)
+        # The flat numpy arrays are the buffers of the series, so they can be wrapped without copying them
+        imu_columns = as_series(self.imu_data, ImuSeries).columns()
+        gt_columns = as_series(self.gt_data, GtSeries).columns()
+
+        n_samples = len(imu_columns["timestamp"])
+        x_axis = np.linspace(0, n_samples/self.sampling_freq, n_samples)
+
+        fig = plt.figure()
+        fig.tight_layout()
+        ax = fig.add_subplot(2, 1, 1)
+        ax.plot(x_axis, imu_columns["gyro"])
+        ax.set_title("IMU: gyroscope")
+        ax.legend(['x', 'y', 'z'])
+        ax.set_ylabel('rad/s')
+        ax = fig.add_subplot(2, 1, 2)
+        ax.plot(x_axis, imu_columns["acc"])
+        ax.set_title("IMU: accelerometer")
+        ax.legend(['x', 'y', 'z'])
+        ax.set_ylabel(r'$m/s^{2}$')
+        ax.set_xlabel('s')
+        fig.suptitle(title)
+
+        fig = plt.figure()
+        fig.tight_layout()
+        ax = fig.add_subplot(2, 2, 1)
+        ax.plot(x_axis, gt_columns["pos"])
+        ax.set_title("GT: position")
+        ax.legend(['x', 'y', 'z'])
+        ax = fig.add_subplot(2, 2, 2)
+        ax.plot(x_axis, gt_columns["vel"])
+        ax.set_title("GT: velocity")
+        ax.legend(['x', 'y', 'z'])
+        ax = fig.add_subplot(2, 2, 3)
+        ax.plot(x_axis, gt_columns["att"])
+        ax.set_title("GT: attitude")
+        ax.legend(['w', 'x', 'y', 'z'])
+        ax = fig.add_subplot(2, 2, 4)
+        ax.plot(x_axis, gt_columns["ang_vel"])
+        ax.set_title("GT: angular velocity")
+        ax.legend(['x', 'y', 'z'])
+        fig.suptitle(title)
 
         if show:
             plt.show()
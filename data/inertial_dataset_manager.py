@@ -1,28 +1,273 @@
+import json
+import shutil
+import hashlib
+import multiprocessing
 import numpy as np
 import tensorflow as tf
-from sklearn.externals import joblib
+from concurrent.futures import ProcessPoolExecutor
 
-from data.imu_dataset_generators import StatePredictionDataset
-from data.utils.data_utils import save_train_and_test_datasets, load_mat_data
-from utils.directories import add_text_to_txt_file
+from data.inertial_ABCs import CHUNKED_PROCESSING_DIR
+from data.imu_dataset_generators import StatePredictionDataset, imu_window_view, imu_window_spec, imu_window_rows, \
+    gather_imu_windows
+from data.utils.data_utils import save_train_and_test_datasets, load_mat_data, save_train_and_test_chunks, \
+    load_npy_data
+from data.utils.streaming_scaler import StreamingScaler
+from utils.directories import add_text_to_txt_file, safe_mkdir_recursive
 
 
-SCALER_GYRO_FILE = "scaler_gyro.save"
-SCALER_ACC_FILE = "scaler_acc.save"
+SCALER_GYRO_FILE = "scaler_gyro.json"
+SCALER_ACC_FILE = "scaler_acc.json"
 SCALER_DIR_FILE = 'scaler_files_dir.txt'
 DATASET_CONF_PARAMS_FILE = "generated_ds_params.txt"
 
+MULTI_SEQUENCE_DIR = './data/dataset/multi_sequence/'
+
+# Directory (within the chunked preprocessing directory of a sequence) of the chunks of its windowed dataset
+WINDOW_CHUNKS_DIR = 'windows/'
+
+# Keys of the stored datasets of the random stride mode, which keep the padded imu buffer and the row of the buffer
+# where every window starts instead of the imu windows (see `compact_imu_windows`)
+IMU_ROWS_KEY = "imu_input_rows"
+IMU_BUFFER_KEY = "imu_input_buffer"
+
+# Parameters that identify a sequence of each dataset, in the order used by the "a/b/c" sequence spec strings
+SEQUENCE_SPEC_KEYS = {
+    "blackbird": ("trajectory_name", "yaw_type", "max_speed"),
+    "euroc": ("dataset_version", "oversampled_regions"),
+    "simulated": ("dataset_version", "flight", "number")
+}
+
+
+def make_inertial_dataset(dataset_name, **sequence):
+    """
+    Creates the dataset manager of a sequence
+
+    :param dataset_name: name of the dataset
+    :param sequence: parameters of the sequence (see `SEQUENCE_SPEC_KEYS`). Missing parameters are taken from the flags
+    :return: the InertialDataset of the sequence
+    """
+
+    if dataset_name == 'blackbird':
+        from data.utils.blackbird_utils import BlackbirdDSManager
+        return BlackbirdDSManager(**sequence)
+    elif dataset_name == 'euroc':
+        from data.utils.euroc_utils import EurocDSManager
+        return EurocDSManager(**sequence)
+    elif dataset_name == 'simulated':
+        from data.utils.simulated_ds_utils import GenDSManager
+        return GenDSManager(**sequence)
+    else:
+        raise NameError("Invalid dataset name")
+
+
+def parse_sequence_spec(dataset_name, spec):
+    """
+    Converts a sequence spec into the parameters of the sequence
+
+    :param dataset_name: name of the dataset
+    :param spec: dictionary of sequence parameters, or string with the parameters separated by slashes, in the order of
+    `SEQUENCE_SPEC_KEYS` (e.g. "bentDice/yawForward/2.0" for blackbird). The last parameters can be left out, and are
+    then taken from the flags
+    :return: dictionary of sequence parameters
+    """
+
+    if isinstance(spec, dict):
+        return spec
+
+    values = spec.strip("/").split("/")
+    keys = SEQUENCE_SPEC_KEYS[dataset_name]
+    assert len(values) <= len(keys), "Sequence spec {0} does not match the format {1}".format(spec, "/".join(keys))
+
+    return dict(zip(keys, values))
+
+
+def compact_imu_windows(x_data, padded_imu):
+    """
+    Replaces the imu windows of a windowed dataset by the padded imu buffer they are a view of, and the row of the
+    buffer where every window starts, so that the dataset is stored in O(n) memory (see `gather_imu_windows`)
+
+    :param x_data: inputs dictionary of the windowed dataset
+    :param padded_imu: padded imu buffer of the windows
+    :return: the inputs dictionary, with the IMU_ROWS_KEY and IMU_BUFFER_KEY entries instead of the imu input
+    """
+
+    windows = x_data.pop("imu_input")
+    x_data[IMU_ROWS_KEY] = imu_window_rows(windows, padded_imu)
+    x_data[IMU_BUFFER_KEY] = padded_imu[:, :windows.shape[2]]
+    return x_data
+
+
+def generate_windowed_dataset(dataset, dataset_type, args, processed_imu, processed_gt, pre_integration_workers=1,
+                              max_window_len=0, precision="float64", stride=1, compact_imu=False):
+    """
+    Windows the pre-processed data of a sequence and generates the targets of the dataset. The result is cached as the
+    last preprocessing stage of the sequence (see `InertialDataset.run_stage`), so that changing only the dataset type
+    or the window length does not run the upstream stages again, and switching back to a previous configuration does
+    not run any stage at all
+
+    :param dataset: InertialDataset of the sequence, after its pre-processing
+    :param dataset_type: dataset structure type
+    :param args: extra arguments for dataset generation
+    :param processed_imu: pre-processed imu data of the sequence
+    :param processed_gt: pre-processed ground truth data of the sequence
+    :param pre_integration_workers: number of processes that compute the targets of the pre-integration dataset
+    :param max_window_len: if larger than the window length, the targets of the pre-integration dataset are sliced
+    from a cached pre-integration table of windows of this length (see `build_pre_integration_table`), shared by all
+    the shorter window lengths
+    :param precision: floating point type of the windows and targets of the dataset ("float64" or "float32")
+    :param stride: only every stride-th window is kept (see `StatePredictionDataset.generate_dataset`). The cached
+    dataset keeps all the windows, so that it is shared by all the strides
+    :param compact_imu: whether to return the padded imu buffer and the first row of every window instead of the imu
+    windows (see `compact_imu_windows`)
+    :return: the inputs and outputs dictionaries of the windowed dataset
+    """
+
+    dataset_generator = StatePredictionDataset(pre_integration_workers, precision)
+    dataset_generator.load_data(processed_imu, processed_gt, dataset.sample_map)
+
+    if dataset.stage_key is None:
+        dataset_generator.generate_dataset(dataset_type, args, stride)
+        dataset_generator.close()
+        x_data, y_data = dataset_generator.get_dataset()
+        return compact_imu_windows(x_data, dataset_generator.padded_imu) if compact_imu else x_data, y_data
+
+    # The class of the dataset is part of the key, as `pre_process_data` may process the data further after the filter,
+    # and so are the oversampled regions, which are not part of any upstream stage
+    params = {"dataset": type(dataset).__name__, "dataset_type": dataset_type, "args": args,
+              "oversampled_regions": dataset.oversampled_regions, "precision": precision}
+
+    if dataset_type == "imu_preintegration" and max_window_len > args[0]:
+        # The rest of the dataset are views and slices of the pre-processed data, so only the table is cached
+        table_params = {"dataset": type(dataset).__name__, "window_len": max_window_len,
+                        "oversampled_regions": dataset.oversampled_regions, "precision": precision}
+        key = dataset.raw_cache.stage_key(dataset.stage_key, "pre_integration_table", table_params)
+
+        entry = dataset.raw_cache.load_entry(key)
+        if entry is None:
+            table = dataset_generator.build_pre_integration_table(max_window_len)
+            dataset.raw_cache.store_entry(key, table, upstream_key=dataset.entry_key)
+        else:
+            table = entry[0]
+
+        dataset_generator.pre_integration_table = table
+        dataset_generator.generate_dataset(dataset_type, args, stride)
+        dataset_generator.close()
+        x_data, y_data = dataset_generator.get_dataset()
+        return compact_imu_windows(x_data, dataset_generator.padded_imu) if compact_imu else x_data, y_data
+
+    key = dataset.raw_cache.stage_key(dataset.stage_key, "windowed", params)
+
+    # The imu windows are not stored, as they would be window_len copies of every imu sample. Only the windows they
+    # span are, and they are rebuilt as views of the padded imu data (O(n) memory), which is cheap to compute. Entries
+    # that still store the imu windows are generated again
+    entry = dataset.raw_cache.load_entry(key)
+    if entry is not None and "imu_windows" in entry[1]:
+        arrays, ds_keys = entry
+        padded_imu = dataset_generator.pad_imu_data(args[0])
+        arrays.update({ds_key: imu_window_view(padded_imu, args[0], *spec)
+                       for ds_key, spec in ds_keys["imu_windows"].items()})
+        x_data = {x_key: arrays[x_key][::stride] for x_key in ds_keys["x_keys"]}
+        y_data = {y_key: arrays[y_key][::stride] for y_key in ds_keys["y_keys"]}
+        return compact_imu_windows(x_data, padded_imu) if compact_imu else x_data, y_data
+
+    dataset_generator.generate_dataset(dataset_type, args)
+    dataset_generator.close()
+    x_data, y_data = dataset_generator.get_dataset()
+
+    padded_imu = dataset_generator.padded_imu
+    imu_windows = {ds_key: imu_window_spec(values, padded_imu) for ds_key, values in {**x_data, **y_data}.items()
+                   if padded_imu is not None and np.may_share_memory(values, padded_imu)}
+    stored_arrays = {ds_key: values for ds_key, values in {**x_data, **y_data}.items() if ds_key not in imu_windows}
+
+    dataset.raw_cache.store_entry(key, stored_arrays,
+                                  {"x_keys": list(x_data), "y_keys": list(y_data), "imu_windows": imu_windows},
+                                  dataset.entry_key)
+
+    x_data = {x_key: x[::stride] for x_key, x in x_data.items()}
+    y_data = {y_key: y[::stride] for y_key, y in y_data.items()}
+    return compact_imu_windows(x_data, padded_imu) if compact_imu else x_data, y_data
+
+
+def build_sequence_dataset(dataset_name, sequence, dataset_type, args, scaler_gyro_file, scaler_acc_file,
+                           chunk_size=None, uniform_imu_rate=False, pre_integration_workers=1, max_window_len=0,
+                           precision="float64", stride=1, compact_imu=False):
+    """
+    Runs the whole dataset generation pipeline (ingestion, interpolation, filtering and windowing) on one sequence.
+    Used as process pool task by the multi-sequence mode of the DatasetManager
+
+    :param dataset_name: name of the dataset
+    :param sequence: parameters of the sequence
+    :param dataset_type: dataset structure type
+    :param args: extra arguments for dataset generation
+    :param scaler_gyro_file: file to save pre-processing functions for gyroscope
+    :param scaler_acc_file: file to save pre-processing functions for accelerometer
+    :param chunk_size: if given, the sequence is processed out of core, in chunks of this number of samples
+    :param uniform_imu_rate: whether to resample the imu data onto a uniform time grid
+    :param pre_integration_workers: number of processes that compute the targets of the pre-integration dataset
+    :param max_window_len: window length of the cached pre-integration table (see `generate_windowed_dataset`)
+    :param precision: floating point type of the windows and targets of the dataset ("float64" or "float32")
+    :param stride: only every stride-th window of the sequence is kept
+    :param compact_imu: whether to return the padded imu buffer and the window rows instead of the imu windows (see
+    `compact_imu_windows`). Not supported in chunked mode
+    :return: the local directory of the sequence and the chunks of its windowed dataset, as a list of (inputs, outputs)
+    dictionary pairs. In chunked mode the dictionaries hold the .npy files of the chunks, otherwise the whole windowed
+    dataset is a single in-memory chunk
+    """
+
+    dataset = make_inertial_dataset(dataset_name, **sequence)
+    dataset.chunk_size = chunk_size
+    dataset.uniform_imu_rate = uniform_imu_rate
+    dataset.get_raw_ds()
+    processed_imu, processed_gt = dataset.pre_process_data(scaler_gyro_file, scaler_acc_file)
+
+    if chunk_size:
+        dataset_generator = StatePredictionDataset(pre_integration_workers, precision)
+        dataset_generator.load_data(processed_imu, processed_gt, dataset.sample_map)
+        chunks = dataset_generator.generate_dataset_chunks(
+            dataset_type, args, chunk_size, dataset.get_chunk_directory() + WINDOW_CHUNKS_DIR, stride)
+        dataset_generator.close()
+        return dataset.get_ds_directory(), chunks
+
+    return dataset.get_ds_directory(), [generate_windowed_dataset(dataset, dataset_type, args, processed_imu,
+                                                                  processed_gt, pre_integration_workers,
+                                                                  max_window_len, precision, stride, compact_imu)]
+
 
 class DatasetManager:
-    def __init__(self, prepared_train_data_file, prepared_test_data_file, trained_model_dir, dataset_name):
+    def __init__(self, prepared_train_data_file, prepared_test_data_file, trained_model_dir, dataset_name,
+                 sequences=None, max_workers=None, chunk_size=None, uniform_imu_rate=False, pre_integration_workers=1,
+                 max_window_len=0, precision="float64", window_stride=1, random_stride=False):
         """
 
         :param prepared_train_data_file: Name of the preprocessed training dataset
         :param prepared_test_data_file: Name of the preprocessed testing dataset
         :param trained_model_dir: Local directory of the model currently being trained
         :param dataset_name: Name of the dataset to use
+        :param sequences: list of sequence specs (see `parse_sequence_spec`) to combine in a single dataset. If not
+        given, the single sequence selected by the dataset flags is used
+        :param max_workers: maximum number of processes used to generate the sequences in multi-sequence mode
+        :param chunk_size: if given, the sequences are preprocessed and windowed out of core, in chunks of this number
+        of samples, so that the memory usage does not depend on their length. The datasets are then saved as directories
+        of .npy files instead of .mat files
+        :param uniform_imu_rate: whether to resample the imu data of the sequences onto an exact uniform time grid at
+        the sampling frequency (see `InertialDataset.regularize_timing`)
+        :param pre_integration_workers: number of processes that compute the targets of the pre-integration dataset of
+        every sequence
+        :param max_window_len: if larger than the window length, the pre-integration targets of every sequence are
+        computed (and cached) once for windows of this length, and the targets of any shorter window length are sliced
+        from them. Not used in chunked mode
+        :param precision: floating point type of the windows and targets of the datasets ("float64" or "float32"), from
+        their generation to the tensorflow datasets. The timestamps of the sequences are processed in float64 anyway
+        :param window_stride: only every window_stride-th window of every sequence is part of the datasets
+        :param random_stride: if True, the datasets keep all the windows, and the stride is applied by the training
+        dataset instead: every pass over it takes one window at a random offset from every window_stride windows (see
+        `generate_tf_ds`). Unless in chunked mode, the datasets then store the padded imu data of the sequences instead
+        of the imu windows (see `compact_imu_windows`)
         """
 
+        assert precision in ("float64", "float32"), "The dataset precision must be either float64 or float32"
+        assert window_stride >= 1, "The window stride must be a positive integer"
+
         self.train_data_file = prepared_train_data_file
         self.test_data_file = prepared_test_data_file
         self.training_dir = trained_model_dir
@@ -34,19 +279,38 @@ class DatasetManager:
 
         self.dataset_formatting = None
 
-        if dataset_name == 'blackbird':
-            from data.utils.blackbird_utils import BlackbirdDSManager
-            self.dataset = BlackbirdDSManager()
-        elif dataset_name == 'euroc':
-            from data.utils.euroc_utils import EurocDSManager
-            self.dataset = EurocDSManager()
-        elif dataset_name == 'simulated':
-            from data.utils.simulated_ds_utils import GenDSManager
-            self.dataset = GenDSManager()
+        self.dataset_name = dataset_name
+        self.max_workers = max_workers
+        self.chunk_size = chunk_size
+        self.uniform_imu_rate = uniform_imu_rate
+        self.pre_integration_workers = pre_integration_workers
+        self.max_window_len = max_window_len
+        self.precision = precision
+        self.window_stride = window_stride
+        self.random_stride = random_stride
+        # Stride of the generated datasets. In random stride mode, it is applied afterwards
+        self.generation_stride = 1 if random_stride else window_stride
+        # Whether the stored datasets hold the padded imu buffer and the window rows instead of the imu windows
+        self.compact_imu = random_stride and window_stride > 1 and not chunk_size
+        self.sequences = [parse_sequence_spec(dataset_name, spec) for spec in sequences] if sequences else None
+
+        if self.sequences is None:
+            self.dataset = make_inertial_dataset(dataset_name)
+            self.dataset.chunk_size = chunk_size
+            self.dataset.uniform_imu_rate = uniform_imu_rate
+            self.ds_local_dir = self.dataset.get_ds_directory()
         else:
-            raise NameError("Invalid dataset name")
+            # The combined dataset is stored in a directory of its own, named after the combined sequences
+            sequences_id = hashlib.sha1(json.dumps(self.sequences, sort_keys=True).encode()).hexdigest()[:16]
+            self.dataset = None
+            self.ds_local_dir = "{0}{1}_{2}/".format(MULTI_SEQUENCE_DIR, dataset_name, sequences_id)
+            safe_mkdir_recursive(self.ds_local_dir, overwrite=False)
+            add_text_to_txt_file(json.dumps(self.sequences), self.ds_local_dir, "sequences.json", overwrite=True)
 
-        self.dataset_generator = StatePredictionDataset()
+        self.dataset_generator = StatePredictionDataset(pre_integration_workers, precision)
+
+    def get_ds_directory(self):
+        return self.ds_local_dir
 
     def get_dataset(self, dataset_type, *args, train, batch_size, validation_split, split_percentage=0.1, plot=False,
                     shuffle=True, random_split=True, normalize=True, full_batches=False, repeat_ds=False,
@@ -60,7 +324,7 @@ class DatasetManager:
         :param batch_size: batch size of training, validation and testing dataset (same batch size for the three)
         :param validation_split: whether a validation split should be generated
         :param split_percentage: the percentage of dataset to be split for validation/testing
-        :param plot: whether to plot the dataset
+        :param plot: whether to plot the dataset (only in single-sequence mode)
         :param shuffle: whether to shuffle the dataset
         :param random_split: whether to randomly split into train and test datasets
         :param normalize: whether to normalize the dataset
@@ -73,14 +337,19 @@ class DatasetManager:
 
         self.dataset_formatting = dataset_type
 
-        if not self.is_dataset_ready(dataset_type, args) or force_remake:
+        if self.sequences is not None:
+            if not self.is_dataset_ready(dataset_type, args) or force_remake:
+                print("Generating the dataset from {0} sequences. This may take a while".format(len(self.sequences)))
+                self.save_multi_sequence_dataset(args, split_percentage, random_split=random_split)
+
+        elif not self.is_dataset_ready(dataset_type, args) or force_remake:
             print("Generating the dataset. This may take a while")
             self.dataset.get_raw_ds()
             if plot:
                 self.dataset.plot_all_data(title="raw")
 
             # TODO: export as json/yaml
-            add_text_to_txt_file(dataset_type + str(args), self.dataset.get_ds_directory(), self.dataset_conf_file,
+            add_text_to_txt_file(self.get_ds_conf(dataset_type, args), self.get_ds_directory(), self.dataset_conf_file,
                                  overwrite=True)
             processed_imu, processed_gt = self.dataset.pre_process_data(self.scaler_gyro_file, self.scaler_acc_file)
 
@@ -91,7 +360,7 @@ class DatasetManager:
             self.save_dataset_to_files(processed_imu, processed_gt, args, split_percentage, random_split=random_split)
 
         if train:
-            add_text_to_txt_file(self.dataset.get_ds_directory(), self.training_dir, self.scaler_dir_file)
+            add_text_to_txt_file(self.get_ds_directory(), self.training_dir, self.scaler_dir_file)
 
         return self.generate_tf_ds(args,
                                    normalize=normalize,
@@ -116,16 +385,126 @@ class DatasetManager:
         :param random_split: whether datasets should be randomly splitted
         """
 
-        ds_dir = self.dataset.get_ds_directory()
+        if self.chunk_size:
+            self.dataset_generator.load_data(x_data, y_data, self.dataset.sample_map)
+            chunks = self.dataset_generator.generate_dataset_chunks(
+                self.dataset_formatting, args, self.chunk_size, self.dataset.get_chunk_directory() + WINDOW_CHUNKS_DIR,
+                self.generation_stride)
+            self.dataset_generator.close()
+            self.save_train_and_test_chunks(chunks, [self.dataset.get_ds_directory()], test_split, random_split)
+            return
+
+        training_data, ground_truth_data = generate_windowed_dataset(self.dataset, self.dataset_formatting, args,
+                                                                     x_data, y_data, self.pre_integration_workers,
+                                                                     self.max_window_len, self.precision,
+                                                                     self.generation_stride, self.compact_imu)
+
+        self.save_train_and_test_files(training_data, ground_truth_data, test_split, random_split)
+
+    def save_multi_sequence_dataset(self, args, test_split, random_split):
+        """
+        Generates the windowed dataset of every sequence in a process pool, and combines them in a single training and
+        testing dataset. The sequences are windowed separately, so no window crosses the boundary between two sequences.
+        The scalers of the sequences are merged into the scalers of the combined dataset.
+
+        :param args: extra arguments for dataset generation
+        :param test_split: the percentage of dataset to be split for testing
+        :param random_split: whether datasets should be randomly splitted
+        """
+
+        # Spawn the workers instead of forking the (possibly multi-threaded) tensorflow process
+        pool = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context("spawn"))
+
+        with pool:
+            futures = [pool.submit(build_sequence_dataset, self.dataset_name, sequence, self.dataset_formatting, args,
+                                   self.scaler_gyro_file, self.scaler_acc_file, self.chunk_size,
+                                   self.uniform_imu_rate, self.pre_integration_workers, self.max_window_len,
+                                   self.precision, self.generation_stride, self.compact_imu)
+                       for sequence in self.sequences]
+            results = [future.result() for future in futures]
+
+        sequence_dirs, sequence_chunks = zip(*results)
+        chunks = [chunk for chunk_list in sequence_chunks for chunk in chunk_list]
+
+        for scaler_file in (self.scaler_gyro_file, self.scaler_acc_file):
+            scaler = StreamingScaler.merged([StreamingScaler.load(ds_dir + scaler_file) for ds_dir in sequence_dirs])
+            scaler.save(self.get_ds_directory() + scaler_file)
+
+        add_text_to_txt_file(self.get_ds_conf(self.dataset_formatting, args), self.get_ds_directory(),
+                             self.dataset_conf_file, overwrite=True)
+
+        if self.chunk_size:
+            self.save_train_and_test_chunks(chunks, sequence_dirs, test_split, random_split)
+            return
+
+        x_datasets, y_datasets = zip(*chunks)
+
+        if self.compact_imu:
+            # The imu buffers of the sequences are concatenated, so the rows of their windows are offset accordingly
+            buffer_offsets = np.cumsum([0] + [len(x_ds[IMU_BUFFER_KEY]) for x_ds in x_datasets[:-1]])
+            for x_ds, offset in zip(x_datasets, buffer_offsets):
+                x_ds[IMU_ROWS_KEY] = x_ds[IMU_ROWS_KEY] + offset
+
+        training_data = {key: np.concatenate([x_ds[key] for x_ds in x_datasets]) for key in x_datasets[0].keys()}
+        ground_truth_data = {key: np.concatenate([y_ds[key] for y_ds in y_datasets]) for key in y_datasets[0].keys()}
 
-        self.dataset_generator.load_data(x_data, y_data)
-        self.dataset_generator.generate_dataset(self.dataset_formatting, args)
-        training_data, ground_truth_data = self.dataset_generator.get_dataset()
+        self.save_train_and_test_files(training_data, ground_truth_data, test_split, random_split)
+
+    def save_train_and_test_files(self, training_data, ground_truth_data, test_split, random_split):
+        """
+        Splits a generated dataset into training and testing datasets, and saves them in the dataset directory
+
+        :param training_data: inputs dictionary of the generated dataset
+        :param ground_truth_data: outputs dictionary of the generated dataset
+        :param test_split: the percentage of dataset to be split for testing
+        :param random_split: whether datasets should be randomly splitted
+        """
+
+        ds_dir = self.get_ds_directory()
 
         storage_train_ds_file = "{0}{1}".format(ds_dir, self.train_data_file)
         storage_test_ds_file = "{0}{1}".format(ds_dir, self.test_data_file)
+
+        # The imu buffer is not split, both datasets keep all of it
+        shared_data = {IMU_BUFFER_KEY: training_data.pop(IMU_BUFFER_KEY)} if self.compact_imu else None
         save_train_and_test_datasets(storage_train_ds_file, storage_test_ds_file, training_data, ground_truth_data,
-                                     test_split, random_split)
+                                     test_split, random_split, shared_data)
+
+    def save_train_and_test_chunks(self, chunks, sequence_dirs, test_split, random_split):
+        """
+        Splits a dataset generated in chunks into training and testing datasets, saves them in the dataset directory,
+        and removes the intermediate files of the chunked preprocessing of its sequences
+
+        :param chunks: list of (inputs, outputs) dictionary pairs with the .npy files of the chunks of the dataset
+        :param sequence_dirs: local directories of the sequences the dataset was generated from
+        :param test_split: the percentage of dataset to be split for testing
+        :param random_split: whether datasets should be randomly splitted
+        """
+
+        ds_dir = self.get_ds_directory()
+
+        storage_train_ds_file = "{0}{1}".format(ds_dir, self.train_data_file)
+        storage_test_ds_file = "{0}{1}".format(ds_dir, self.test_data_file)
+        save_train_and_test_chunks(storage_train_ds_file, storage_test_ds_file, chunks, test_split, random_split)
+
+        for sequence_dir in sequence_dirs:
+            shutil.rmtree(sequence_dir + CHUNKED_PROCESSING_DIR, ignore_errors=True)
+
+    def get_ds_conf(self, dataset_type, args):
+        """
+        :param dataset_type: dataset structure type
+        :param args: extra arguments for dataset generation
+        :return: the string that identifies the generated dataset files
+        """
+
+        # The chunked mode stores the datasets in a different format, the uniform rate changes the imu data, the
+        # precision the type of the stored arrays, the stride the stored windows, and the random stride mode stores the
+        # imu buffer instead of the imu windows
+        return dataset_type + str(args) + (" (chunked)" if self.chunk_size else "") + \
+            (" (uniform rate)" if self.uniform_imu_rate else "") + \
+            (" ({0})".format(self.precision) if self.precision != "float64" else "") + \
+            (" (stride {0})".format(self.generation_stride) if self.generation_stride > 1 else "") + \
+            (" (imu buffer)" if self.compact_imu else "")
 
     def is_dataset_ready(self, dataset_type, args):
         """
@@ -137,9 +516,9 @@ class DatasetManager:
         """
 
         try:
-            file = open(self.dataset.get_ds_directory() + self.dataset_conf_file, "r")
+            file = open(self.get_ds_directory() + self.dataset_conf_file, "r")
             generated_ds_params = file.read()
-            return generated_ds_params == dataset_type + str(args)
+            return generated_ds_params == self.get_ds_conf(dataset_type, args)
         except (NotADirectoryError, FileNotFoundError):
             return False
 
@@ -165,28 +544,55 @@ class DatasetManager:
         seed = 8901
 
         if training:
-            filename = self.dataset.get_ds_directory() + self.train_data_file
+            filename = self.get_ds_directory() + self.train_data_file
         else:
-            filename = self.dataset.get_ds_directory() + self.test_data_file
+            filename = self.get_ds_directory() + self.test_data_file
 
         x_keys, y_keys = self.dataset_generator.get_dataset_keys(self.dataset_formatting)
-        training_x, training_y = load_mat_data(filename, x_keys, y_keys)
+        window_len = args[0]
+
+        if self.chunk_size:
+            training_x, training_y = load_npy_data(filename, x_keys, y_keys)
+        elif self.compact_imu:
+            stored_x_keys = [x_key for x_key in x_keys if x_key != "imu_input"] + [IMU_ROWS_KEY, IMU_BUFFER_KEY]
+            training_x, training_y = load_mat_data(filename, stored_x_keys, y_keys)
+        else:
+            training_x, training_y = load_mat_data(filename, x_keys, y_keys)
+
+        imu_buffer = training_x.pop(IMU_BUFFER_KEY, None)
+        imu_rows = training_x.pop(IMU_ROWS_KEY, None)
+
+        # The .mat files may not keep the type of every array (e.g. of the two-dimensional ones), so they are cast back
+        # to the dataset precision, which is also the type of the tensors of the tensorflow datasets
+        training_x = {key: value.astype(self.precision, copy=False) for key, value in training_x.items()}
+        training_y = {key: value.astype(self.precision, copy=False) for key, value in training_y.items()}
+
+        if imu_buffer is not None:
+            imu_buffer = imu_buffer.astype(self.precision, copy=False)
+            # The rows stand for the imu windows until these are gathered from the buffer, so they are split along with
+            # the rest of the dataset
+            training_x["imu_input"] = imu_rows.ravel().astype(np.int64)
 
         # TODO: find more elegant way to chose the tensor to normalize?
         if normalize:
             file = open(self.training_dir + self.scaler_dir_file, "r")
             scaler_dir = file.read()
 
-            scale_g = joblib.load(scaler_dir + self.scaler_gyro_file)
-            scale_a = joblib.load(scaler_dir + self.scaler_acc_file)
+            scale_g = StreamingScaler.load(scaler_dir + self.scaler_gyro_file)
+            scale_a = StreamingScaler.load(scaler_dir + self.scaler_acc_file)
 
-            imu_tensor = training_x["imu_input"]
+            if imu_buffer is not None:
+                # The windows are views of the rows of the buffer, so the buffer is scaled instead
+                imu_buffer[:, 0:3] = scale_g.transform(imu_buffer[:, 0:3])
+                imu_buffer[:, 3:6] = scale_a.transform(imu_buffer[:, 3:6])
+            else:
+                imu_tensor = training_x["imu_input"]
 
-            for i in range(args[0]):
-                imu_tensor[:, i, 0:3, 0] = scale_g.transform(imu_tensor[:, i, 0:3, 0])
-                imu_tensor[:, i, 3:6, 0] = scale_a.transform(imu_tensor[:, i, 3:6, 0])
+                # The scalers work element-wise on the last axis, so all the window positions are scaled at once
+                imu_tensor[:, :, 0:3, 0] = scale_g.transform(imu_tensor[:, :, 0:3, 0])
+                imu_tensor[:, :, 3:6, 0] = scale_a.transform(imu_tensor[:, :, 3:6, 0])
 
-            training_x["imu_input"] = imu_tensor
+                training_x["imu_input"] = imu_tensor
 
         # Compute main dataset and validation dataset lengths
         y_sample = list(training_y.values())[0]
@@ -203,6 +609,11 @@ class DatasetManager:
         else:
             val_ds_indexes = range(total_ds_len - val_ds_len, total_ds_len)
 
+        if tensorflow_format and training and self.random_stride and self.window_stride > 1:
+            return self.generate_random_stride_tf_ds(training_x, training_y, imu_buffer, window_len, val_ds_indexes,
+                                                     validation_split, shuffle, batch_size, full_batches,
+                                                     repeat_main_ds, seed)
+
         # Split the training dataset into training and validation
         validation_x = {}
         validation_y = {}
@@ -214,6 +625,10 @@ class DatasetManager:
             validation_y[y_key] = training_y[y_key][val_ds_indexes]
             training_y[y_key] = np.delete(training_y[y_key], val_ds_indexes, axis=0)
 
+        if imu_buffer is not None:
+            training_x["imu_input"] = gather_imu_windows(imu_buffer, training_x["imu_input"], window_len)
+            validation_x["imu_input"] = gather_imu_windows(imu_buffer, validation_x["imu_input"], window_len)
+
         # If data is not to be transformed to tensorflow dataset, return
         if not tensorflow_format:
             # TODO: shuffle if requested
@@ -243,3 +658,85 @@ class DatasetManager:
             return main_ds, val_ds, (main_ds_len, val_ds_len)
         else:
             return main_ds, main_ds_len
+
+    def generate_random_stride_tf_ds(self, x_data, y_data, imu_buffer, window_len, val_ds_indexes, validation_split,
+                                     shuffle, batch_size, full_batches, repeat_main_ds, seed):
+        """
+        Generates the tensorflow training datasets of the random stride mode. The training windows are split in groups
+        of window_stride consecutive windows, and every pass over the main dataset takes one window of every group, at
+        a random offset. The main dataset only holds the indexes of the windows: once they are batched, the windows of
+        the batch (and their targets) are gathered from the numpy arrays, i.e. from the imu buffer or the memory-mapped
+        .npy files of the chunked mode. So the windows are never all copied, neither in memory nor into tensors. The
+        validation windows are taken at a fixed offset instead, so that the epochs are comparable
+
+        :param x_data: inputs of the dataset (training and validation). If imu_buffer is given, the imu input holds the
+        row of the buffer where every window starts
+        :param y_data: outputs of the dataset (training and validation)
+        :param imu_buffer: padded imu buffer of the windows, if the dataset was stored in compact form
+        :param window_len: number of imu samples of every window
+        :param val_ds_indexes: indexes of the validation windows
+        :param validation_split: whether a validation split should be generated
+        :param shuffle: whether to shuffle the dataset
+        :param batch_size: batch size of training and validation dataset
+        :param full_batches: whether to enforce same-sized batches in the dataset
+        :param repeat_main_ds: whether to repeat indefinitely the main generated dataset
+        :param seed: seed of the shuffling
+        :return: the requested datasets, as returned by `generate_tf_ds`
+        """
+
+        stride = self.window_stride
+        x_keys, y_keys = list(x_data), list(y_data)
+
+        def gather(ds, key, indexes):
+            if key == "imu_input" and imu_buffer is not None:
+                return gather_imu_windows(imu_buffer, ds[key][indexes], window_len)
+            return np.asarray(ds[key][indexes])
+
+        def gather_batch(indexes):
+            return [gather(x_data, x_key, indexes) for x_key in x_keys] + \
+                [gather(y_data, y_key, indexes) for y_key in y_keys]
+
+        total_ds_len = len(x_data[x_keys[0]])
+        main_indexes = np.delete(np.arange(total_ds_len), val_ds_indexes)
+        val_indexes = np.asarray(val_ds_indexes, dtype=np.int64)[::stride]
+
+        validation = gather_batch(val_indexes)
+        val_ds = tf.data.Dataset.from_tensor_slices((dict(zip(x_keys, validation[:len(x_keys)])),
+                                                     dict(zip(y_keys, validation[len(x_keys):]))))
+        val_ds_len = len(val_indexes)
+
+        # The shapes and types of the gathered tensors, which py_function does not know
+        batch_shapes = [(None, ) + np.shape(values)[1:] for values in validation]
+        batch_types = [tf.as_dtype(values.dtype) for values in validation]
+
+        n_main_windows = len(main_indexes)
+        main_ds_len = int(np.ceil(n_main_windows / stride))
+
+        def random_window(group):
+            group_len = tf.minimum(tf.constant(stride, tf.int64), n_main_windows - group * stride)
+            return group * stride + tf.random.uniform([], 0, group_len, dtype=tf.int64)
+
+        def gather_main_batch(positions):
+            tensors = tf.py_function(lambda p: gather_batch(main_indexes[p.numpy()]), [positions], batch_types)
+            for tensor, shape in zip(tensors, batch_shapes):
+                tensor.set_shape(shape)
+            return dict(zip(x_keys, tensors[:len(x_keys)])), dict(zip(y_keys, tensors[len(x_keys):]))
+
+        main_ds = tf.data.Dataset.range(main_ds_len).map(random_window)
+
+        # Shuffle dataset if requested
+        if shuffle:
+            main_ds = main_ds.shuffle(batch_size, seed=seed)
+
+        # Batch dataset
+        main_ds = main_ds.batch(batch_size, drop_remainder=full_batches).map(gather_main_batch)
+        val_ds = val_ds.batch(batch_size, drop_remainder=full_batches)
+
+        # Repeat dataset if requested
+        if repeat_main_ds:
+            main_ds = main_ds.repeat()
+
+        if validation_split:
+            return main_ds, val_ds, (main_ds_len, val_ds_len)
+        else:
+            return main_ds, main_ds_len
@@ -1,45 +1,71 @@
-import subprocess
 import gflags
 import sys
-import csv
 import os
+import functools
+import itertools
 
 import numpy as np
+import pandas as pd
 
 from utils.directories import safe_mkdir_recursive
 from utils.algebra import correct_quaternion_flip
+from utils.kinematics import derive_kinematics
 from data.config.blackbird_flags import FLAGS
-from data.inertial_ABCs import IMU, GT, InertialDataset
-from data.utils.data_utils import get_file_from_url
+from data.inertial_ABCs import InertialDataset
+from data.utils.download_manager import DownloadManager
+from data.utils.rosbag_reader import RosbagReader
 
 
-class BBIMU(IMU):
-    def __init__(self):
-        super(BBIMU, self).__init__()
+# Columns of each field in the Blackbird poses file (the timestamp, in us, is always the first column)
+BLACKBIRD_GT_COLUMNS = {"pos": (1, 4), "att": (4, 8)}
 
-    def read(self, data):
-        gyro_indx = [14, 15, 16]
-        acc_indx = [19, 20, 21]
-        data = np.array(data)
-        self.timestamp = data[0].astype(np.float) / 1000
-        self.gyro = data[gyro_indx].astype(np.float)
-        self.acc = data[acc_indx].astype(np.float)
 
+def read_blackbird_sequence(ds_local_dir, data_file_name, gt_file_name, rosbag_topics, smoothing_window=None):
+    """
+    Parses the raw imu and ground truth data of a Blackbird sequence. The ground truth only provides poses, so the
+    velocity, angular velocity and acceleration are derived from them
 
-class BBGT(GT):
-    def __init__(self):
-        super(BBGT, self).__init__()
+    :param ds_local_dir: local directory of the sequence
+    :param data_file_name: name of the rosbag file with the imu data
+    :param gt_file_name: name of the csv file with the ground truth poses
+    :param rosbag_topics: imu topic(s) of the rosbag
+    :param smoothing_window: Savitzky-Golay window used to derive the ground truth kinematics (see `derive_kinematics`)
+    :return: the columnar imu and ground truth data, with the timestamps in ns (int64)
+    """
 
-    def read(self, data):
-        data = np.array(data)
-        data = data.astype(np.float)
-        self.timestamp = data[0]
-        self.pos = data[1:4]
-        self.att = data[4:8]
+    data_file_dir = "{0}{1}".format(ds_local_dir, data_file_name)
+    gt_file_dir = "{0}{1}".format(ds_local_dir, gt_file_name)
+
+    # Decode the IMU messages straight from the rosbag. The bag time is in ns, but the ground truth is in us
+    with RosbagReader(data_file_dir) as bag:
+        imu_msgs = bag.read_imu_messages(rosbag_topics)
+
+    raw_imu_data = {
+        "gyro": imu_msgs["angular_velocity"],
+        "acc": imu_msgs["linear_acceleration"],
+        "timestamp": imu_msgs["timestamp"]
+    }
+
+    poses = pd.read_csv(gt_file_dir, header=None, dtype=np.float64).to_numpy()
+    ground_truth_data = {field: np.ascontiguousarray(poses[:, start:end])
+                         for field, (start, end) in BLACKBIRD_GT_COLUMNS.items()}
+    ground_truth_data["timestamp"] = np.rint(poses[:, 0] * 1000).astype(np.int64)
+
+    ground_truth_data.update(derive_kinematics(poses[:, 0] * 1e-6, ground_truth_data["pos"],
+                                               ground_truth_data["att"], smoothing_window=smoothing_window))
+
+    return raw_imu_data, ground_truth_data
 
 
 class BlackbirdDSManager(InertialDataset):
-    def __init__(self, *args):
+    def __init__(self, *args, trajectory_name=None, yaw_type=None, max_speed=None):
+        """
+        :param args: flags to parse
+        :param trajectory_name: name of the trajectory of the sequence. Taken from the flags if not given
+        :param yaw_type: yaw type of the sequence. Taken from the flags if not given
+        :param max_speed: maximum speed of the sequence. Taken from the flags if not given
+        """
+
         super(BlackbirdDSManager, self).__init__()
 
         self.sampling_freq = 100
@@ -56,8 +82,6 @@ class BlackbirdDSManager(InertialDataset):
         # Inner pipeline variables
         self.gt_file_name = "poses.csv"
         self.data_file_name = "data.bag"
-        self.csv_imu_file_name = "data/_slash_blackbird_slash_imu.csv"
-        self.bag2csv_script = "./data/utils/convert_bag_to_csv.sh"
 
         self.blackbird_local_dir = './data/dataset/blackbird_dataset/'
         self.blackbird_url = 'http://blackbird-dataset.mit.edu/BlackbirdDatasetData'
@@ -69,6 +93,12 @@ class BlackbirdDSManager(InertialDataset):
             print('Usage: %s ARGS\\n%s' % (sys.argv[0], FLAGS))
             sys.exit(1)
 
+        self.trajectory_name = self.ds_flags.trajectory_name if trajectory_name is None else trajectory_name
+        self.yaw_type = self.ds_flags.yaw_type if yaw_type is None else yaw_type
+        self.max_speed = self.ds_flags.max_speed if max_speed is None else float(max_speed)
+
+        self.gt_smoothing_window = self.ds_flags.gt_smoothing_window or None
+
         self.ds_version = self.get_dataset_version()
         self.ds_local_dir = "{0}{1}/".format(self.blackbird_local_dir, self.ds_version)
 
@@ -91,15 +121,20 @@ class BlackbirdDSManager(InertialDataset):
         else:
             return "maxSpeed7p0"
 
-    def convert_to_csv(self, file_name):
-        print("\nTransforming bag file to csv...")
-        subprocess.call("./{0} {1} {2}".format(self.bag2csv_script, file_name, self.rosbag_topics), shell=True)
+    def get_dataset_version(self, trajectory_name=None, yaw_type=None, max_speed=None):
+        """
+        Gets the version (relative directory) of a Blackbird sequence. The parameters that are not given are those of
+        the sequence of this manager.
 
-    def get_dataset_version(self):
+        :param trajectory_name: name of the trajectory
+        :param yaw_type: yaw type of the flight
+        :param max_speed: maximum speed of the flight
+        :return: the dataset version
+        """
 
-        yaw_type = self.ds_flags.yaw_type
-        trajectory_name = self.ds_flags.trajectory_name
-        max_speed = self.ds_flags.max_speed
+        yaw_type = self.yaw_type if yaw_type is None else yaw_type
+        trajectory_name = self.trajectory_name if trajectory_name is None else trajectory_name
+        max_speed = self.max_speed if max_speed is None else max_speed
 
         assert yaw_type in self.valid_yaw_types
         assert trajectory_name in self.valid_trajectory_names
@@ -111,95 +146,139 @@ class BlackbirdDSManager(InertialDataset):
 
         return dataset_version
 
-    def download_blackbird_data(self):
-
-        safe_mkdir_recursive(self.ds_local_dir)
-        pose_file_dir = "{0}{1}".format(self.ds_local_dir, self.gt_file_name)
-        data_file_dir = "{0}{1}".format(self.ds_local_dir, self.data_file_name)
+    def get_sequence_files(self, trajectory_name=None, yaw_type=None, max_speed=None):
+        """
+        Gets the remote and local files of a Blackbird sequence. The parameters that are not given are those of the
+        sequence of this manager.
 
-        max_speed = self.encode_max_speed(self.ds_flags.max_speed)
+        :return: the local directory of the sequence, and the (url, local file) pairs of the ground truth and data files
+        """
 
-        # root url of github repo
-        root = "{0}/{1}/".format(self.blackbird_url, self.ds_version)
-        data_file = "{0}_{1}.bag".format(self.ds_flags.trajectory_name, max_speed)
-        poses_file = "{0}_{1}_poses.csv".format(self.ds_flags.trajectory_name, max_speed)
+        trajectory_name = self.trajectory_name if trajectory_name is None else trajectory_name
+        max_speed = self.max_speed if max_speed is None else max_speed
 
-        url = "{0}{1}".format(root, poses_file)
+        ds_version = self.get_dataset_version(trajectory_name, yaw_type, max_speed)
+        ds_local_dir = "{0}{1}/".format(self.blackbird_local_dir, ds_version)
+        root = "{0}/{1}/".format(self.blackbird_url, ds_version)
+        file_prefix = "{0}_{1}".format(trajectory_name, self.encode_max_speed(max_speed))
 
-        if not os.path.exists(pose_file_dir):
-            get_file_from_url(pose_file_dir, url)
-        else:
-            print("Ground truth data file already available")
+        poses_file = ("{0}{1}_poses.csv".format(root, file_prefix), ds_local_dir + self.gt_file_name)
+        data_file = ("{0}{1}.bag".format(root, file_prefix), ds_local_dir + self.data_file_name)
 
-        url = "{0}/{1}".format(root, data_file)
-        if not os.path.exists(data_file_dir):
-            get_file_from_url(data_file_dir, url)
-            self.convert_to_csv(data_file_dir)
+        return ds_local_dir, poses_file, data_file
 
-        else:
-            print("Sensor file already available")
+    def download_blackbird_data(self):
+        """
+        Downloads the sequence of this manager, if it is not available yet
+
+        :raises IOError: if the sequence could not be downloaded
+        """
+
+        errors = []
+        available = self.download_blackbird_grid([self.trajectory_name], [self.yaw_type], [self.max_speed],
+                                                 ingest=False, errors=errors)
+
+        if self.ds_local_dir not in available:
+            raise IOError("The sequence {0} could not be downloaded: {1}".format(self.ds_version, errors))
+
+    def download_blackbird_grid(self, trajectory_names, yaw_types, max_speeds, max_workers=4, ingest=True,
+                                errors=None):
+        """
+        Downloads every (trajectory, yaw type, max speed) combination of the given parameters concurrently. Files that
+        are already available are not downloaded again, and interrupted downloads are resumed. If `ingest` is set, each
+        sequence is parsed into the raw sequence cache as soon as its bag file lands, while the rest of the grid keeps
+        downloading. Combinations missing from the server are reported and skipped.
+
+        :param trajectory_names: list of trajectory names
+        :param yaw_types: list of yaw types
+        :param max_speeds: list of maximum speeds
+        :param max_workers: maximum number of concurrent downloads
+        :param ingest: whether to parse the downloaded sequences into the raw sequence cache
+        :param errors: if given, list where the errors of the failed downloads are appended
+        :return: the local directories of the sequences that are available
+        """
+
+        available = []
+
+        with DownloadManager(max_workers=max_workers) as downloader:
+            for trajectory_name, yaw_type, max_speed in itertools.product(trajectory_names, yaw_types, max_speeds):
+                ds_local_dir, poses_file, data_file = self.get_sequence_files(trajectory_name, yaw_type, max_speed)
+                safe_mkdir_recursive(ds_local_dir)
+                available.append(ds_local_dir)
+
+                poses_future = None
+                if not os.path.exists(poses_file[1]):
+                    poses_future = downloader.submit(*poses_file)
+                else:
+                    print("Ground truth data file already available: " + poses_file[1])
+
+                on_complete = None
+                if ingest:
+                    on_complete = functools.partial(self._ingest_sequence, ds_local_dir, poses_future)
+
+                if not os.path.exists(data_file[1]):
+                    downloader.submit(*data_file, on_complete=on_complete)
+                else:
+                    print("Sensor file already available: " + data_file[1])
+                    if on_complete is not None:
+                        downloader.submit_post(on_complete, data_file[1])
+
+            for error in downloader.wait():
+                print("Download failed: {0}".format(error))
+                if errors is not None:
+                    errors.append(error)
+
+        return [ds_dir for ds_dir in available if all(os.path.exists(ds_dir + file_name) for file_name in
+                                                      (self.gt_file_name, self.data_file_name))]
+
+    def _ingest_sequence(self, ds_local_dir, poses_future, _):
+        """
+        Parses a downloaded sequence into the raw sequence cache. Runs in the post-processing pool of the download
+        manager, so it does not touch the state of the dataset manager.
+
+        :param ds_local_dir: local directory of the sequence
+        :param poses_future: future of the ground truth file download, or None if it was already available
+        """
+
+        if poses_future is not None:
+            # Raises if the ground truth download failed
+            poses_future.result()
+
+        source_files = [ds_local_dir + file_name for file_name in (self.data_file_name, self.gt_file_name)]
+        read_params = {"gt_smoothing_window": self.gt_smoothing_window}
+        if self.raw_cache.load(source_files, read_params) is not None:
+            return
+
+        imu_data, gt_data = read_blackbird_sequence(ds_local_dir, self.data_file_name, self.gt_file_name,
+                                                    self.rosbag_topics, self.gt_smoothing_window)
+        self.store_raw_data(source_files, imu_data, gt_data, read_params)
+        print("Ingested " + ds_local_dir)
 
     def read_blackbird_data(self):
-        data_file_dir = "{0}{1}".format(self.ds_local_dir, self.csv_imu_file_name)
-        gt_file_dir = "{0}{1}".format(self.ds_local_dir, self.gt_file_name)
-
-        raw_imu_data = []
-        ground_truth_data = []
-
-        with open(data_file_dir, 'rt') as csv_file:
-            header_line = 1
-            csv_reader = csv.reader(csv_file, delimiter=',')
-
-            for row in csv_reader:
-                if header_line:
-                    header_line = 0
-                    continue
-
-                imu = BBIMU()
-                imu.read(row)
-                raw_imu_data.append(imu)
-
-        with open(gt_file_dir, 'rt') as csv_file:
-            csv_reader = csv.reader(csv_file, delimiter=',')
-            header_line = 1
-
-            gt_old = BBGT()
-
-            for row in csv_reader:
-
-                gt = BBGT()
-                gt.read(row)
-                ground_truth_data.append(gt)
-
-                if header_line:
-                    header_line = 0
-                    gt_old = gt
-                    continue
-
-                gt.integrate(gt_old)
-
-                gt_old = gt
-
-        self.imu_data = raw_imu_data
-        self.gt_data = ground_truth_data
+        self.imu_data, self.gt_data = read_blackbird_sequence(self.ds_local_dir, self.data_file_name,
+                                                              self.gt_file_name, self.rosbag_topics,
+                                                              self.gt_smoothing_window)
 
     def get_raw_ds(self):
 
         self.download_blackbird_data()
-        self.read_blackbird_data()
+
+        source_files = ["{0}{1}".format(self.ds_local_dir, data_file) for data_file in
+                        (self.data_file_name, self.gt_file_name)]
+
+        self.read_raw_data(source_files, self.read_blackbird_data, {"gt_smoothing_window": self.gt_smoothing_window})
+        self.regularize_timing()
         self.interpolate_ground_truth()
 
         # Cut away last 5% samples (noisy measurements)
-        self.imu_data = self.imu_data[0:int(np.ceil(0.95 * len(self.imu_data)))]
-        self.gt_data = self.gt_data[0:int(np.ceil(0.95 * len(self.gt_data)))]
+        self.keep_first_samples(0.95)
 
         return self.imu_data, self.gt_data
 
     def pre_process_data(self, gyro_scale_file, acc_scale_file):
         self.basic_preprocessing(gyro_scale_file, acc_scale_file, 10)
 
-        corrected_quaternion = correct_quaternion_flip(np.stack(self.gt_data[:, 2]))
-        for i in range(len(self.gt_data)):
-            self.gt_data[i, 2] = corrected_quaternion[i, :]
+        # Attitude quaternion columns (see GT_FIELDS)
+        self.gt_data[:, 6:10] = correct_quaternion_flip(self.gt_data[:, 6:10])
 
         return self.imu_data, self.gt_data
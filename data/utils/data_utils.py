@@ -1,18 +1,18 @@
 import os
-import sys
-import logging
-import requests
+import shutil
+import functools
 import scipy.io
 import numpy as np
-from matplotlib import pyplot as plt
 from scipy import signal
-from scipy.interpolate import interp1d
-from mpl_toolkits.axes_grid1 import ImageGrid
 
 from tensorflow.python.keras import datasets as k_ds
 from tensorflow.python.keras.utils import to_categorical
 from tensorflow.python.data import Dataset
 
+from data.utils.download_manager import DownloadManager
+
+INTERPOLATION_BLOCK_SIZE = 2 ** 14
+
 ############################################################################
 # EXAMPLE CLASS TO FETCH FILENAMES (AND OPTIONALLY LABELS) FROM DIRECTORIES#
 ############################################################################
@@ -48,22 +48,15 @@ def get_mnist_datasets(img_h, img_w, batch_s):
 
 
 def get_file_from_url(file_name, link):
-    with open(file_name, "wb") as f:
-        print("\nDownloading %s" % file_name)
-        response = requests.get(link, stream=True)
-        total_length = response.headers.get('content-length')
+    """
+    Downloads a single file. Interrupted downloads are resumed on the next call
 
-        if total_length is None:  # no content length header
-            f.write(response.content)
-        else:
-            dl = 0
-            total_length = int(total_length)
-            for data in response.iter_content(chunk_size=4096):
-                dl += len(data)
-                f.write(data)
-                done = int(50 * dl / total_length)
-                sys.stdout.write("\r[%s%s%s]" % ('=' * done, '>', ' ' * (50 - done - 1)))
-                sys.stdout.flush()
+    :param file_name: local directory of the downloaded file
+    :param link: url of the file
+    """
+
+    with DownloadManager(max_workers=1) as downloader:
+        downloader.download(link, file_name)
 
 
 def save_mat_data(x_data, y_data, file_name):
@@ -99,15 +92,16 @@ def load_mat_data(directory, x_keys, y_keys):
         y_data[y_key] = mat_data[y_key]
 
     # For some reason, two-dimensional is added extra dimensions during the saving process that need to be removed.
+    # Numeric arrays are loaded as they were saved (e.g. the imu buffer of the random stride mode)
     for x_key in x_keys:
-        if len(x_data[x_key].shape) == 2:
+        if len(x_data[x_key].shape) == 2 and x_data[x_key].dtype == object:
             aux = np.zeros(x_data[x_key].shape)
             for i in range(np.shape(aux)[0]):
                 for j in range(np.shape(aux)[1]):
                     aux[i][j] = x_data[x_key][i][j][0][0]
             x_data[x_key] = aux
     for y_key in y_keys:
-        if len(y_data[y_key].shape) == 2:
+        if len(y_data[y_key].shape) == 2 and y_data[y_key].dtype == object:
             aux = np.zeros(y_data[y_key].shape)
             for i in range(np.shape(aux)[0]):
                 for j in range(np.shape(aux)[1]):
@@ -123,95 +117,190 @@ def load_mat_data(directory, x_keys, y_keys):
     return x_data, y_data
 
 
-def interpolate_ts(ref_ts, target_ts, meas_vec, is_quaternion=False):
+def interpolation_brackets(ref_ts, target_ts):
     """
-    Interpolates a vector to different acquisition times, given the original acquisition times
+    Locates the target times inside the reference times. The result can be reused to interpolate any number of signals
+    sampled at `ref_ts`
+
+    :param ref_ts: reference timestamp vector (sorted)
+    :param target_ts: target timestamp vector (must be inside the limits of `ref_ts`)
+    :return: the index of the reference sample right before every target time, and the relative position of the target
+    time between that sample and the next one (between 0 and 1)
+    """
+
+    ref_ts = np.asarray(ref_ts)
+    target_ts = np.asarray(target_ts)
+
+    if len(target_ts) and (target_ts.min() < ref_ts[0] or target_ts.max() > ref_ts[-1]):
+        raise ValueError("The target timestamps must be inside the limits of the reference timestamps")
+
+    indices = np.clip(np.searchsorted(ref_ts, target_ts, side='right') - 1, 0, len(ref_ts) - 2)
+
+    t_0 = ref_ts[indices]
+    t_diff = ref_ts[indices + 1] - t_0
+    weights = np.divide(target_ts - t_0, t_diff, out=np.zeros(len(indices)), where=t_diff != 0)
+
+    return indices, weights
+
+
+def _sin_ratio(x):
+    """
+    :return: sin(x) / x, element-wise, with the limit value 1 at x = 0
+    """
+
+    return np.divide(np.sin(x), x, out=np.ones_like(x), where=x != 0)
+
+
+def slerp_terms(q_0, q_1):
+    """
+    Computes the terms of the spherical linear interpolation between two arrays of quaternions that don't depend on the
+    interpolation weights, so that they can be reused to interpolate at several weights
+
+    :param q_0: initial quaternions, shape <n, 4>
+    :param q_1: final quaternions, shape <n, 4>
+    :return: the normalized initial quaternions, the normalized final quaternions (sign-corrected so that the
+    interpolation follows the shortest path), the angle between them and the inverse of sin(angle) / angle
+    """
+
+    q_0 = q_0 / np.linalg.norm(q_0, axis=1, keepdims=True)
+    q_1 = q_1 / np.linalg.norm(q_1, axis=1, keepdims=True)
+
+    cos_theta = np.sum(q_0 * q_1, axis=1)
+    q_1 *= np.where(cos_theta < 0, -1.0, 1.0)[:, np.newaxis]
+
+    theta = np.arccos(np.minimum(np.abs(cos_theta), 1.0))
+
+    return q_0, q_1, theta, 1 / _sin_ratio(theta)
+
+
+def slerp(q_0, q_1, weights, terms=None):
+    """
+    Spherical linear interpolation between two arrays of quaternions, element-wise. The interpolation always follows the
+    shortest path, so it does not depend on the sign of the quaternions
+
+    :param q_0: initial quaternions, shape <n, 4>
+    :param q_1: final quaternions, shape <n, 4>
+    :param weights: interpolation weights (0: q_0, 1: q_1), shape <n>
+    :param terms: output of `slerp_terms(q_0, q_1)`, if already computed
+    :return: the interpolated unit quaternions, shape <n, 4>
+    """
+
+    q_0, q_1, theta, inv_sin_ratio = slerp_terms(q_0, q_1) if terms is None else terms
+
+    # sin((1 - w) * theta) / sin(theta) and sin(w * theta) / sin(theta), written with sin(x) / x so that they converge
+    # to the linear interpolation weights when theta tends to 0
+    w_0 = (1 - weights) * _sin_ratio((1 - weights) * theta) * inv_sin_ratio
+    w_1 = weights * _sin_ratio(weights * theta) * inv_sin_ratio
+
+    return w_0[:, np.newaxis] * q_0 + w_1[:, np.newaxis] * q_1
+
+
+def interpolate_ts(ref_ts, target_ts, meas_vec, is_quaternion=False, brackets=None):
+    """
+    Interpolates a vector (or several channels at once) to different acquisition times, given the original acquisition
+    times. Quaternions are interpolated with SLERP, the rest of signals linearly
 
     :param ref_ts: reference timestamp vector
     :param target_ts: target timestamp vector (must be inside the limits of `ref_ts`)
-    :param meas_vec: vector to be interpolated
+    :param meas_vec: vector to be interpolated, with the samples in the first dimension and the channels in the second
     :param is_quaternion: whether the vector is a quaternion or not
+    :param brackets: output of `interpolation_brackets(ref_ts, target_ts)`, if already computed
     :return: the interpolated vector `meas_vec` at times `target_ts`
     """
 
-    if is_quaternion:
-        logging.warning("Quaternion SLERP not implemented yet. A quaternion vector was interpolated using the euclidean"
-                        " method, which may yield an incorrect result!")
-        # TODO: implement SLERP!
+    indices, weights = interpolation_brackets(ref_ts, target_ts) if brackets is None else brackets
+    meas_vec = np.asarray(meas_vec, dtype=np.float64)
 
-    _, d = np.shape(meas_vec)
+    interp_vec = np.empty((len(indices),) + meas_vec.shape[1:])
 
-    # Generate interpolating functions for each component of the vector
-    interp_fx = [None for _ in range(d)]
-    for i in range(d):
-        interp_fx[i] = interp1d(ref_ts, meas_vec[:, i])
+    if is_quaternion:
+        # The slerp terms only depend on the reference samples, so they are computed once per reference interval
+        terms = slerp_terms(meas_vec[:-1], meas_vec[1:])
+    else:
+        slopes = np.diff(meas_vec, axis=0)
 
-    # Initialize array of interpolated Ground Truth velocities
-    interp_vec = np.zeros((len(target_ts), d))
+    # Interpolate in blocks, to keep the temporary arrays small on long sequences
+    for start in range(0, len(indices), INTERPOLATION_BLOCK_SIZE):
+        block = slice(start, start + INTERPOLATION_BLOCK_SIZE)
+        block_indices = indices[block]
+        w = weights[block]
 
-    # Fill in array
-    for i, imu_timestamp in enumerate(target_ts):
-        interp_vec[i, :] = np.array([interp_fx[j](imu_timestamp) for j in range(d)])
+        if is_quaternion:
+            interp_vec[block] = slerp(None, None, w, [np.take(term, block_indices, axis=0) for term in terms])
+        else:
+            block_interp = np.take(slopes, block_indices, axis=0)
+            block_interp *= w.reshape((-1,) + (1,) * (meas_vec.ndim - 1))
+            block_interp += np.take(meas_vec, block_indices, axis=0)
+            interp_vec[block] = block_interp
 
     return interp_vec
 
 
-def filter_with_coeffs(a, b, time_series, sampling_f=None, plot_stft=False):
+def increasing_samples(timestamps):
     """
-    Applies a digital filter along a signal using the filter coefficients a, b
+    Finds the samples of a time series that are later than all the previous ones
 
-    :param a: array of filter coefficients a
-    :param b: array of filter coefficients b
-    :param time_series: signal to filter
-    :param sampling_f: sampling frequency of signal
-    :param plot_stft: whether to plot the STFT
-    :return:
+    :param timestamps: timestamp vector
+    :return: boolean mask that drops the duplicated and out-of-order samples
     """
 
-    filtered_signal = signal.lfilter(b, a, time_series, axis=0)
-    if plot_stft:
-        assert sampling_f is not None, "A sampling frequency must be specified to plot the STFT"
-        figure = plt.figure()
-        figure.tight_layout()
-        time_series_dim = time_series.shape[1]
+    timestamps = np.asarray(timestamps)
+    keep = np.ones(len(timestamps), dtype=bool)
+    if len(timestamps) > 1:
+        keep[1:] = timestamps[1:] > np.maximum.accumulate(timestamps)[:-1]
+    return keep
 
-        grid1 = ImageGrid(figure, 111, nrows_ncols=(2, time_series_dim), axes_pad=0.15, share_all=True,
-                          cbar_location="right", cbar_mode="single", cbar_size="7%", cbar_pad=0.15, aspect=False)
-        axes = grid1.axes_all
 
-        stft = []
-        t = f = None
-        for i in range(time_series_dim):
-            f, t, stft1 = signal.stft(time_series[:, i], sampling_f)
-            f, t, stft2 = signal.stft(filtered_signal[:, i], sampling_f)
+def uniform_grid(start, end, period):
+    """
+    :param start: first time of the grid (int)
+    :param end: upper limit of the grid (int)
+    :param period: time between two consecutive grid points (int)
+    :return: the int64 times start, start + period, ... up to end (included)
+    """
 
-            stft.append(np.log(np.abs(stft1)))
-            stft.append(np.log(np.abs(stft2)))
+    return start + period * np.arange((end - start) // period + 1, dtype=np.int64)
 
-        vmax = np.amax(stft)
-        vmin = np.amin(stft)
-        im = None
-        for i in range(time_series_dim):
-            ax = axes[i]
-            ax.pcolormesh(t, f, stft[i * 2], vmin=vmin, vmax=vmax)
-            if i == 0:
-                ax.set_ylabel('Frequency [Hz] Raw')
 
-            ax = axes[i + time_series_dim]
+@functools.lru_cache(maxsize=32)
+def butterworth_sos(sampling_f, cutoff_f, order):
+    """
+    Designs a low-pass Butterworth filter in second-order sections. The designs are cached, so that repeated calls with
+    the same parameters skip the design step
+
+    :param sampling_f: sampling frequency of the signal to filter (Hz)
+    :param cutoff_f: cutoff frequency of the filter (Hz)
+    :param order: order of the filter
+    :return: the second-order sections of the filter, shape <n_sections, 6>. The array is shared by all the callers, so
+    it must not be modified
+    """
 
-            im = ax.pcolormesh(t, f, stft[i * 2 + 1], vmin=vmin, vmax=vmax)
-            if i == 0:
-                ax.set_ylabel('Frequency [Hz] Filtered')
-            ax.set_xlabel('Time [sec]')
+    return signal.butter(order, cutoff_f / (sampling_f / 2), output='sos')
 
-        grid1.cbar_axes[0].colorbar(im)
 
-        return filtered_signal, figure
+def filter_with_sos(sos, time_series, zero_phase=False, zi=None):
+    """
+    Applies a digital filter in second-order sections along a (multi-channel) signal, for all the channels at once
+
+    :param sos: second-order sections of the filter
+    :param time_series: signal to filter, with the samples in the first dimension
+    :param zero_phase: whether to filter the signal forward and backward, which cancels the phase delay of the filter
+    (and squares its magnitude response)
+    :param zi: initial state of the (causal) filter, shape <n_sections, 2, n_channels>. Used to filter a long signal
+    chunk by chunk, by passing the final state of each chunk as initial state of the next one
+    :return: the filtered signal, and the final state of the filter if `zi` is given
+    """
 
-    return filtered_signal
+    if zero_phase:
+        assert zi is None, "The zero-phase filter cannot be applied chunk by chunk"
+        return signal.sosfiltfilt(sos, time_series, axis=0)
+    if zi is not None:
+        return signal.sosfilt(sos, time_series, axis=0, zi=zi)
+    return signal.sosfilt(sos, time_series, axis=0)
 
 
-def save_train_and_test_datasets(train_ds_node, test_ds_node, x_data, y_data, test_split, random_split):
+def save_train_and_test_datasets(train_ds_node, test_ds_node, x_data, y_data, test_split, random_split,
+                                 shared_data=None):
     """
     Saves a copy of the train & test datasets as a mat file in a specified file names
 
@@ -221,6 +310,7 @@ def save_train_and_test_datasets(train_ds_node, test_ds_node, x_data, y_data, te
     :param y_data: y data (samples in first dimension)
     :param test_split: the percentage of dataset to be split for testing
     :param random_split: whether datasets should be randomly split
+    :param shared_data: extra entries that are not split, but saved whole in both datasets
     """
     if os.path.exists(train_ds_node):
         os.remove(train_ds_node)
@@ -252,7 +342,101 @@ def save_train_and_test_datasets(train_ds_node, test_ds_node, x_data, y_data, te
         test_set_y[key] = y_data[key][test_indexes]
         y_data[key] = np.delete(y_data[key], test_indexes, axis=0)
 
+    if shared_data is not None:
+        x_data.update(shared_data)
+        test_set_x.update(shared_data)
+
     print("Saving datasets... ", end='')
     save_mat_data(x_data, y_data, train_ds_node)
     save_mat_data(test_set_x, test_set_y, test_ds_node)
     print("Done.")
+
+
+def npy_ds_directory(ds_node):
+    """
+    :param ds_node: dataset file name <dir/file.mat>
+    :return: the directory where the dataset is stored in .npy format instead <dir/file/>
+    """
+
+    return os.path.splitext(ds_node)[0] + '/'
+
+
+def save_train_and_test_chunks(train_ds_node, test_ds_node, chunks, test_split, random_split):
+    """
+    Splits a dataset stored in chunks into train & test datasets, without loading it in memory. Every entry of the
+    datasets is saved as a .npy file (see `npy_ds_directory`)
+
+    :param train_ds_node: Training ds file name <dir/file.mat>
+    :param test_ds_node: Test ds file name <dir/file.mat>
+    :param chunks: list of (x files, y files) pairs, with the dictionaries of key -> .npy file of every chunk of the
+    dataset (samples in first dimension), in order
+    :param test_split: the percentage of dataset to be split for testing
+    :param random_split: whether datasets should be randomly split
+    """
+
+    chunk_lengths = [len(np.load(next(iter(x_files.values())), mmap_mode='r')) for x_files, _ in chunks]
+    total_ds_len = int(np.sum(chunk_lengths))
+    test_ds_len = int(np.ceil(total_ds_len * test_split))
+
+    # Choose some entries to separate for the test set
+    if random_split:
+        test_indexes = np.random.choice(total_ds_len, test_ds_len, replace=False)
+    else:
+        test_indexes = range(total_ds_len - test_ds_len, total_ds_len)
+
+    # Position of every entry in its dataset. The train entries keep their order, and the test ones are in the order of
+    # `test_indexes` (as in `save_train_and_test_datasets`)
+    is_test = np.zeros(total_ds_len, dtype=bool)
+    is_test[test_indexes] = True
+    ds_positions = np.empty(total_ds_len, dtype=np.int64)
+    ds_positions[~is_test] = np.arange(total_ds_len - test_ds_len)
+    ds_positions[test_indexes] = np.arange(test_ds_len)
+
+    print("Saving datasets... ", end='')
+
+    split_files = {}
+    for ds_node, split_len in ((train_ds_node, total_ds_len - test_ds_len), (test_ds_node, test_ds_len)):
+        ds_dir = npy_ds_directory(ds_node)
+        shutil.rmtree(ds_dir, ignore_errors=True)
+        os.makedirs(ds_dir)
+
+        split_files[ds_node] = {}
+        for key, file in {**chunks[0][0], **chunks[0][1]}.items():
+            sample = np.load(file, mmap_mode='r')
+            split_files[ds_node][key] = np.lib.format.open_memmap(
+                ds_dir + key + '.npy', mode='w+', dtype=sample.dtype, shape=(split_len,) + sample.shape[1:])
+
+    # Copy the entries of every chunk to their positions in the train or test dataset
+    chunk_start = 0
+    for (x_files, y_files), chunk_len in zip(chunks, chunk_lengths):
+        chunk_is_test = is_test[chunk_start:chunk_start + chunk_len]
+        chunk_positions = ds_positions[chunk_start:chunk_start + chunk_len]
+        for ds_node, mask in ((train_ds_node, ~chunk_is_test), (test_ds_node, chunk_is_test)):
+            for key, file in {**x_files, **y_files}.items():
+                split_files[ds_node][key][chunk_positions[mask]] = np.load(file, mmap_mode='r')[mask]
+        chunk_start += chunk_len
+
+    for ds_files in split_files.values():
+        for ds_file in ds_files.values():
+            ds_file.flush()
+
+    print("Done.")
+
+
+def load_npy_data(directory, x_keys, y_keys):
+    """
+    Loads a dataset saved with the save_train_and_test_chunks function. The entries are memory-mapped copy-on-write, so
+    only the parts that are read (or modified) are loaded in memory
+
+    :param directory: dataset file name <dir/file.mat> (see `npy_ds_directory`)
+    :param x_keys: dictionary keys from where to retrieve the x data
+    :param y_keys: dictionary keys from where to retrieve the y data
+    :return: the x and y data dictionaries, as they were generated by the data generator
+    """
+
+    ds_dir = npy_ds_directory(directory)
+
+    x_data = {x_key: np.load(ds_dir + x_key + '.npy', mmap_mode='c') for x_key in x_keys}
+    y_data = {y_key: np.load(ds_dir + y_key + '.npy', mmap_mode='c') for y_key in y_keys}
+
+    return x_data, y_data
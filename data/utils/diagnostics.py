@@ -0,0 +1,141 @@
+import os
+import atexit
+import threading
+import multiprocessing
+import numpy as np
+
+from scipy import signal
+from concurrent.futures import ProcessPoolExecutor, wait
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from mpl_toolkits.axes_grid1 import ImageGrid
+
+from utils.directories import safe_mkdir_recursive
+
+
+# Directory (within the dataset directory) where the diagnostic figures are saved
+DIAGNOSTICS_DIR = "diagnostics/"
+
+# Number of processes rendering the diagnostic figures
+DIAGNOSTICS_WORKERS = 2
+
+
+def filter_stft(raw_signal, filtered_signal, sampling_f):
+    """
+    Computes the log-magnitude STFT of every channel of a signal, before and after filtering it, in a single batched
+    call for all the channels
+
+    :param raw_signal: raw signal, with the samples in the first dimension and the channels in the second one
+    :param filtered_signal: filtered signal, with the same shape
+    :param sampling_f: sampling frequency of the signal
+    :return: dictionary with the frequencies ("frequencies") and segment times ("times") of the STFT, and the
+    log-magnitude STFTs of the raw ("raw") and filtered ("filtered") channels, of shape <channels, frequencies, times>
+    """
+
+    n_channels = raw_signal.shape[1]
+    f, t, stft = signal.stft(np.concatenate((raw_signal, filtered_signal), axis=1).T, sampling_f, axis=-1)
+
+    # Exact zeros (e.g. of constant channels) would go to -inf and break the color scale of the figures
+    log_stft = np.log(np.maximum(np.abs(stft), np.finfo(np.float32).tiny)).astype(np.float32)
+
+    return {"frequencies": f, "times": t, "raw": log_stft[:n_channels], "filtered": log_stft[n_channels:]}
+
+
+def render_filter_stft(file_name, stft, title, channel_names):
+    """
+    Renders the STFT of the channels of a signal, before (top row) and after (bottom row) filtering it, and saves the
+    figure. The figure is drawn on an Agg canvas, so it needs no display and can be rendered in any process
+
+    :param file_name: directory of the image file
+    :param stft: STFT of the signal, as returned by `filter_stft`
+    :param title: title of the figure
+    :param channel_names: names of the channels, used as column titles
+    """
+
+    figure = Figure()
+    FigureCanvasAgg(figure)
+    n_channels = len(stft["raw"])
+
+    grid = ImageGrid(figure, 111, nrows_ncols=(2, n_channels), axes_pad=0.15, share_all=True,
+                     cbar_location="right", cbar_mode="single", cbar_size="7%", cbar_pad=0.15, aspect=False)
+    axes = grid.axes_all
+
+    vmin = min(np.amin(stft["raw"]), np.amin(stft["filtered"]))
+    vmax = max(np.amax(stft["raw"]), np.amax(stft["filtered"]))
+    t, f = stft["times"], stft["frequencies"]
+
+    im = None
+    for i in range(n_channels):
+        ax = axes[i]
+        ax.pcolormesh(t, f, stft["raw"][i], vmin=vmin, vmax=vmax, shading='auto')
+        ax.set_title(channel_names[i])
+        if i == 0:
+            ax.set_ylabel('Frequency [Hz] Raw')
+
+        ax = axes[i + n_channels]
+        im = ax.pcolormesh(t, f, stft["filtered"][i], vmin=vmin, vmax=vmax, shading='auto')
+        if i == 0:
+            ax.set_ylabel('Frequency [Hz] Filtered')
+        ax.set_xlabel('Time [sec]')
+
+    grid.cbar_axes[0].colorbar(im)
+    figure.suptitle(title)
+
+    safe_mkdir_recursive(os.path.dirname(file_name))
+    figure.savefig(file_name)
+
+
+class DiagnosticsRenderer:
+    def __init__(self, max_workers=DIAGNOSTICS_WORKERS):
+        """
+        Renders diagnostic figures in a pool of background processes, so that drawing them does not block the
+        generation of the dataset. The pool is only started with the first figure
+
+        :param max_workers: number of rendering processes
+        """
+
+        self.max_workers = max_workers
+        self.executor = None
+        self.futures = []
+        self.lock = threading.Lock()
+
+    def submit(self, render_func, *args):
+        """
+        Renders a figure in the background
+
+        :param render_func: function that draws and saves the figure (must be picklable, i.e. a module function)
+        :param args: arguments of the function
+        :return: the future of the rendering task
+        """
+
+        with self.lock:
+            if self.executor is None:
+                # Spawn the workers instead of forking the (multi-threaded) process that generates the dataset
+                self.executor = ProcessPoolExecutor(max_workers=self.max_workers,
+                                                    mp_context=multiprocessing.get_context("spawn"))
+            future = self.executor.submit(render_func, *args)
+            self.futures = [f for f in self.futures if not f.done()] + [future]
+        return future
+
+    def wait(self):
+        """
+        Waits until all the submitted figures are rendered, and raises the first rendering error, if any
+        """
+
+        with self.lock:
+            futures = self.futures
+            self.futures = []
+        wait(futures)
+        for future in futures:
+            future.result()
+
+    def shutdown(self):
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+
+# Renderer shared by all the datasets. The pending figures are finished before the interpreter exits
+diagnostics_renderer = DiagnosticsRenderer()
+atexit.register(diagnostics_renderer.shutdown)
@@ -0,0 +1,204 @@
+import os
+import time
+import hashlib
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor, wait
+
+
+PARTIAL_FILE_SUFFIX = ".part"
+CHECKSUM_FILE_SUFFIX = ".sha256"
+
+MIN_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 8 * 1024 ** 2
+
+# The chunk size is doubled when a chunk arrives faster than the lower bound, and halved when slower than the upper one
+CHUNK_TIME_BOUNDS = (0.05, 0.5)
+
+
+def partial_file_digest(file_name):
+    """
+    :param file_name: directory of a (possibly partially downloaded) file
+    :return: a sha256 hash object updated with the contents of the file
+    """
+
+    sha = hashlib.sha256()
+    with open(file_name, "rb") as f:
+        for block in iter(lambda: f.read(MAX_CHUNK_SIZE), b""):
+            sha.update(block)
+    return sha
+
+
+class DownloadManager:
+    def __init__(self, max_workers=4, max_post_workers=1, timeout=30):
+        """
+        Downloads files concurrently through a bounded pool of HTTP connections. Interrupted downloads are resumed with
+        HTTP Range requests, every file is checksummed while it is written, and files only appear at their final path
+        (by atomic rename) once they are complete.
+
+        :param max_workers: maximum number of concurrent downloads (and open connections)
+        :param max_post_workers: maximum number of concurrent post-processing tasks (see `submit`)
+        :param timeout: connection and read timeout of the requests, in seconds
+        """
+
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers, max_retries=3)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self.download_executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.post_executor = ThreadPoolExecutor(max_workers=max_post_workers)
+        self.futures = []
+        self.futures_lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def close(self):
+        self.download_executor.shutdown(wait=True)
+        self.post_executor.shutdown(wait=True)
+        self.session.close()
+
+    def download(self, url, file_name, expected_sha256=None):
+        """
+        Downloads a file, resuming the partial download of a previous attempt if there is one
+
+        :param url: url of the file
+        :param file_name: local directory of the downloaded file
+        :param expected_sha256: if given, the download fails if the sha256 of the file does not match it
+        :return: the sha256 hex digest of the downloaded file
+        """
+
+        part_file = file_name + PARTIAL_FILE_SUFFIX
+        downloaded = os.path.getsize(part_file) if os.path.exists(part_file) else 0
+
+        # Ask for the raw bytes, so that the received length can be checked against the content length
+        headers = {"Accept-Encoding": "identity"}
+        if downloaded:
+            headers["Range"] = "bytes={0}-".format(downloaded)
+        response = self.session.get(url, headers=headers, stream=True, timeout=self.timeout)
+
+        with response:
+            if response.status_code == 416:
+                # The partial file already holds the whole remote file
+                total_length = downloaded
+                sha = partial_file_digest(part_file)
+            else:
+                response.raise_for_status()
+
+                if response.status_code == 206:
+                    sha = partial_file_digest(part_file)
+                    mode = "ab"
+                else:
+                    # The server ignored the range request (or there was nothing to resume): start from scratch
+                    sha = hashlib.sha256()
+                    downloaded = 0
+                    mode = "wb"
+
+                content_length = response.headers.get("content-length")
+                total_length = downloaded + int(content_length) if content_length is not None else None
+
+                with open(part_file, mode) as f:
+                    downloaded = self._write_chunks(response, f, sha, downloaded)
+                    f.flush()
+                    os.fsync(f.fileno())
+
+        if total_length is not None and downloaded != total_length:
+            raise IOError("Download of {0} incomplete: got {1} of {2} bytes. Call again to resume it".format(
+                url, downloaded, total_length))
+
+        digest = sha.hexdigest()
+        if expected_sha256 is not None and digest != expected_sha256:
+            os.remove(part_file)
+            raise IOError("Checksum mismatch for {0}: expected {1}, got {2}".format(url, expected_sha256, digest))
+
+        with open(file_name + CHECKSUM_FILE_SUFFIX, "w") as f:
+            f.write(digest)
+        os.replace(part_file, file_name)
+
+        print("Downloaded {0} ({1:.1f} MB)".format(file_name, downloaded / 1024 ** 2))
+        return digest
+
+    @staticmethod
+    def _write_chunks(response, file, sha, downloaded):
+        """
+        Streams the response body to a file, adapting the chunk size to the download speed
+
+        :return: the total number of bytes in the file
+        """
+
+        chunk_size = MIN_CHUNK_SIZE
+        while True:
+            start = time.time()
+            chunk = response.raw.read(chunk_size, decode_content=True)
+            if not chunk:
+                return downloaded
+            elapsed = time.time() - start
+
+            file.write(chunk)
+            sha.update(chunk)
+            downloaded += len(chunk)
+
+            if elapsed < CHUNK_TIME_BOUNDS[0] and len(chunk) == chunk_size:
+                chunk_size = min(chunk_size * 2, MAX_CHUNK_SIZE)
+            elif elapsed > CHUNK_TIME_BOUNDS[1]:
+                chunk_size = max(chunk_size // 2, MIN_CHUNK_SIZE)
+
+    def submit(self, url, file_name, on_complete=None, expected_sha256=None):
+        """
+        Schedules the download of a file
+
+        :param url: url of the file
+        :param file_name: local directory of the downloaded file
+        :param on_complete: optional function, called with `file_name` as soon as the file is downloaded. It runs in a
+        separate pool, so that it does not hold a download slot
+        :param expected_sha256: if given, the download fails if the sha256 of the file does not match it
+        :return: the future of the download
+        """
+
+        def download_task():
+            digest = self.download(url, file_name, expected_sha256)
+            if on_complete is not None:
+                self._track(self.post_executor.submit(on_complete, file_name))
+            return digest
+
+        return self._track(self.download_executor.submit(download_task))
+
+    def submit_post(self, func, *args):
+        """
+        Schedules a post-processing task directly, e.g. for a file that was already downloaded
+
+        :param func: function to run in the post-processing pool
+        :param args: arguments of the function
+        :return: the future of the task
+        """
+
+        return self._track(self.post_executor.submit(func, *args))
+
+    def _track(self, future):
+        with self.futures_lock:
+            self.futures.append(future)
+        return future
+
+    def wait(self):
+        """
+        Waits until all the scheduled downloads and their post-processing tasks are finished
+
+        :return: the list of exceptions raised by the failed tasks
+        """
+
+        errors = []
+        pending = True
+        while pending:
+            with self.futures_lock:
+                futures, self.futures = self.futures, []
+            pending = bool(futures)
+            wait(futures)
+            errors += [future.exception() for future in futures if future.exception() is not None]
+        return errors
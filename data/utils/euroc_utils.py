@@ -1,42 +1,46 @@
-import csv
 import yaml
 import numpy as np
+import pandas as pd
 import gflags
 import sys
 
-from data.inertial_ABCs import IMU, GT, InertialDataset
+from data.inertial_ABCs import InertialDataset
 from data.config.euroc_flags import FLAGS
+from data.utils.resampling import parse_oversampled_regions
 
 
-class EurocIMU(IMU):
-    def __init__(self):
-        super(EurocIMU, self).__init__()
+# Column ranges of each field in the EuRoC csv files (the timestamp is always the first column)
+EUROC_IMU_COLUMNS = {"gyro": (1, 4), "acc": (4, 7)}
+EUROC_GT_COLUMNS = {"pos": (1, 4), "att": (4, 8), "vel": (8, 11), "ang_vel": (11, 14), "acc": (14, 17)}
 
-    def read(self, data):
-        data = np.array(data)
-        data = data.astype(np.float)
-        self.timestamp = data[0]
-        self.gyro = data[1:4]
-        self.acc = data[4:7]
 
+def read_euroc_csv(file_name, field_columns):
+    """
+    Reads a EuRoC csv file in bulk into columnar format
 
-class EurocGT(GT):
-    def __init__(self):
-        super(EurocGT, self).__init__()
+    :param file_name: directory of the csv file
+    :param field_columns: dictionary of field name -> (first column, last column + 1) in the csv file
+    :return: dictionary with one contiguous array per field. The timestamp is stored as int64 (ns), the rest as float64
+    """
 
-    def read(self, data):
-        data = np.array(data)
-        data = data.astype(np.float)
-        self.timestamp = data[0]
-        self.pos = data[1:4]
-        self.att = data[4:8]
-        self.vel = data[8:11]
-        self.ang_vel = data[11:14]
-        self.acc = data[14:17]
+    frame = pd.read_csv(file_name, header=None, skiprows=1, dtype={0: np.int64})
+
+    data = frame.iloc[:, 1:].to_numpy(dtype=np.float64)
+    columns = {field: np.ascontiguousarray(data[:, start - 1:end - 1]) for field, (start, end) in field_columns.items()}
+    columns["timestamp"] = frame.iloc[:, 0].to_numpy(dtype=np.int64)
+
+    return columns
 
 
 class EurocDSManager(InertialDataset):
-    def __init__(self, *args):
+    def __init__(self, *args, dataset_version=None, oversampled_regions=None):
+        """
+        :param args: flags to parse
+        :param dataset_version: version (flight) of the EuRoC dataset. Taken from the flags if not given
+        :param oversampled_regions: spec of the oversampled regions of the flight (see `parse_oversampled_regions`).
+        Taken from the flags if not given
+        """
+
         super(EurocDSManager, self).__init__()
 
         self.sampling_freq = 200
@@ -55,7 +59,12 @@ class EurocDSManager(InertialDataset):
 
         self.euroc_local_dir = './data/dataset/EuRoC_dataset/'
 
-        self.ds_local_dir = "{0}{1}/".format(self.euroc_local_dir, self.ds_flags.dataset_version)
+        self.dataset_version = self.ds_flags.dataset_version if dataset_version is None else dataset_version
+        self.ds_local_dir = "{0}{1}/".format(self.euroc_local_dir, self.dataset_version)
+
+        # Flat regions are oversampled, so that the model does not learn to predict the average value
+        self.oversampled_regions = parse_oversampled_regions(
+            self.ds_flags.oversampled_regions if oversampled_regions is None else oversampled_regions)
 
     def read_euroc_data(self):
 
@@ -64,41 +73,19 @@ class EurocDSManager(InertialDataset):
         ground_truth_file = "{0}{1}".format(self.ds_local_dir, self.gt_data_file)
 
         imu_yaml_data = dict()
-        raw_imu_data = []
-        ground_truth_data = []
+        raw_imu_data = None
+        ground_truth_data = None
 
         try:
             # Read IMU data
-            with open(imu_file, 'rt') as csv_file:
-                header_line = 1
-                csv_reader = csv.reader(csv_file, delimiter=',')
-
-                for row in csv_reader:
-                    if header_line:
-                        header_line = 0
-                        continue
-
-                    imu = EurocIMU()
-                    imu.read(row)
-                    raw_imu_data.append(imu)
+            raw_imu_data = read_euroc_csv(imu_file, EUROC_IMU_COLUMNS)
 
             # Read IMU sensor yaml file
             with open(imu_yaml_file, 'r') as stream:
-                imu_yaml_data = yaml.load(stream)
+                imu_yaml_data = yaml.safe_load(stream)
 
             # Read ground truth data
-            with open(ground_truth_file, 'rt') as csv_file:
-                header_line = 1
-                csv_reader = csv.reader(csv_file, delimiter=',')
-
-                for row in csv_reader:
-                    if header_line:
-                        header_line = 0
-                        continue
-
-                    gt = EurocGT()
-                    gt.read(row)
-                    ground_truth_data.append(gt)
+            ground_truth_data = read_euroc_csv(ground_truth_file, EUROC_GT_COLUMNS)
 
         except IOError:
             print("Dataset file not found")
@@ -111,30 +98,19 @@ class EurocDSManager(InertialDataset):
 
     def get_raw_ds(self):
 
-        self.read_euroc_data()
+        source_files = ["{0}{1}".format(self.ds_local_dir, data_file) for data_file in
+                        (self.imu_data_file, self.gt_data_file)]
+
+        self.read_raw_data(source_files, self.read_euroc_data)
+        self.regularize_timing()
         self.interpolate_ground_truth()
 
         # Cut away last 1% samples (noisy measurements)
-        self.imu_data = self.imu_data[0:int(np.ceil(0.99 * len(self.imu_data)))]
-        self.gt_data = self.gt_data[0:int(np.ceil(0.99 * len(self.gt_data)))]
+        self.keep_first_samples(0.99)
 
         return self.imu_data, self.gt_data
 
     def pre_process_data(self, gyro_scale_file, acc_scale_file):
         self.basic_preprocessing(gyro_scale_file, acc_scale_file, 10)
 
-        self.imu_data, self.gt_data = expand_dataset_region(self.imu_data, self.gt_data)
-
         return self.imu_data, self.gt_data
-
-
-def expand_dataset_region(filt_imu_vec, filt_gt_v_interp):
-    # Add more flat region so avoid model from learning average value
-    flat_region = filt_imu_vec[6000:7000, :]
-    flat_region_v = filt_gt_v_interp[6000:7000, :]
-    flat_region = np.repeat(np.concatenate((flat_region, flat_region[::-1, :])), [4], axis=0)
-    flat_region_v = np.repeat(np.concatenate((flat_region_v, flat_region_v[::-1])), [4], axis=0)
-    filt_imu_vec = np.concatenate((filt_imu_vec[0:6000, :], flat_region, filt_imu_vec[7000:, :]))
-    filt_gt_v_interp = np.concatenate((filt_gt_v_interp[0:6000, :], flat_region_v, filt_gt_v_interp[7000:, :]))
-
-    return filt_imu_vec, filt_gt_v_interp
@@ -0,0 +1,302 @@
+import os
+import json
+import time
+import fcntl
+import shutil
+import hashlib
+import tempfile
+import contextlib
+
+import numpy as np
+
+from utils.directories import safe_mkdir_recursive
+
+
+RAW_CACHE_DIR = './data/dataset/raw_sequence_cache/'
+RAW_CACHE_MAX_BYTES = 20 * 1024 ** 3
+RAW_CACHE_INDEX_FILE = 'index.json'
+RAW_CACHE_LOCK_FILE = 'index.lock'
+METADATA_FILE = 'metadata.json'
+
+HASH_BLOCK_SIZE = 8 * 1024 ** 2
+
+# Part of every cache key. Must be increased whenever the parsed format of the sequences changes
+RAW_CACHE_FORMAT_VERSION = 4
+
+
+def file_digest(file_name):
+    """
+    Computes the sha1 hash of the contents of a file
+
+    :param file_name: directory of the file
+    :return: the hex digest of the file contents
+    """
+
+    sha = hashlib.sha1()
+    with open(file_name, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+class RawSequenceCache:
+    def __init__(self, cache_dir=RAW_CACHE_DIR, max_bytes=RAW_CACHE_MAX_BYTES):
+        """
+        Disk cache of parsed raw sequences and of the outputs of their preprocessing stages. Every entry stores the
+        arrays of a sequence (e.g. its imu and ground truth buffers) as .npy files, which are memory-mapped when loaded,
+        and optionally a small json-serializable metadata dictionary. Raw sequences are keyed by the path, size,
+        modification time and content hash of the source files they were parsed from, and the outputs of the stages by
+        the parameters of the stage and the key of its upstream entry (see `stage_key`), so that the entries form a
+        chain from every raw sequence to its processed versions. The least recently used entries are evicted when the
+        cache grows over its disk budget.
+
+        :param cache_dir: directory of the cache
+        :param max_bytes: disk budget of the cache, in bytes
+        """
+
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.index_file = os.path.join(cache_dir, RAW_CACHE_INDEX_FILE)
+        self.lock_file = os.path.join(cache_dir, RAW_CACHE_LOCK_FILE)
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """
+        Holds an exclusive lock on the cache index, so that several threads or processes can share the cache
+        """
+
+        safe_mkdir_recursive(self.cache_dir)
+        with open(self.lock_file, 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _read_index(self):
+        try:
+            with open(self.index_file, 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {"entries": {}, "digests": {}}
+
+    def _write_index(self, index):
+        safe_mkdir_recursive(self.cache_dir)
+        fd, tmp_file = tempfile.mkstemp(dir=self.cache_dir, suffix='.json')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_file, self.index_file)
+
+    def _source_signature(self, file_name, index):
+        """
+        Gets the (path, size, mtime, content hash) signature of a source file. The content hash is only recomputed when
+        the size or the modification time of the file have changed since it was last hashed.
+        """
+
+        path = os.path.abspath(file_name)
+        stat = os.stat(path)
+        known = index["digests"].get(path)
+
+        if known is None or known["size"] != stat.st_size or known["mtime_ns"] != stat.st_mtime_ns:
+            known = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "digest": file_digest(path)}
+            index["digests"][path] = known
+
+        return [path, known["size"], known["mtime_ns"], known["digest"]]
+
+    def key(self, source_files, index=None, params=None):
+        """
+        Computes the cache key of a sequence
+
+        :param source_files: list of files the sequence is parsed from
+        :param index: cache index (read from disk if not given)
+        :param params: json-serializable parameters the parsed sequence depends on
+        :return: the cache key
+        """
+
+        if index is None:
+            index = self._read_index()
+        signatures = [self._source_signature(file_name, index) for file_name in source_files]
+        key_data = [RAW_CACHE_FORMAT_VERSION, signatures, params]
+        return hashlib.sha1(json.dumps(key_data, sort_keys=True).encode()).hexdigest()
+
+    @staticmethod
+    def stage_key(upstream_key, stage, params=None):
+        """
+        Computes the cache key of the output of a preprocessing stage
+
+        :param upstream_key: cache key of the input data of the stage (e.g. of the raw sequence)
+        :param stage: name of the stage
+        :param params: json-serializable parameters of the stage
+        :return: the cache key
+        """
+
+        key_data = [RAW_CACHE_FORMAT_VERSION, upstream_key, stage, params]
+        return hashlib.sha1(json.dumps(key_data, sort_keys=True).encode()).hexdigest()
+
+    def load(self, source_files, params=None):
+        """
+        Loads a cached sequence
+
+        :param source_files: list of files the sequence is parsed from
+        :param params: parameters the parsed sequence depends on
+        :return: dictionary of name -> memory-mapped array, or None if the sequence is not cached
+        """
+
+        with self._locked():
+            index = self._read_index()
+            key = self.key(source_files, index, params)
+            entry = self._load_entry(index, key)
+            self._write_index(index)
+
+        return None if entry is None else entry[0]
+
+    def load_entry(self, key):
+        """
+        Loads a cached entry by its key (e.g. the output of a preprocessing stage)
+
+        :param key: cache key of the entry
+        :return: the dictionary of name -> memory-mapped array and the metadata of the entry, or None if it is not
+        cached
+        """
+
+        with self._locked():
+            index = self._read_index()
+            entry = self._load_entry(index, key)
+            if entry is not None:
+                self._write_index(index)
+
+        return entry
+
+    def _load_entry(self, index, key):
+        entry_dir = os.path.join(self.cache_dir, key)
+        if key not in index["entries"] or not os.path.isdir(entry_dir):
+            return None
+
+        # Copy-on-write maps: the loaded arrays can be modified in place (e.g. by the dataset specific preprocessing
+        # that follows the cached stages), but the changes are never written back to the cache
+        arrays = {os.path.splitext(file_name)[0]: np.load(os.path.join(entry_dir, file_name), mmap_mode='c')
+                  for file_name in os.listdir(entry_dir) if file_name.endswith('.npy')}
+
+        metadata = None
+        if os.path.exists(os.path.join(entry_dir, METADATA_FILE)):
+            with open(os.path.join(entry_dir, METADATA_FILE), 'r') as f:
+                metadata = json.load(f)
+
+        index["entries"][key]["last_access"] = time.time()
+        return arrays, metadata
+
+    def store(self, source_files, arrays, params=None):
+        """
+        Stores a parsed sequence in the cache, and evicts the least recently used entries if the cache is over budget
+
+        :param source_files: list of files the sequence was parsed from
+        :param arrays: dictionary of name -> array of the parsed sequence
+        :param params: parameters the parsed sequence depends on
+        """
+
+        tmp_dir, entry_size = self._write_entry_files(arrays)
+
+        with self._locked():
+            index = self._read_index()
+            key = self.key(source_files, index, params)
+            self._add_entry(index, key, tmp_dir, entry_size,
+                            sources=[os.path.abspath(file_name) for file_name in source_files])
+
+    def store_entry(self, key, arrays, metadata=None, upstream_key=None):
+        """
+        Stores an entry by its key (e.g. the output of a preprocessing stage), and evicts the least recently used
+        entries if the cache is over budget
+
+        :param key: cache key of the entry
+        :param arrays: dictionary of name -> array of the entry
+        :param metadata: json-serializable dictionary stored along with the arrays
+        :param upstream_key: key of the entry the stored data was computed from. The entry is invalidated along with it
+        """
+
+        tmp_dir, entry_size = self._write_entry_files(arrays, metadata)
+
+        with self._locked():
+            index = self._read_index()
+            self._add_entry(index, key, tmp_dir, entry_size, sources=[], upstream_key=upstream_key)
+
+    def _write_entry_files(self, arrays, metadata=None):
+        """
+        Writes the files of an entry to a temporary directory first, so that no partial entry is ever visible
+
+        :return: the temporary directory and the size of the entry
+        """
+
+        safe_mkdir_recursive(self.cache_dir)
+        tmp_dir = tempfile.mkdtemp(dir=self.cache_dir)
+        # Non-contiguous arrays (e.g. slices of larger arrays) are written in blocks, without copying them at once
+        for name, values in arrays.items():
+            np.save(os.path.join(tmp_dir, name + ".npy"), values)
+        if metadata is not None:
+            with open(os.path.join(tmp_dir, METADATA_FILE), 'w') as f:
+                json.dump(metadata, f)
+
+        entry_size = sum(os.path.getsize(os.path.join(tmp_dir, f)) for f in os.listdir(tmp_dir))
+        return tmp_dir, entry_size
+
+    def _add_entry(self, index, key, tmp_dir, entry_size, sources, upstream_key=None):
+        entry_dir = os.path.join(self.cache_dir, key)
+
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        os.rename(tmp_dir, entry_dir)
+
+        index["entries"][key] = {
+            "sources": sources,
+            "upstream": upstream_key,
+            "size": entry_size,
+            "last_access": time.time()
+        }
+
+        self._evict(index, keep=key)
+        self._write_index(index)
+
+    def _evict(self, index, keep=None):
+        entries = index["entries"]
+        total_size = sum(entry["size"] for entry in entries.values())
+
+        for key in sorted(entries.keys(), key=lambda k: entries[k]["last_access"]):
+            if total_size <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            total_size -= entries[key]["size"]
+            shutil.rmtree(os.path.join(self.cache_dir, key), ignore_errors=True)
+            del entries[key]
+
+    def invalidate(self, source_files=None):
+        """
+        Removes cached sequences, along with the cached outputs of their preprocessing stages
+
+        :param source_files: remove every entry parsed from any of these files. If None, the whole cache is cleared
+        """
+
+        with self._locked():
+            index = self._read_index()
+
+            if source_files is None:
+                invalid_keys = list(index["entries"].keys())
+                index["digests"] = {}
+            else:
+                paths = [os.path.abspath(file_name) for file_name in source_files]
+                invalid_keys = [key for key, entry in index["entries"].items()
+                                if any(path in entry["sources"] for path in paths)]
+                for path in paths:
+                    index["digests"].pop(path, None)
+
+            # The outputs of the preprocessing stages are invalidated along with their upstream entries
+            invalid_keys = set(invalid_keys)
+            downstream_keys = invalid_keys
+            while downstream_keys:
+                downstream_keys = {key for key, entry in index["entries"].items()
+                                   if entry.get("upstream") in downstream_keys} - invalid_keys
+                invalid_keys |= downstream_keys
+
+            for key in invalid_keys:
+                shutil.rmtree(os.path.join(self.cache_dir, key), ignore_errors=True)
+                del index["entries"][key]
+
+            self._write_index(index)
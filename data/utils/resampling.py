@@ -0,0 +1,57 @@
+import numpy as np
+
+
+def parse_oversampled_regions(spec):
+    """
+    Parses the oversampled regions of a sequence
+
+    :param spec: semicolon-separated list of regions, each one as "start:end:repeats" or "start:end:repeats:mirror"
+    (e.g. "6000:7000:4:mirror"), where start and end are sample indices of the processed sequence, every sample of the
+    region is repeated `repeats` times, and with "mirror" the region is followed by a time-reversed copy of itself.
+    An empty spec means no oversampling
+    :return: list of region dictionaries, as used by `oversampling_index_map`
+    """
+
+    regions = []
+    for region_spec in filter(None, spec.replace(" ", "").split(";")):
+        fields = region_spec.split(":")
+        assert len(fields) in (3, 4) and (len(fields) == 3 or fields[3] == "mirror"), \
+            "Region {0} does not match the format start:end:repeats[:mirror]".format(region_spec)
+        regions.append({"start": int(fields[0]), "end": int(fields[1]), "repeats": int(fields[2]),
+                        "mirror": len(fields) == 4})
+
+    return regions
+
+
+def oversampling_index_map(n_samples, regions):
+    """
+    Describes the oversampling of some regions of a sequence as an index map over its samples: the resampled sequence is
+    `sequence[index_map]`. The sequence itself (and its cached preprocessing stages) is never expanded, as the dataset
+    generators gather the samples through the map when they build the windows (see `StatePredictionDataset.load_data`)
+
+    :param n_samples: number of samples of the sequence
+    :param regions: list of dictionaries with the first ("start") and last + 1 ("end") samples of every region, the
+    number of times ("repeats") every sample of the region is repeated, and whether the region is followed by a
+    time-reversed copy of itself ("mirror"). Regions are clipped to the length of the sequence, like slices
+    :return: the index map (int64 array), or None if there are no regions
+    """
+
+    if not regions:
+        return None
+
+    pieces = []
+    position = 0
+    for region in sorted(regions, key=lambda r: r["start"]):
+        start, end = min(region["start"], n_samples), min(region["end"], n_samples)
+        assert start >= position, "The oversampled regions must not overlap"
+        assert region["repeats"] >= 1, "The samples of a region must be repeated at least once"
+
+        region_indices = np.arange(start, end, dtype=np.int64)
+        if region.get("mirror", False):
+            region_indices = np.concatenate((region_indices, region_indices[::-1]))
+
+        pieces += [np.arange(position, start, dtype=np.int64), np.repeat(region_indices, region["repeats"])]
+        position = end
+
+    pieces.append(np.arange(position, n_samples, dtype=np.int64))
+    return np.concatenate(pieces)
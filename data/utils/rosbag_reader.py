@@ -0,0 +1,322 @@
+import bz2
+import mmap
+import struct
+import collections
+
+import numpy as np
+
+
+ROSBAG_MAGIC = b"#ROSBAG V2.0\n"
+
+# Record op codes of the rosbag v2 format (http://wiki.ros.org/Bags/Format/2.0)
+OP_MSG_DATA = 0x02
+OP_BAG_HEADER = 0x03
+OP_INDEX_DATA = 0x04
+OP_CHUNK = 0x05
+OP_CHUNK_INFO = 0x06
+OP_CONNECTION = 0x07
+
+# Each entry of an index data record: message time (secs, nsecs) and offset of the message record inside the chunk
+INDEX_ENTRY_DTYPE = np.dtype([("secs", "<u4"), ("nsecs", "<u4"), ("offset", "<u4")])
+
+# Number of messages decoded at once. Bounds the size of the temporary gather indices
+DECODE_BLOCK_SIZE = 2 ** 16
+
+# Number of float64 values in a serialized sensor_msgs/Imu after the std_msgs/Header (orientation, angular velocity
+# and linear acceleration, each one followed by its 3x3 covariance matrix)
+IMU_FLOAT_COUNT = 37
+
+Connection = collections.namedtuple("Connection", ["id", "topic", "msg_type", "md5sum", "message_definition"])
+ChunkInfo = collections.namedtuple("ChunkInfo", ["position", "start_time", "end_time", "message_counts"])
+
+
+def _parse_header(buffer, position, length):
+    """
+    Parses the header of a bag record into a dictionary of field name -> raw bytes
+
+    :param buffer: buffer holding the record
+    :param position: position of the first header field in the buffer
+    :param length: length of the header in bytes
+    :return: the header fields dictionary
+    """
+
+    fields = {}
+    end = position + length
+    while position < end:
+        field_len, = struct.unpack_from("<I", buffer, position)
+        position += 4
+        name, value = bytes(buffer[position:position + field_len]).split(b"=", 1)
+        fields[name.decode()] = value
+        position += field_len
+    return fields
+
+
+def _read_record(buffer, position):
+    """
+    Reads the record starting at a given position
+
+    :param buffer: buffer holding the record
+    :param position: position of the record in the buffer
+    :return: the header fields, the position of the record data, its length, and the position of the next record
+    """
+
+    header_len, = struct.unpack_from("<I", buffer, position)
+    header = _parse_header(buffer, position + 4, header_len)
+    data_pos = position + 4 + header_len + 4
+    data_len, = struct.unpack_from("<I", buffer, data_pos - 4)
+    return header, data_pos, data_len, data_pos + data_len
+
+
+def _unpack_time(raw_time):
+    secs, nsecs = struct.unpack("<II", raw_time)
+    return secs * 1000000000 + nsecs
+
+
+def _gather(buffer, starts, dtype, count):
+    """
+    Reads `count` consecutive values of type `dtype` starting at every byte position in `starts`. The positions don't
+    need to be aligned to the size of the type.
+
+    :param buffer: buffer to read from
+    :param starts: byte positions of the first value of every row
+    :param dtype: numpy (little endian) type of the values
+    :param count: number of values per row
+    :return: array of shape <len(starts), count>
+    """
+
+    dtype = np.dtype(dtype)
+    out = np.empty((len(starts), count), dtype=dtype)
+    buffer_len = len(buffer)
+
+    for alignment in range(dtype.itemsize):
+        rows = np.flatnonzero(starts % dtype.itemsize == alignment)
+        if not len(rows):
+            continue
+        aligned_view = np.frombuffer(buffer, dtype=dtype, offset=alignment,
+                                     count=(buffer_len - alignment) // dtype.itemsize)
+        for block in range(0, len(rows), DECODE_BLOCK_SIZE):
+            block_rows = rows[block:block + DECODE_BLOCK_SIZE]
+            first_value = (starts[block_rows] - alignment) // dtype.itemsize
+            out[block_rows] = aligned_view[first_value[:, np.newaxis] + np.arange(count)]
+
+    return out
+
+
+def decompress_chunk(compression, data, size):
+    """
+    Decompresses the data of a chunk record
+
+    :param compression: compression type of the chunk (none, bz2 or lz4)
+    :param data: compressed chunk data
+    :param size: uncompressed size of the chunk
+    :return: the uncompressed chunk data
+    """
+
+    if compression == "none":
+        return data
+    if compression == "bz2":
+        out = bz2.decompress(data)
+    elif compression == "lz4":
+        try:
+            import lz4.frame
+        except ImportError:
+            raise ImportError("The lz4 package is needed to read lz4-compressed bags (pip install lz4)")
+        out = lz4.frame.decompress(data)
+    else:
+        raise ValueError("Unknown chunk compression: {0}".format(compression))
+
+    assert len(out) == size, "Corrupted chunk: expected {0} bytes, got {1}".format(size, len(out))
+    return out
+
+
+class RosbagReader:
+    def __init__(self, file_name):
+        """
+        Reads rosbag v2 files without a ROS installation. The file is memory-mapped, and only the chunks that contain
+        the requested topics are accessed, using the connection and chunk indices of the bag.
+
+        :param file_name: directory of the bag file
+        """
+
+        self.file_name = file_name
+        self._file = open(file_name, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self._map[:len(ROSBAG_MAGIC)] != ROSBAG_MAGIC:
+            self.close()
+            raise ValueError("{0} is not a rosbag v2.0 file".format(file_name))
+
+        self.connections = {}
+        self.chunks = []
+        self._read_index()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
+
+    def _read_index(self):
+        header, _, _, _ = _read_record(self._map, len(ROSBAG_MAGIC))
+        assert header["op"][0] == OP_BAG_HEADER, "The bag does not start with a bag header record"
+
+        index_pos, = struct.unpack("<Q", header["index_pos"])
+        conn_count, = struct.unpack("<I", header["conn_count"])
+        chunk_count, = struct.unpack("<I", header["chunk_count"])
+
+        if index_pos == 0:
+            raise ValueError("The bag {0} is not indexed. Run `rosbag reindex` on it first".format(self.file_name))
+
+        position = index_pos
+        for _ in range(conn_count):
+            header, data_pos, data_len, position = _read_record(self._map, position)
+            assert header["op"][0] == OP_CONNECTION, "Expected a connection record in the bag index"
+
+            conn_id, = struct.unpack("<I", header["conn"])
+            conn_header = _parse_header(self._map, data_pos, data_len)
+            self.connections[conn_id] = Connection(
+                id=conn_id,
+                topic=header["topic"].decode(),
+                msg_type=conn_header["type"].decode(),
+                md5sum=conn_header["md5sum"].decode(),
+                message_definition=conn_header.get("message_definition", b"").decode())
+
+        for _ in range(chunk_count):
+            header, data_pos, data_len, position = _read_record(self._map, position)
+            assert header["op"][0] == OP_CHUNK_INFO, "Expected a chunk info record in the bag index"
+
+            counts = np.frombuffer(self._map, dtype="<u4", count=data_len // 4, offset=data_pos).reshape(-1, 2)
+            self.chunks.append(ChunkInfo(
+                position=struct.unpack("<Q", header["chunk_pos"])[0],
+                start_time=_unpack_time(header["start_time"]),
+                end_time=_unpack_time(header["end_time"]),
+                message_counts={int(conn): int(count) for conn, count in counts}))
+
+    def get_topics(self):
+        """
+        :return: dictionary of topic name -> message type of all the topics in the bag
+        """
+
+        return {conn.topic: conn.msg_type for conn in self.connections.values()}
+
+    def get_connection_ids(self, topics):
+        """
+        :param topics: topic name or list of topic names
+        :return: the ids of the connections that publish to the given topics
+        """
+
+        if isinstance(topics, str):
+            topics = [topics]
+        return [conn.id for conn in self.connections.values() if conn.topic in topics]
+
+    def _chunk_index(self, chunk):
+        """
+        Reads the index data records that follow a chunk
+
+        :param chunk: ChunkInfo of the chunk
+        :return: the chunk header, the position and length of the chunk data, and a dictionary of connection id ->
+        index entries (INDEX_ENTRY_DTYPE array)
+        """
+
+        chunk_header, data_pos, data_len, position = _read_record(self._map, chunk.position)
+        assert chunk_header["op"][0] == OP_CHUNK, "Chunk info points to a non-chunk record"
+
+        index = {}
+        for _ in range(len(chunk.message_counts)):
+            header, index_pos, index_len, position = _read_record(self._map, position)
+            assert header["op"][0] == OP_INDEX_DATA, "Expected an index data record after the chunk"
+            conn_id, = struct.unpack("<I", header["conn"])
+            index[conn_id] = np.frombuffer(self._map, dtype=INDEX_ENTRY_DTYPE, count=index_len // 12, offset=index_pos)
+
+        return chunk_header, data_pos, data_len, index
+
+    def message_records(self, topics):
+        """
+        Locates the message records of the requested topics, using the bag index. Uncompressed chunks are not copied:
+        their records are located directly in the memory-mapped file.
+
+        :param topics: topic name or list of topic names
+        :return: list of (buffer, record positions in the buffer, record times in ns, connection ids) tuples
+        """
+
+        conn_ids = set(self.get_connection_ids(topics))
+        mapped_records = []
+        records = []
+
+        for chunk in self.chunks:
+            if not conn_ids.intersection(chunk.message_counts.keys()):
+                continue
+
+            chunk_header, data_pos, data_len, index = self._chunk_index(chunk)
+            compression = chunk_header["compression"].decode()
+
+            entries = [(conn_id, index[conn_id]) for conn_id in sorted(conn_ids) if conn_id in index]
+            if not entries:
+                continue
+            times = np.concatenate([
+                entry["secs"].astype(np.int64) * 1000000000 + entry["nsecs"] for _, entry in entries])
+            offsets = np.concatenate([entry["offset"].astype(np.int64) for _, entry in entries])
+            chunk_conn_ids = np.concatenate([np.full(len(entry), conn_id) for conn_id, entry in entries])
+
+            if compression == "none":
+                mapped_records.append((offsets + data_pos, times, chunk_conn_ids))
+            else:
+                size, = struct.unpack("<I", chunk_header["size"])
+                chunk_data = decompress_chunk(compression, self._map[data_pos:data_pos + data_len], size)
+                records.append((chunk_data, offsets, times, chunk_conn_ids))
+
+        if mapped_records:
+            records.insert(0, (self._map,) + tuple(np.concatenate(field) for field in zip(*mapped_records)))
+
+        return records
+
+    def read_imu_messages(self, topics):
+        """
+        Decodes all the sensor_msgs/Imu messages of the requested topics straight into numpy arrays, sorted by time
+
+        :param topics: topic name or list of topic names
+        :return: dictionary with the bag time (`timestamp`, int64 ns), the header sequence number and stamp (int64 ns),
+        the orientation (x,y,z,w), angular velocity, linear acceleration and their covariances (as 9-vectors)
+        """
+
+        for conn_id in self.get_connection_ids(topics):
+            assert self.connections[conn_id].msg_type == "sensor_msgs/Imu", \
+                "Topic {0} is not of type sensor_msgs/Imu".format(self.connections[conn_id].topic)
+
+        decoded = []
+        for buffer, positions, times, _ in self.message_records(topics):
+            header_len = _gather(buffer, positions, "<u4", 1)[:, 0].astype(np.int64)
+            data_pos = positions + 4 + header_len + 4
+
+            # std_msgs/Header: seq, stamp secs, stamp nsecs, frame_id length (followed by the frame_id itself)
+            msg_header = _gather(buffer, data_pos, "<u4", 4).astype(np.int64)
+            values = _gather(buffer, data_pos + 16 + msg_header[:, 3], "<f8", IMU_FLOAT_COUNT)
+            decoded.append((times, msg_header, values))
+
+        if not decoded:
+            times = np.zeros(0, dtype=np.int64)
+            msg_header = np.zeros((0, 4), dtype=np.int64)
+            values = np.zeros((0, IMU_FLOAT_COUNT))
+        else:
+            times, msg_header, values = (np.concatenate(field) for field in zip(*decoded))
+
+        order = np.argsort(times, kind="stable")
+        times, msg_header, values = times[order], msg_header[order], values[order]
+
+        return {
+            "timestamp": times,
+            "seq": msg_header[:, 0],
+            "stamp": msg_header[:, 1] * 1000000000 + msg_header[:, 2],
+            "orientation": np.ascontiguousarray(values[:, 0:4]),
+            "orientation_covariance": np.ascontiguousarray(values[:, 4:13]),
+            "angular_velocity": np.ascontiguousarray(values[:, 13:16]),
+            "angular_velocity_covariance": np.ascontiguousarray(values[:, 16:25]),
+            "linear_acceleration": np.ascontiguousarray(values[:, 25:28]),
+            "linear_acceleration_covariance": np.ascontiguousarray(values[:, 28:37]),
+        }
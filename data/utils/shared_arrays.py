@@ -0,0 +1,70 @@
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+class SharedArray:
+    def __init__(self, shape, dtype=np.float64, name=None):
+        """
+        Numpy array in a named block of shared memory, so that worker processes can read and write it in place, without
+        pickling it. The process that creates the array owns the block, and removes it when the array is closed.
+
+        :param shape: shape of the array
+        :param dtype: data type of the array
+        :param name: name of an existing block to attach to. If not given, a new (zero-filled) block is created
+        """
+
+        self.shape = tuple(int(s) for s in shape)
+        self.dtype = np.dtype(dtype).str
+        self.owner = name is None
+
+        size = max(int(np.prod(self.shape)) * np.dtype(dtype).itemsize, 1)
+        self.shm = shared_memory.SharedMemory(name=name, create=self.owner, size=size if self.owner else 0)
+
+        self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=self.shm.buf)
+
+    @classmethod
+    def attach(cls, spec):
+        """
+        :param spec: spec of the array, as given by the `spec` property of its owner
+        :return: the array, attached to the shared block of its owner
+        """
+
+        name, shape, dtype = spec
+        return cls(shape, dtype, name)
+
+    @classmethod
+    def from_array(cls, values):
+        """
+        :param values: array to copy
+        :return: a new shared array with a copy of the values
+        """
+
+        shared = cls(np.shape(values), np.asarray(values).dtype)
+        shared.array[...] = values
+        return shared
+
+    @property
+    def spec(self):
+        """
+        Picklable description of the array, used to attach to it from other processes
+        """
+
+        return self.shm.name, self.shape, self.dtype
+
+    def close(self):
+        """
+        Detaches from the shared block (and removes it, if this process owns it). Any view of `array` must have been
+        released before
+        """
+
+        self.array = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -1,64 +1,118 @@
 import gflags
 import yaml
 import sys
+import os
 
 import numpy as np
 import pandas as pd
+from numpy.lib.format import open_memmap
 
 from utils.directories import safe_mkdir_recursive
 from utils.algebra import correct_quaternion_flip
+from utils.kinematics import derive_kinematics_in_chunks
 from data.config.simulated_ds_flags import FLAGS
-from data.inertial_ABCs import IMU, GT, InertialDataset
+from data.inertial_ABCs import InertialDataset, ImuSeries, GtSeries
 
 
-class GenIMU(IMU):
-    def __init__(self):
-        super(GenIMU, self).__init__()
-        self.ts_indx = 0
-        self.gyro_indx = [4, 5, 6]
-        self.acc_indx = [1, 2, 3]
+# Columns of each field in the simulator output files (the timestamp is always the first column). The attitude is
+# written as x,y,z,w, and reordered to w,x,y,z
+SIM_IMU_COLUMNS = {"acc": [1, 2, 3], "gyro": [4, 5, 6]}
+SIM_GT_COLUMNS = {"pos": [1, 2, 3], "att": [7, 4, 5, 6], "vel": [8, 9, 10]}
 
-    def read(self, data):
-        self.timestamp = data[self.ts_indx].astype(np.float) * 10e6
-        self.gyro = data[self.gyro_indx].astype(np.float)
-        self.acc = data[self.acc_indx].astype(np.float)
+# The simulator writes timestamps in seconds, which are converted to ns
+SIM_TIMESTAMP_SCALE = 1e9
 
+READ_BLOCK_SIZE = 8 * 1024 ** 2
 
-class GenGT(GT):
-    def __init__(self):
-        super(GenGT, self).__init__()
 
-    def read(self, data):
-        ts_indx = 0
-        pos_indx = [1, 2, 3]
-        att_indx = [7, 4, 5, 6]  # w,x,y,z
-        vel_indx = [8, 9, 10]
+def count_rows(file_name):
+    """
+    Counts the non-empty lines of a text file, without parsing it
 
-        data = data.astype(np.float)
-        self.timestamp = data[ts_indx] * 10e6
-        self.pos = data[pos_indx]
-        self.att = data[att_indx]
-        self.vel = data[vel_indx]
+    :param file_name: directory of the file
+    :return: the number of non-empty lines
+    """
+
+    with open(file_name, "rb", buffering=READ_BLOCK_SIZE) as f:
+        return sum(1 for line in f if line.strip())
+
+
+def read_simulated_file(file_name, series_class, field_columns, chunk_size=None, out_file=None):
+    """
+    Reads a simulator output file into a series. The file can be parsed in chunks of rows, so that the text is never
+    loaded at once, and the series can be written straight into a memory-mapped .npy file, for files that do not fit in
+    memory. The fields of the series that are not in the file are filled with zeros.
+
+    :param file_name: directory of the whitespace-separated file
+    :param series_class: InertialSeries subclass to read the file into
+    :param field_columns: dictionary of field name -> list of columns of the field in the file
+    :param chunk_size: number of rows parsed at once. The whole file is parsed at once if None
+    :param out_file: if given, the buffer of the series is a memory-mapped .npy file at this directory
+    :return: the series, with the timestamp in (integer) ns
+    """
+
+    field_columns = dict(field_columns, timestamp=0)
+    frames = pd.read_csv(file_name, header=None, delimiter=r"\s+", dtype=np.float64, chunksize=chunk_size)
+    if chunk_size is None:
+        frames = [frames]
+
+    if out_file is None:
+        series = None
+        n_rows = None
+    else:
+        safe_mkdir_recursive(os.path.dirname(out_file))
+        n_rows = count_rows(file_name)
+        series = series_class(open_memmap(out_file, mode="w+", dtype=np.float64, shape=(n_rows, series_class.width())))
+
+    blocks = []
+    row = 0
+    for frame in frames:
+        values = frame.to_numpy()
+        block = series_class.empty(len(values)) if series is None else series[row:row + len(values)]
+        for field, columns in field_columns.items():
+            block.field(field)[...] = values[:, columns]
+        blocks.append(block.buffer)
+        row += len(values)
+
+    if series is None:
+        series = series_class(np.concatenate(blocks))
+    else:
+        assert row == n_rows, "Expected {0} rows in {1}, parsed {2}".format(n_rows, file_name, row)
+
+    series.timestamp = np.rint(series.timestamp * SIM_TIMESTAMP_SCALE)
+
+    return series
 
 
 class GenDSManager(InertialDataset):
-    def __init__(self, *args):
+    def __init__(self, *args, dataset_version=None, flight=None, number=None):
+        """
+        :param args: flags to parse
+        :param dataset_version: version of the generated dataset. Taken from the flags if not given
+        :param flight: flight of the generated dataset. Taken from the flags if not given
+        :param number: number of the generated flight. Taken from the flags if not given
+        """
+
         super(GenDSManager, self).__init__()
         self.ds_flags = FLAGS
         self.simulation_dir = "./catkin_ws/src/rpg_vi_simulation/"
 
-        self.ds_gen_config_dict = None
-        self.sampling_freq = None
-        self.g_value = None
-        self.dataset_name = None
-        self.get_ds_params()
-
         try:
             _ = FLAGS(args)  # parse flags
         except gflags.FlagsError:
             print('Usage: %s ARGS\\n%s' % (sys.argv[0], FLAGS))
             sys.exit(1)
 
+        self.dataset_version = self.ds_flags.dataset_version if dataset_version is None else dataset_version
+        self.flight = self.ds_flags.flight if flight is None else flight
+        self.number = self.ds_flags.number if number is None else int(number)
+
+        self.ds_gen_config_dict = None
+        self.sampling_freq = None
+        self.g_value = None
+        self.dataset_name = None
+        self.get_ds_params()
+
         # The dataset data is found at the simulator directory
         self.ds_dir = "{0}vi_sim_interface/sim_datasets/{1}".format(self.simulation_dir, self.dataset_name)
         self.gt_file = "{0}interpolated_gt.txt".format(self.ds_dir)
@@ -73,7 +127,7 @@ class GenDSManager(InertialDataset):
         Reads the needed parameters from the synthetic dataset generation configuration files
         """
 
-        config = "{0}vi_sim_interface/exp_configs/{1}.yaml".format(self.simulation_dir, self.ds_flags.dataset_version)
+        config = "{0}vi_sim_interface/exp_configs/{1}.yaml".format(self.simulation_dir, self.dataset_version)
 
         with open(config, 'r') as stream:
             try:
@@ -83,7 +137,7 @@ class GenDSManager(InertialDataset):
 
         config_type = self.ds_gen_config_dict['vi_param']
         self.dataset_name = "{0}/{1}/{2}/".format(
-            self.ds_gen_config_dict['traj_dir'], self.ds_flags.flight, self.ds_flags.number)
+            self.ds_gen_config_dict['traj_dir'], self.flight, self.number)
 
         imu_params = "{0}ze_vi_simulation/vi_params/{1}/imu_params.txt".format(self.simulation_dir, config_type)
 
@@ -95,30 +149,28 @@ class GenDSManager(InertialDataset):
                 self.g_value = x
 
     def read_synthetic_data(self):
+        chunk_size = self.ds_flags.read_chunk_size or None
+        out_dir = self.ds_local_dir + "raw_series/" if self.ds_flags.out_of_core_read else None
 
-        raw_imu_data = []
-        ground_truth_data = []
-
-        for row in pd.read_csv(self.imu_file, header=None, delimiter=r"\s+").values:
-            imu = GenIMU()
-            imu.read(row)
-            raw_imu_data.append(imu)
-
-        gt_old = GenGT()
-        for row in pd.read_csv(self.gt_file, header=None, delimiter=r"\s+").values:
-            gt = GenGT()
-            gt.read(row)
-            ground_truth_data.append(gt)
+        raw_imu_data = read_simulated_file(self.imu_file, ImuSeries, SIM_IMU_COLUMNS, chunk_size,
+                                           out_dir + "imu.npy" if out_dir else None)
+        ground_truth_data = read_simulated_file(self.gt_file, GtSeries, SIM_GT_COLUMNS, chunk_size,
+                                                out_dir + "gt.npy" if out_dir else None)
 
-            gt.integrate(gt_old, int_pos=False)
-            gt_old = gt
+        # The simulator provides the velocity, but not the angular velocity and acceleration. They are derived chunk by
+        # chunk, straight into the (possibly memory-mapped) ground truth series
+        derive_kinematics_in_chunks(ground_truth_data.timestamp, ground_truth_data.pos, ground_truth_data.att,
+                                    {"ang_vel": ground_truth_data.ang_vel, "acc": ground_truth_data.acc},
+                                    vel=ground_truth_data.vel, chunk_size=chunk_size or len(ground_truth_data),
+                                    timestamp_scale=SIM_TIMESTAMP_SCALE)
 
         self.imu_data = raw_imu_data
         self.gt_data = ground_truth_data
 
     def get_raw_ds(self):
 
-        self.read_synthetic_data()
+        self.read_raw_data([self.imu_file, self.gt_file], self.read_synthetic_data)
+        self.regularize_timing()
         self.interpolate_ground_truth()
 
         return self.imu_data, self.gt_data
@@ -126,8 +178,7 @@ class GenDSManager(InertialDataset):
     def pre_process_data(self, gyro_scale_file, acc_scale_file):
         self.basic_preprocessing(gyro_scale_file, acc_scale_file, 10)
 
-        corrected_quaternion = correct_quaternion_flip(np.stack(self.gt_data[:, 2]))
-        for i in range(len(self.gt_data)):
-            self.gt_data[i, 2] = corrected_quaternion[i, :]
+        # Attitude quaternion columns (see GT_FIELDS)
+        self.gt_data[:, 6:10] = correct_quaternion_flip(self.gt_data[:, 6:10])
 
         return self.imu_data, self.gt_data
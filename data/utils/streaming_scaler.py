@@ -0,0 +1,183 @@
+import json
+
+import numpy as np
+
+
+class StreamingScaler:
+    def __init__(self, n_features=None):
+        """
+        Per-feature statistics (min, max, mean and variance) of a dataset, computed incrementally: the data can be fed
+        chunk by chunk, and the statistics of different datasets (e.g. sequences) can be merged into the statistics of
+        all of them together. The mean and variance are updated with the parallel version of Welford's algorithm, which
+        is numerically stable.
+
+        The statistics are saved as a small json file, which can be loaded without unpickling and without sklearn.
+
+        :param n_features: number of features of the data. Set by the first chunk of data if not given
+        """
+
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+        self.data_min = None
+        self.data_max = None
+
+        if n_features is not None:
+            self._reset(n_features)
+
+    def _reset(self, n_features):
+        self.count = 0
+        self.mean = np.zeros(n_features)
+        self.m2 = np.zeros(n_features)
+        self.data_min = np.full(n_features, np.inf)
+        self.data_max = np.full(n_features, -np.inf)
+
+    @property
+    def var(self):
+        return self.m2 / self.count if self.count else np.zeros_like(self.m2)
+
+    @property
+    def std(self):
+        return np.sqrt(self.var)
+
+    def _combine(self, count, mean, m2, data_min, data_max):
+        """
+        Adds the statistics of another set of samples to the statistics of the scaler
+        """
+
+        if self.mean is None:
+            self._reset(len(mean))
+        assert len(mean) == len(self.mean), "The number of features does not match: {0} != {1}".format(
+            len(mean), len(self.mean))
+
+        if not count:
+            return
+
+        total = self.count + count
+        delta = mean - self.mean
+
+        self.mean = self.mean + delta * count / total
+        self.m2 = self.m2 + m2 + delta ** 2 * self.count * count / total
+        self.data_min = np.minimum(self.data_min, data_min)
+        self.data_max = np.maximum(self.data_max, data_max)
+        self.count = total
+
+    def partial_fit(self, x):
+        """
+        Updates the statistics with a chunk of data
+
+        :param x: data chunk, shape <n_samples, n_features>
+        :return: the scaler itself
+        """
+
+        x = np.asarray(x, dtype=np.float64)
+        if not len(x):
+            if self.mean is None:
+                self._reset(x.shape[1])
+            return self
+
+        mean = np.mean(x, axis=0)
+        self._combine(len(x), mean, np.sum((x - mean) ** 2, axis=0), np.min(x, axis=0), np.max(x, axis=0))
+        return self
+
+    def fit(self, x, chunk_size=None):
+        """
+        Computes the statistics of some data, discarding the previous ones
+
+        :param x: data, shape <n_samples, n_features>
+        :param chunk_size: if given, the data is read in chunks of this number of samples (e.g. if memory-mapped)
+        :return: the scaler itself
+        """
+
+        self._reset(np.shape(x)[1])
+        chunk_size = chunk_size or max(len(x), 1)
+        for start in range(0, len(x), chunk_size):
+            self.partial_fit(x[start:start + chunk_size])
+        return self
+
+    def merge(self, other):
+        """
+        Adds the statistics of another scaler, as if its data had been fed to this scaler
+
+        :param other: StreamingScaler
+        :return: the scaler itself
+        """
+
+        if other.mean is not None:
+            self._combine(other.count, other.mean, other.m2, other.data_min, other.data_max)
+        return self
+
+    @classmethod
+    def merged(cls, scalers):
+        """
+        :param scalers: list of StreamingScalers (e.g. of different sequences)
+        :return: a new scaler with the statistics of all the scalers together
+        """
+
+        merged = cls()
+        for scaler in scalers:
+            merged.merge(scaler)
+        return merged
+
+    def transform(self, x):
+        """
+        Scales the data to the [0, 1] range of the fitted data (same as sklearn's MinMaxScaler). Constant features are
+        only shifted
+
+        :param x: data, shape <n_samples, n_features>
+        :return: the scaled data
+        """
+
+        data_range = self.data_max - self.data_min
+        data_range[data_range == 0] = 1
+        return (x - self.data_min) / data_range
+
+    def standardize(self, x):
+        """
+        Scales the data to zero mean and unit variance (with the statistics of the fitted data). Constant features are
+        only centered
+
+        :param x: data, shape <n_samples, n_features>
+        :return: the standardized data
+        """
+
+        std = self.std
+        std[std == 0] = 1
+        return (x - self.mean) / std
+
+    def to_dict(self):
+        assert self.mean is not None, "The scaler has not been fitted yet"
+        return {"count": self.count, "mean": self.mean.tolist(), "m2": self.m2.tolist(),
+                "min": self.data_min.tolist(), "max": self.data_max.tolist()}
+
+    @classmethod
+    def from_dict(cls, stats):
+        scaler = cls(len(stats["mean"]))
+        scaler.count = stats["count"]
+        scaler.mean = np.array(stats["mean"], dtype=np.float64)
+        scaler.m2 = np.array(stats["m2"], dtype=np.float64)
+        scaler.data_min = np.array(stats["min"], dtype=np.float64)
+        scaler.data_max = np.array(stats["max"], dtype=np.float64)
+        return scaler
+
+    def save(self, file_name):
+        """
+        Saves the statistics as a json file
+
+        :param file_name: directory of the file
+        """
+
+        with open(file_name, "w") as f:
+            json.dump(self.to_dict(), f)
+
+    @classmethod
+    def load(cls, file_name):
+        """
+        Loads a scaler saved with `save`
+
+        :param file_name: directory of the file
+        :return: the scaler
+        """
+
+        with open(file_name, "r") as f:
+            return cls.from_dict(json.load(f))
@@ -203,7 +203,7 @@ class ExperimentManager:
                     for it in range(n_predictions_c):
                         progress_bar.update(it + 1)
                         model_out = self.alt_prediction_algo(
-                            np.squeeze(np.expand_dims(dataset[0]["imu_input"][ds_i], axis=0), axis=-1), state_in, False)
+                            np.squeeze(np.expand_dims(dataset[0]["imu_input"][ds_i], axis=0), axis=-1), state_in)
                         model_predictions[it, :] = model_out
                         state_in = model_out
                         comparisons_x_axis[it] = int(ds_i)
@@ -84,7 +84,16 @@ class Learner(object):
         dataset_manager = DatasetManager(prepared_train_data_file='imu_dataset_train.mat',
                                          prepared_test_data_file='imu_dataset_test.mat',
                                          trained_model_dir=self.trained_model_dir,
-                                         dataset_name=dataset_name)
+                                         dataset_name=dataset_name,
+                                         sequences=self.config.sequences,
+                                         max_workers=self.config.ingestion_workers,
+                                         chunk_size=self.config.preprocessing_chunk_size or None,
+                                         uniform_imu_rate=self.config.uniform_imu_rate,
+                                         pre_integration_workers=self.config.pre_integration_workers,
+                                         max_window_len=self.config.max_window_length,
+                                         precision=self.config.dataset_precision,
+                                         window_stride=self.config.window_stride,
+                                         random_stride=self.config.random_window_stride)
 
         return dataset_manager.get_dataset(self.config.dataset_type,
                                            self.config.window_length,
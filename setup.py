@@ -15,12 +15,10 @@ setup(
         'tensorflow==2.0a',
         'numpy',
         'scipy',
-        'sklearn',
         'pyquaternion',
         'requests',
         'matplotlib',
         'python-gflags',
-        'joblib',
         'PyYAML',
         'pandas'
     ],
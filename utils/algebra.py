@@ -1,61 +1,37 @@
 import numpy as np
 from pyquaternion import Quaternion
-from tensorflow.python.keras.utils import Progbar
 import tensorflow as tf
 import tfquaternion as tfq
 
 
-def imu_integration(imu_data, x_0_v, track_progress=True):
-
-    # TODO: get a better comparison
-
-    samples = len(imu_data)
-    out = np.zeros((samples, 10))
-
-    imu_v, t_diff_v = imu_data[:, :, :6], imu_data[:, :, 6:]
-
-    # Convert time diff to seconds
-    t_diff_v = np.squeeze(np.stack(t_diff_v/1000), axis=2)
-
-    bar = Progbar(samples)
-
-    for sample in range(samples):
-        if track_progress:
-            bar.update(sample)
-
-        t_diff = t_diff_v[sample, :]
-
-        # Get initial states (world frame)
-        x_i = x_0_v[sample, :3]
-        v_i = x_0_v[sample, 3:6]
-        q_i = Quaternion(x_0_v[sample, 6:]).unit
-
-        for i in range(len(t_diff)):
-
-            dt = t_diff[i]
+def imu_integration(imu_data, x_0_v):
+    """
+    Integrates the imu samples of a batch of windows from their initial states (baseline of the state predictions).
+    All the windows are integrated at once, through their `PreIntegrationIndex`.
 
-            # Rotation body -> world
-            w_R_b = q_i.inverse
+    The attitude of the states rotates world vectors into the body frame, and the acceleration is integrated with a
+    gravity of +9.81 along z. This is the body attitude of the index inverted, turning with the opposite angular
+    velocity
 
-            # Rotate angular velocity to world frame
-            w_w = w_R_b.rotate(imu_v[sample, i, :3])
-            # Rotate acceleration to world frame
-            w_a = w_R_b.rotate(imu_v[sample, i, 3:]) + [0, 0, 9.81]
+    :param imu_data: imu windows, with shape <n_windows, window_len, 7> (3 gyro + 3 acc + dt in ms)
+    :param x_0_v: 10-dimensional initial state (position, velocity and attitude) of every window
+    :return: the 10-dimensional final state of every window
+    """
 
-            # Integrate attitude (world frame)
-            q_i.integrate(w_w, dt)
+    # TODO: get a better comparison
 
-            # Integrate velocity
-            v_i += w_a*dt
+    imu_data = np.asarray(imu_data, dtype=np.float64)
+    x_0_v = np.array(x_0_v, dtype=np.float64)
 
-            # Integrate position
-            x_i += v_i*dt + 1/2*w_a*(dt**2)
+    # Convert time diff to seconds
+    index = PreIntegrationIndex(-imu_data[:, :, :3], imu_data[:, :, 3:6], imu_data[:, :, 6] / 1000)
 
-        out[sample, 0:3] = x_i
-        out[sample, 3:6] = v_i
-        out[sample, 6:] = q_i.elements
+    x_0_v[:, 6:] = quaternion_conjugate(quaternion_normalize(x_0_v[:, 6:]))
+    out = index.integrate(x_0_v, 0, imu_data.shape[1], [0, 0, 9.81])
+    out[:, 6:] = quaternion_conjugate(out[:, 6:])
 
-    out[:, 6:] = correct_quaternion_flip(out[:, 6:])
+    # Make sure that the quaternions are positive rotations (see `correct_quaternion_flip`)
+    out[:, 6:] *= np.where(out[:, 6:7] < 0, -1.0, 1.0)
     return out
 
 
@@ -186,6 +162,96 @@ def correct_quaternion_flip(q_vec):
     return q_vec
 
 
+def quaternion_product(q1, q2):
+    """
+    Computes the Hamilton product of two quaternions, or element-wise of two arrays of quaternions, without building
+    Quaternion objects
+
+    :param q1: left quaternion (or array of quaternions, along the first axis) in w,x,y,z format
+    :param q2: right quaternion (or array of quaternions, along the first axis) in w,x,y,z format
+    :return: the product q1 * q2 in w,x,y,z format
+    """
+
+    w1, x1, y1, z1 = np.moveaxis(np.asarray(q1), -1, 0)
+    w2, x2, y2, z2 = np.moveaxis(np.asarray(q2), -1, 0)
+
+    return np.stack((w1 * w2 - x1 * x2 - y1 * y2 - z1 * z2,
+                     w1 * x2 + x1 * w2 + y1 * z2 - z1 * y2,
+                     w1 * y2 - x1 * z2 + y1 * w2 + z1 * x2,
+                     w1 * z2 + x1 * y2 - y1 * x2 + z1 * w2), axis=-1)
+
+
+def quaternion_conjugate(q):
+    """
+    :param q: quaternion (or array of quaternions, along the first axis) in w,x,y,z format
+    :return: the conjugate quaternion(s)
+    """
+
+    return np.asarray(q) * np.array([1.0, -1.0, -1.0, -1.0])
+
+
+def quaternion_normalize(q):
+    """
+    :param q: quaternion (or array of quaternions, along the first axes) in w,x,y,z format
+    :return: the unit quaternion(s)
+    """
+
+    q = np.asarray(q, dtype=np.float64)
+    return q / np.linalg.norm(q, axis=-1, keepdims=True)
+
+
+def quaternion_to_rotation_matrix(q):
+    """
+    Computes the rotation matrix of a unit quaternion, or of an array of quaternions, without building Quaternion
+    objects
+
+    :param q: unit quaternion (or array of quaternions, along the first axes) in w,x,y,z format
+    :return: the rotation matrix (or array of matrices, with shape <..., 3, 3>), same as `Quaternion(q).rotation_matrix`
+    """
+
+    w, x, y, z = np.moveaxis(np.asarray(q), -1, 0)
+
+    return np.stack((np.stack((1 - 2 * (y * y + z * z), 2 * (x * y - w * z), 2 * (x * z + w * y)), axis=-1),
+                     np.stack((2 * (x * y + w * z), 1 - 2 * (x * x + z * z), 2 * (y * z - w * x)), axis=-1),
+                     np.stack((2 * (x * z - w * y), 2 * (y * z + w * x), 1 - 2 * (x * x + y * y)), axis=-1)), axis=-2)
+
+
+def quaternion_log(q_vec):
+    """
+    Computes the logarithmic mapping of an array of quaternions (along the first axes) to so3, like `log_mapping` but
+    without building Quaternion objects. The quaternions are normalized, and the identity is mapped to zero
+
+    :param q_vec: quaternion (or array of quaternions) in w,x,y,z format
+    :return: the so3 vector(s) of the quaternion(s)
+    """
+
+    q_vec = quaternion_normalize(q_vec)
+    w, u = q_vec[..., :1], q_vec[..., 1:]
+    u_norm = np.linalg.norm(u, axis=-1, keepdims=True)
+
+    # arctan2(|u|, w) is arccos(w) for unit quaternions, but it stays accurate for small rotations
+    identity = np.all(np.isclose(q_vec, [1.0, 0.0, 0.0, 0.0]), axis=-1, keepdims=True)
+    scale = np.divide(2 * np.arctan2(u_norm, w), u_norm, out=np.zeros_like(u_norm), where=~identity & (u_norm > 0))
+
+    return scale * u
+
+
+def continuous_quaternions(q_vec):
+    """
+    Flips the sign of the quaternions of a sequence so that every quaternion lies in the same hemisphere as the previous
+    one. Unlike `correct_quaternion_flip`, the result has no sign jumps, so it can be interpolated and differentiated
+
+    :param q_vec: quaternion sequence (n quaternions)
+    :return: the continuous quaternion sequence
+    """
+
+    q_vec = np.asarray(q_vec, dtype=np.float64)
+    flips = np.sum(q_vec[1:] * q_vec[:-1], axis=1) < 0
+    signs = np.cumprod(np.append(1.0, np.where(flips, -1.0, 1.0)))
+
+    return q_vec * signs[:, np.newaxis]
+
+
 def log_mapping(q_vec):
     """
     Computes the Lie algebra so3 of the quaternion group SU2, or array of quaternions, via the logarithmic mapping
@@ -200,6 +266,121 @@ def log_mapping(q_vec):
     return w
 
 
+def quaternion_exp(w_vec):
+    """
+    Computes the exponential mapping of an array of so3 vectors (along the first axes) to unit quaternions, like
+    `exp_mapping` but without building Quaternion objects
+
+    :param w_vec: 3 component vector or array of vectors
+    :return: the unit quaternion(s) in w,x,y,z format
+    """
+
+    w_vec = np.asarray(w_vec, dtype=np.float64)
+    angle = np.linalg.norm(w_vec, axis=-1, keepdims=True)
+
+    # sin(angle / 2) / angle, which goes to 1/2 for small angles
+    return np.concatenate((np.cos(angle / 2), np.sinc(angle / (2 * np.pi)) / 2 * w_vec), axis=-1)
+
+
+class PreIntegrationIndex:
+    def __init__(self, gyro, acc, dt):
+        """
+        Cumulative index of the imu measurements of a sequence, from which the pre-integrated motion between any two
+        of its samples is read in constant time, instead of integrating the samples between them. The body attitude
+        (relative to the body frame at the first sample) is the prefix product of the rotation of every sample, and the
+        velocity and position are the prefix sums of the acceleration rotated by that attitude:
+
+            q_k = Exp(w_0 dt_0) * ... * Exp(w_k-1 dt_k-1)
+            v_k = sum(R(q_m) a_m dt_m),  p_k = sum(v_m dt_m + 1/2 R(q_m) a_m dt_m ^ 2),  for m < k
+
+        so that the pre-integrated rotation, velocity and position from the sample i to the sample j are
+        q_i^-1 * q_j, R(q_i)^T (v_j - v_i) and R(q_i)^T (p_j - p_i - v_i (t_j - t_i)). The prefix product is computed
+        as a parallel scan, in log2(n) vectorized quaternion products.
+
+        Several sequences of the same length (e.g. a batch of windows) are indexed at once by adding leading dimensions
+        to the samples
+
+        :param gyro: angular velocity (body frame, rad/s) of every sample, with shape <..., n, 3>
+        :param acc: specific force (body frame, m/s^2) of every sample, with shape <..., n, 3>
+        :param dt: integration time (s) of every sample, with shape <..., n>
+        """
+
+        gyro, acc, dt = np.asarray(gyro), np.asarray(acc), np.asarray(dt, dtype=np.float64)[..., np.newaxis]
+        leading = np.shape(dt)[:-2]
+
+        # Rotation of every sample, accumulated in a Hillis-Steele scan: after the step with the given offset, every
+        # quaternion is the product of the last 2 * offset rotations up to it
+        att = quaternion_exp(gyro * dt)
+        offset = 1
+        while offset < att.shape[-2]:
+            att[..., offset:, :] = quaternion_product(att[..., :-offset, :], att[..., offset:, :])
+            offset *= 2
+
+        identity = np.broadcast_to([1.0, 0.0, 0.0, 0.0], leading + (1, 4))
+        self.att = quaternion_normalize(np.concatenate((identity, att), axis=-2))
+
+        # The attitude at the beginning of every sample rotates its acceleration
+        acc_rot = np.einsum('...ij,...j->...i', quaternion_to_rotation_matrix(self.att[..., :-1, :]), acc)
+
+        zero, zeros = np.zeros(leading + (1, 1)), np.zeros(leading + (1, 3))
+        self.time = np.concatenate((zero, np.cumsum(dt, axis=-2)), axis=-2)
+        self.vel = np.concatenate((zeros, np.cumsum(acc_rot * dt, axis=-2)), axis=-2)
+        self.pos = np.concatenate(
+            (zeros, np.cumsum(self.vel[..., :-1, :] * dt + 1/2 * acc_rot * dt ** 2, axis=-2)), axis=-2)
+
+    def __len__(self):
+        return self.att.shape[-2] - 1
+
+    def query(self, i, j):
+        """
+        Reads the pre-integrated motion between two samples (the motion during the samples i to j - 1), in the body
+        frame at the sample i. i and j can be arrays of sample indices, which are broadcast together
+
+        :param i: first sample
+        :param j: last sample + 1 (from 0 to the number of samples)
+        :return: the pre-integrated rotation (quaternion), velocity and position, and the elapsed time, with one index
+        per leading dimension of the sequences followed by the dimensions of i and j
+        """
+
+        i, j = np.broadcast_arrays(i, j)
+        att_i, att_j = np.take(self.att, i, axis=-2), np.take(self.att, j, axis=-2)
+        vel_i, vel_j = np.take(self.vel, i, axis=-2), np.take(self.vel, j, axis=-2)
+        time_i, time_j = np.take(self.time, i, axis=-2), np.take(self.time, j, axis=-2)
+        pos_i, pos_j = np.take(self.pos, i, axis=-2), np.take(self.pos, j, axis=-2)
+
+        delta_t = time_j - time_i
+        r_i = quaternion_to_rotation_matrix(att_i)
+
+        delta_q = quaternion_product(quaternion_conjugate(att_i), att_j)
+        delta_v = np.einsum('...ji,...j->...i', r_i, vel_j - vel_i)
+        delta_p = np.einsum('...ji,...j->...i', r_i, pos_j - pos_i - vel_i * delta_t)
+
+        return delta_q, delta_v, delta_p, delta_t[..., 0]
+
+    def integrate(self, states, i, j, gravity):
+        """
+        Integrates the imu samples i to j - 1 from some initial states
+
+        :param states: 10-dimensional state (world frame position, velocity and body attitude) at the sample i
+        :param i: first sample (or array of samples)
+        :param j: last sample + 1 (or array of samples)
+        :param gravity: gravity acceleration vector, in world frame
+        :return: the 10-dimensional state at the sample j
+        """
+
+        delta_q, delta_v, delta_p, delta_t = self.query(i, j)
+        delta_t = delta_t[..., np.newaxis]
+        gravity = np.asarray(gravity)
+
+        pos, vel, att = states[..., 0:3], states[..., 3:6], quaternion_normalize(states[..., 6:])
+        r = quaternion_to_rotation_matrix(att)
+
+        return np.concatenate((
+            pos + vel * delta_t + 1/2 * gravity * delta_t ** 2 + np.einsum('...ij,...j->...i', r, delta_p),
+            vel + gravity * delta_t + np.einsum('...ij,...j->...i', r, delta_v),
+            quaternion_normalize(quaternion_product(att, delta_q))), axis=-1)
+
+
 def exp_mapping(w_vec):
     """
     Computes the quaternion representation of the Lie algebra vector so3, or array of vectors, by exponential mapping
@@ -0,0 +1,128 @@
+import numpy as np
+from scipy.signal import savgol_filter
+
+from utils.algebra import quaternion_product, quaternion_conjugate, continuous_quaternions
+
+
+# Number of samples derived at once by `derive_kinematics_in_chunks`
+KINEMATICS_CHUNK_SIZE = 2 ** 20
+
+
+def time_derivative(values, timestamps, order=1, smoothing_window=None, polyorder=3, sampling_period=None):
+    """
+    Differentiates a sampled signal with respect to time, for all the samples and channels at once
+
+    :param values: signal samples, with the samples in the first dimension
+    :param timestamps: sample times, in seconds
+    :param order: order of the derivative
+    :param smoothing_window: if given, length (in samples, odd) of the Savitzky-Golay filter used to smooth and
+    differentiate the signal. The filter assumes uniform sampling, so the median sampling period is used. If None,
+    second order (non-uniform) finite differences are used instead
+    :param polyorder: order of the polynomial fitted by the Savitzky-Golay filter. Must be larger than `order`
+    :param sampling_period: sampling period used by the Savitzky-Golay filter. The median sampling period of the
+    timestamps if not given
+    :return: the derivative of the signal, same shape as `values`
+    """
+
+    values = np.asarray(values, dtype=np.float64)
+    timestamps = np.asarray(timestamps, dtype=np.float64)
+
+    if smoothing_window:
+        assert smoothing_window % 2 == 1, "The smoothing window must have an odd length"
+        assert polyorder > order, "The polynomial order must be larger than the derivative order"
+        delta = np.median(np.diff(timestamps)) if sampling_period is None else sampling_period
+        return savgol_filter(values, smoothing_window, polyorder, deriv=order, delta=delta, axis=0)
+
+    for _ in range(order):
+        values = np.gradient(values, timestamps, axis=0)
+    return values
+
+
+def body_angular_velocity(att, timestamps, smoothing_window=None, polyorder=3, sampling_period=None):
+    """
+    Computes the angular velocity in body frame of an attitude sequence, as w = 2 * q^-1 * dq/dt
+
+    :param att: attitude quaternion sequence in w,x,y,z format, shape <n, 4>
+    :param timestamps: sample times, in seconds
+    :param smoothing_window: Savitzky-Golay window for the quaternion derivative (see `time_derivative`)
+    :param polyorder: Savitzky-Golay polynomial order
+    :param sampling_period: Savitzky-Golay sampling period (see `time_derivative`)
+    :return: the angular velocity sequence, shape <n, 3>, in rad/s
+    """
+
+    att = continuous_quaternions(att)
+    att = att / np.linalg.norm(att, axis=1, keepdims=True)
+
+    att_dot = time_derivative(att, timestamps, smoothing_window=smoothing_window, polyorder=polyorder,
+                              sampling_period=sampling_period)
+
+    return 2 * quaternion_product(quaternion_conjugate(att), att_dot)[:, 1:]
+
+
+def derive_kinematics(timestamps, pos, att, vel=None, smoothing_window=None, polyorder=3, sampling_period=None):
+    """
+    Derives the linear velocity, body angular velocity and linear acceleration of a whole trajectory
+
+    :param timestamps: sample times, in seconds
+    :param pos: position sequence, shape <n, 3>
+    :param att: attitude quaternion sequence in w,x,y,z format, shape <n, 4>
+    :param vel: velocity sequence, shape <n, 3>. If given, it is not derived from the position, and the acceleration is
+    derived from it
+    :param smoothing_window: if given, length of the Savitzky-Golay window used for all the derivatives
+    :param polyorder: Savitzky-Golay polynomial order
+    :param sampling_period: Savitzky-Golay sampling period (see `time_derivative`)
+    :return: dictionary with the `vel`, `ang_vel` and `acc` sequences
+    """
+
+    if vel is None:
+        vel = time_derivative(pos, timestamps, 1, smoothing_window, polyorder, sampling_period)
+        acc = time_derivative(pos, timestamps, 2, smoothing_window, polyorder, sampling_period)
+    else:
+        acc = time_derivative(vel, timestamps, 1, smoothing_window, polyorder, sampling_period)
+
+    ang_vel = body_angular_velocity(att, timestamps, smoothing_window, polyorder, sampling_period)
+
+    return {"vel": vel, "ang_vel": ang_vel, "acc": acc}
+
+
+def derive_kinematics_in_chunks(timestamps, pos, att, out, vel=None, chunk_size=KINEMATICS_CHUNK_SIZE,
+                                timestamp_scale=1.0, smoothing_window=None, polyorder=3):
+    """
+    Derives the kinematics of a trajectory (see `derive_kinematics`) chunk by chunk, and writes them into the given
+    arrays (e.g. the fields of a memory-mapped series), so that the trajectory is never loaded in memory at once. Every
+    chunk is derived with a margin of samples at both sides as wide as the stencil of the derivatives, and only its own
+    samples are kept, so the result is the same as if the whole trajectory was derived at once
+
+    :param timestamps: sample times
+    :param pos: position sequence, shape <n, 3>
+    :param att: attitude quaternion sequence in w,x,y,z format, shape <n, 4>
+    :param out: dictionary with the arrays where the derived `ang_vel`, `acc` and (if `vel` is not given) `vel` are
+    written
+    :param vel: velocity sequence, shape <n, 3> (see `derive_kinematics`)
+    :param chunk_size: number of samples derived at once
+    :param timestamp_scale: the timestamps are divided by this factor to get them in seconds
+    :param smoothing_window: if given, length of the Savitzky-Golay window used for all the derivatives
+    :param polyorder: Savitzky-Golay polynomial order
+    """
+
+    n_samples = len(timestamps)
+
+    # The finite differences reach one sample at both sides (two for the second derivative), and the Savitzky-Golay
+    # filter half its window. The filter uses the median sampling period of the whole trajectory, as in a single chunk
+    margin = smoothing_window // 2 if smoothing_window else 2
+    sampling_period = None
+    if smoothing_window:
+        sampling_period = np.median(np.diff(np.asarray(timestamps, dtype=np.float64) / timestamp_scale))
+
+    for start in range(0, n_samples, chunk_size):
+        end = min(start + chunk_size, n_samples)
+        margin_start = max(start - margin, 0)
+        margin_end = min(end + margin, n_samples)
+        chunk = slice(margin_start, margin_end)
+
+        kinematics = derive_kinematics(np.asarray(timestamps[chunk], dtype=np.float64) / timestamp_scale, pos[chunk],
+                                       att[chunk], None if vel is None else vel[chunk], smoothing_window, polyorder,
+                                       sampling_period)
+
+        for name, values in out.items():
+            values[start:end] = kinematics[name][start - margin_start:end - margin_start]